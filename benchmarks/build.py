@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+
+"""Measure the time taken by anod build in typical scenarios.
+
+anod build is run on a generated tree of small specs exercising the same
+code paths as the OpenUxAS specs: checkouts of local git repositories (the
+libraries are pinned to a tag, the application follows a branch), the
+download and unpacking of an archive served by a local HTTP server, and
+cmake builds. The common, github, compiler and cmake specs are the ones of
+this repository.
+
+The scenarios are run in order on the same tree:
+
+- cold: empty sandbox and caches
+- no-op: nothing changed since the previous build
+- warm: empty sandbox, caches populated by the previous builds
+- source-touch: one source file of the application changed
+- spec-touch: the spec of the library all the others depend on changed
+
+For each scenario, the wall clock and CPU times of the build are reported
+with the read and write system calls and disk I/O of the build and of its
+subprocesses (from /proc/self/io, on Linux), and the time spent in each
+kind of action (from the build metrics written by anod build). Results can
+be saved as a baseline, to which later runs are compared.
+"""
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import glob
+import json
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ["cold", "no-op", "warm", "source-touch", "spec-touch"]
+
+# Specs of the repository used by the fixture specs
+REPO_SPECS = ["common", "github", "compiler", "cmake"]
+
+# Phases of a build, by job class (see lib.anod.build)
+PHASES = {
+    "UxasCheckout": "checkout",
+    "UxasDownloadSource": "download",
+    "UxasCreateSource": "sources",
+    "UxasInstallSource": "sources",
+    "UxasBuildJob": "build",
+    "UxasRemoteBuildJob": "build",
+}
+
+# Counters of /proc/self/io reported for each scenario
+IO_COUNTERS = ["syscr", "syscw", "read_bytes", "write_bytes"]
+
+# Differences with the baseline below this time (in seconds) are noise
+TIME_NOISE = 0.2
+
+LIBRARY_SPEC = """\
+from e3.anod.loader import spec
+from e3.anod.spec import Anod
+
+
+class %(class_name)s(spec('github')):
+
+    github_project = '%(name)s'
+
+    @property
+    def build_deps(self):
+        return [Anod.Dependency('compiler'),
+                Anod.Dependency('cmake')] + [
+            Anod.Dependency(name) for name in %(deps)r]
+
+    @Anod.primitive()
+    def build(self):
+        self.cmake_build()
+"""
+
+DATA_SPEC = """\
+from e3.anod.loader import spec
+from e3.anod.spec import Anod
+from e3.fs import sync_tree
+import os
+
+
+class Data(spec('common')):
+
+    @property
+    def build_source_list(self):
+        return [Anod.Source(name='data-1.0.tar.gz', publish=True)]
+
+    @property
+    def source_pkg_build(self):
+        return [
+            self.HTTPSSourceBuilder(
+                name='data-1.0.tar.gz',
+                url='%(url)s/data-1.0.tar.gz')]
+
+    @Anod.primitive()
+    def build(self):
+        sync_tree(self['SRC_DIR'],
+                  os.path.join(self['INSTALL_DIR'], 'share', 'data'))
+"""
+
+LIBRARY_CMAKE = """\
+cmake_minimum_required(VERSION 3.5)
+project(%(name)s C)
+add_library(%(name)s STATIC %(sources)s)
+install(TARGETS %(name)s ARCHIVE DESTINATION lib)
+install(FILES %(name)s.h DESTINATION include)
+"""
+
+APP_CMAKE = """\
+cmake_minimum_required(VERSION 3.5)
+project(app C)
+add_executable(app %(sources)s)
+install(TARGETS app RUNTIME DESTINATION bin)
+"""
+
+C_SOURCE = """\
+int %(function)s(int n)
+{
+    int result = 0;
+    for (int i = 0; i < n; i++)
+        result += i * %(index)d %% 7;
+    return result;
+}
+"""
+
+
+def git(repo_dir: str, *args: str) -> None:
+    """Run git in a repository.
+
+    :param repo_dir: the repository
+    :param args: the git arguments
+    """
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+        + list(args),
+        cwd=repo_dir,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def write_file(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(content)
+
+
+def io_counters() -> Dict[str, int]:
+    """Return the I/O counters of the process and of its waited children."""
+    result = {}
+    try:
+        with open("/proc/self/io") as fd:
+            for line in fd:
+                name, _, value = line.partition(":")
+                result[name] = int(value)
+    except OSError:
+        pass
+    return result
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class Fixture(object):
+    """A tree with anod, the fixture specs and their sources."""
+
+    def __init__(self, work_dir: str, libraries: int, files: int):
+        """Initialize a fixture.
+
+        :param work_dir: directory in which the fixture is created
+        :param libraries: number of library specs
+        :param files: number of C files of each library
+        """
+        self.work_dir = work_dir
+        self.tree_dir = os.path.join(work_dir, "tree")
+        self.repos_dir = os.path.join(work_dir, "repos")
+        self.www_dir = os.path.join(work_dir, "www")
+        self.log_dir = os.path.join(work_dir, "logs")
+        self.libraries = ["lib%d" % i for i in range(libraries)]
+        self.files = files
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.touches = 0
+
+    @property
+    def sandbox_dir(self) -> str:
+        return os.path.join(self.tree_dir, "sbx")
+
+    def create(self) -> None:
+        """Create the tree and start the HTTP server."""
+        spec_dir = os.path.join(self.tree_dir, "specs")
+        os.makedirs(spec_dir)
+        os.makedirs(self.log_dir)
+        shutil.copy2(os.path.join(ROOT_DIR, "anod"), self.tree_dir)
+        shutil.copytree(
+            os.path.join(ROOT_DIR, "lib"),
+            os.path.join(self.tree_dir, "lib"),
+            ignore=shutil.ignore_patterns("__pycache__"),
+        )
+        for name in REPO_SPECS:
+            shutil.copy2(
+                os.path.join(ROOT_DIR, "specs", name + ".anod"),
+                os.path.join(spec_dir, name + ".anod"),
+            )
+
+        self.create_archive()
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(QuietHandler, directory=self.www_dir)
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        write_file(
+            os.path.join(spec_dir, "data.anod"),
+            DATA_SPEC % {"url": "http://127.0.0.1:%d" % self.server.server_port},
+        )
+
+        repositories = []
+        for index, name in enumerate(self.libraries):
+            sources = ["%s_%d.c" % (name, i) for i in range(self.files)]
+            header = "".join("int %s(int n);\n" % source[:-2] for source in sources)
+            files = {
+                "CMakeLists.txt": LIBRARY_CMAKE
+                % {"name": name, "sources": " ".join(sources)},
+                name + ".h": header,
+            }
+            for i, source in enumerate(sources):
+                files[source] = C_SOURCE % {"function": source[:-2], "index": i}
+            self.create_repo(name, files, tag="v1.0")
+            repositories.append((name, "v1.0"))
+            # All the libraries depend on the first one
+            write_file(
+                os.path.join(spec_dir, name + ".anod"),
+                LIBRARY_SPEC
+                % {
+                    "class_name": name.capitalize(),
+                    "name": name,
+                    "deps": self.libraries[:1] if index else [],
+                },
+            )
+
+        self.create_repo(
+            "app",
+            {
+                "CMakeLists.txt": APP_CMAKE % {"sources": "main.c app.c"},
+                "main.c": "int app(int n);\nint main(void) { return app(3); }\n",
+                "app.c": C_SOURCE % {"function": "app", "index": 0},
+            },
+        )
+        repositories.append(("app", "main"))
+        write_file(
+            os.path.join(spec_dir, "app.anod"),
+            LIBRARY_SPEC
+            % {"class_name": "App", "name": "app", "deps": ["data"] + self.libraries},
+        )
+
+        write_file(
+            os.path.join(spec_dir, "config", "repositories.yaml"),
+            "".join(
+                '%s:\n    vcs: git\n    url: %s\n    revision: "%s"\n'
+                % (name, os.path.join(self.repos_dir, name), revision)
+                for name, revision in repositories
+            ),
+        )
+
+    def create_archive(self) -> None:
+        """Create the archive downloaded by the data spec."""
+        content_dir = os.path.join(self.work_dir, "data-1.0")
+        for i in range(200):
+            write_file(
+                os.path.join(content_dir, "data%03d.txt" % i),
+                "line %d of the benchmark data\n" % i * 100,
+            )
+        os.makedirs(self.www_dir, exist_ok=True)
+        with tarfile.open(os.path.join(self.www_dir, "data-1.0.tar.gz"), "w:gz") as tar:
+            tar.add(content_dir, arcname="data-1.0")
+        shutil.rmtree(content_dir)
+
+    def create_repo(
+        self, name: str, files: Dict[str, str], tag: Optional[str] = None
+    ) -> None:
+        """Create a git repository with a single commit on branch main.
+
+        :param name: the repository name
+        :param files: the content of the files, by name
+        :param tag: tag to create, if any
+        """
+        repo_dir = os.path.join(self.repos_dir, name)
+        for filename, content in files.items():
+            write_file(os.path.join(repo_dir, filename), content)
+        git(repo_dir, "init", "-q")
+        git(repo_dir, "symbolic-ref", "HEAD", "refs/heads/main")
+        git(repo_dir, "add", ".")
+        git(repo_dir, "commit", "-q", "-m", "initial version")
+        if tag is not None:
+            git(repo_dir, "tag", tag)
+
+    def touch_source(self) -> None:
+        """Change a source file of the application."""
+        self.touches += 1
+        repo_dir = os.path.join(self.repos_dir, "app")
+        with open(os.path.join(repo_dir, "app.c"), "a") as fd:
+            fd.write("/* change %d */\n" % self.touches)
+        git(repo_dir, "commit", "-q", "-a", "-m", "change %d" % self.touches)
+
+    def touch_spec(self) -> None:
+        """Change the spec of the first library."""
+        self.touches += 1
+        with open(
+            os.path.join(self.tree_dir, "specs", self.libraries[0] + ".anod"), "a"
+        ) as fd:
+            fd.write("# change %d\n" % self.touches)
+
+    def build(self, scenario: str, build_args: List[str]) -> Dict[str, Any]:
+        """Run anod build app and return its measures.
+
+        :param scenario: the scenario name, used to name the log
+        :param build_args: additional arguments of anod build
+        :raise RuntimeError: if the build fails
+        """
+        env = dict(os.environ)
+        # Do not forward the build to a running anod server
+        env["OPENUXAS_ANOD_SERVER"] = ""
+        log_file = os.path.join(self.log_dir, scenario + ".log")
+
+        usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_start = io_counters()
+        start = time.perf_counter()
+        with open(log_file, "w") as log:
+            p = subprocess.run(
+                [sys.executable, os.path.join(self.tree_dir, "anod"), "build", "app"]
+                + build_args,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=env,
+                cwd=self.tree_dir,
+            )
+        wall = time.perf_counter() - start
+        io_end = io_counters()
+        usage_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if p.returncode != 0:
+            raise RuntimeError("%s build failed, see %s" % (scenario, log_file))
+
+        result: Dict[str, Any] = {
+            "wall": round(wall, 3),
+            "cpu": round(
+                usage_end.ru_utime
+                - usage_start.ru_utime
+                + usage_end.ru_stime
+                - usage_start.ru_stime,
+                3,
+            ),
+            "io": {
+                name: io_end[name] - io_start[name]
+                for name in IO_COUNTERS
+                if name in io_start
+            },
+        }
+        result.update(self.build_phases(wall))
+        return result
+
+    def build_phases(self, wall: float) -> Dict[str, Any]:
+        """Return the time spent in each phase of the last build.
+
+        :param wall: the wall clock time of the build
+        :return: the number of actions executed and the time spent in each
+            phase (the sum of the durations of its actions). The setup phase
+            is the time not spent walking the DAG: startup, spec loading and
+            scheduling.
+        """
+        metrics_files = glob.glob(
+            os.path.join(self.sandbox_dir, "log", "build-metrics-*.json")
+        )
+        if not metrics_files:
+            return {"executed": None, "phases": {}}
+        with open(max(metrics_files, key=os.path.getmtime)) as fd:
+            metrics = json.load(fd)
+        phases = {"setup": wall - (metrics["end"] - metrics["start"])}
+        for action in metrics["actions"]:
+            phase = PHASES.get(action["kind"])
+            if phase is not None and action["duration"] is not None:
+                phases[phase] = phases.get(phase, 0.0) + action["duration"]
+        return {
+            "executed": len(metrics["actions"]),
+            "phases": {name: round(value, 3) for name, value in phases.items()},
+        }
+
+    def run(self, build_args: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Run all the scenarios.
+
+        :param build_args: additional arguments of anod build
+        :return: the measures of each scenario
+        """
+        result = {}
+        for scenario in SCENARIOS:
+            if scenario == "warm":
+                shutil.rmtree(self.sandbox_dir)
+            elif scenario == "source-touch":
+                self.touch_source()
+            elif scenario == "spec-touch":
+                self.touch_spec()
+            result[scenario] = self.build(scenario, build_args)
+        return result
+
+    def cleanup(self) -> None:
+        """Stop the HTTP server."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def print_results(
+    results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Any]]
+) -> None:
+    """Print the measures of the scenarios.
+
+    :param results: the measures of each scenario
+    :param baseline: the measures of a previous run, if any
+    """
+    print(
+        "%-13s %8s %8s %7s %9s %9s  %s"
+        % ("scenario", "wall(s)", "cpu(s)", "actions", "syscalls", "written", "phases")
+    )
+    for scenario, result in results.items():
+        io = result["io"]
+        syscalls = io.get("syscr", 0) + io.get("syscw", 0) if io else None
+        print(
+            "%-13s %8.2f %8.2f %7s %9s %9s  %s"
+            % (
+                scenario,
+                result["wall"],
+                result["cpu"],
+                result["executed"],
+                syscalls if syscalls is not None else "-",
+                "%.1fM" % (io["write_bytes"] / 1e6) if "write_bytes" in io else "-",
+                " ".join(
+                    "%s=%.2f" % (name, value)
+                    for name, value in sorted(result["phases"].items())
+                ),
+            )
+        )
+        if baseline is not None and scenario in baseline:
+            base = baseline[scenario]
+            print(
+                "%-13s %+7.0f%% %+7.0f%% %7s %+8.0f%%"
+                % (
+                    "  vs baseline",
+                    100.0 * (result["wall"] / base["wall"] - 1) if base["wall"] else 0,
+                    100.0 * (result["cpu"] / base["cpu"] - 1) if base["cpu"] else 0,
+                    "",
+                    100.0 * (syscalls / (base["io"]["syscr"] + base["io"]["syscw"]) - 1)
+                    if syscalls and base["io"].get("syscr")
+                    else 0,
+                )
+            )
+
+
+def regressions(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Return the scenarios slower than in the baseline.
+
+    :param results: the measures of each scenario
+    :param baseline: the measures of the baseline
+    :param tolerance: the allowed slowdown, in percent
+    """
+    result = []
+    for scenario, measures in results.items():
+        if scenario not in baseline:
+            continue
+        limit = baseline[scenario]["wall"] * (1 + tolerance / 100.0)
+        if measures["wall"] > max(limit, baseline[scenario]["wall"] + TIME_NOISE):
+            result.append(scenario)
+    return result
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--work-dir",
+        help="directory in which the fixture is created, it must not exist "
+        "(default: a temporary directory, removed at the end)",
+    )
+    parser.add_argument(
+        "--libraries",
+        type=int,
+        default=4,
+        help="number of library specs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=10,
+        help="number of C files of each library (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--build-args",
+        default="",
+        help="additional arguments of anod build, e.g. '-j 4 --incremental'",
+    )
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=20.0,
+        help="slowdown compared to the baseline above which a scenario is "
+        "reported as a regression, in percent (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save", metavar="FILE", help="save the results as a JSON baseline"
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as fd:
+            data = json.load(fd)
+        if data["fixture"] != {"libraries": args.libraries, "files": args.files}:
+            parser.error("the baseline was made with a different fixture")
+        baseline = data["scenarios"]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="anod-bench-")
+    os.makedirs(work_dir, exist_ok=args.work_dir is None)
+    fixture = Fixture(work_dir, libraries=args.libraries, files=args.files)
+    try:
+        fixture.create()
+        results = fixture.run(shlex.split(args.build_args))
+    except RuntimeError as e:
+        # The work directory is kept for investigation
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+    finally:
+        fixture.cleanup()
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results, baseline)
+    if args.save is not None:
+        with open(args.save, "w") as fd:
+            json.dump(
+                {
+                    "fixture": {"libraries": args.libraries, "files": args.files},
+                    "scenarios": results,
+                },
+                fd,
+                indent=2,
+            )
+
+    if baseline is not None:
+        slower = regressions(results, baseline, args.tolerance)
+        if slower:
+            print("regressions: %s" % ", ".join(slower))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""Measure the startup time of the anod front-end.
+
+Each command is run several times and the best wall clock time is compared
+to a time budget. The imports taking most of the time, as reported by
+python -X importtime, are listed for each command so that a regression can
+be traced to the module that introduced it.
+
+The anod server is not used, so that the time measured is the time needed
+to start from scratch.
+"""
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import List, Tuple
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANOD = os.path.join(ROOT_DIR, "anod")
+
+DEFAULT_COMMANDS = ["--help", "printenv --help", "build --help"]
+
+
+def command_env() -> dict:
+    """Return the environment in which commands are run."""
+    env = dict(os.environ)
+    # Do not forward commands to a running anod server
+    env["OPENUXAS_ANOD_SERVER"] = ""
+    return env
+
+
+def wall_time(args: List[str], repeat: int) -> float:
+    """Return the best wall clock time of a Python command, in ms.
+
+    :param args: the Python interpreter arguments
+    :param repeat: number of runs
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=command_env(),
+            cwd=ROOT_DIR,
+        )
+        elapsed = (time.perf_counter() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    assert best is not None
+    return best
+
+
+def slowest_imports(args: List[str], count: int) -> List[Tuple[float, str]]:
+    """Return the top-level imports taking most time.
+
+    :param args: the anod arguments
+    :param count: number of imports to return
+    :return: a list of (cumulative time in ms, module name)
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", ANOD] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=command_env(),
+        cwd=ROOT_DIR,
+        universal_newlines=True,
+    )
+    result = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        # Only keep the modules imported directly by anod (no indentation)
+        if name.startswith("  "):
+            continue
+        result.append((int(fields[1]) / 1000, name.strip()))
+    return sorted(result, reverse=True)[:count]
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--command",
+        action="append",
+        dest="commands",
+        help="anod command line to measure, e.g. 'printenv uxas' (can be "
+        "repeated, default: %s)" % ", ".join(repr(c) for c in DEFAULT_COMMANDS),
+    )
+    # The default budget is the time measured for the slowest command
+    # (about 185 ms, most of it spent importing e3.main) plus a margin for
+    # noisy machines: lower it as the imports are trimmed
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=250.0,
+        help="maximum time allowed for a command, in ms (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs of each command (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--imports",
+        type=int,
+        default=5,
+        help="number of slowest imports to report (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    # Time needed by anything using e3.main, for reference
+    floor = wall_time(["-c", "import e3.main"], args.repeat)
+    print("%-35s %7.1f ms" % ("python -c 'import e3.main'", floor))
+
+    failures = 0
+    for command in args.commands or DEFAULT_COMMANDS:
+        anod_args = shlex.split(command)
+        elapsed = wall_time([ANOD] + anod_args, args.repeat)
+        status = "ok" if elapsed <= args.budget else "OVER BUDGET"
+        if elapsed > args.budget:
+            failures += 1
+        print("anod %-30s %7.1f ms  %s" % (command, elapsed, status))
+        for import_time, name in slowest_imports(anod_args, args.imports):
+            print("    %7.1f ms  %s" % (import_time, name))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    exit(main())
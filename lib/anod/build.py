@@ -8,21 +8,37 @@ from e3.anod.action import (
     Checkout,
     CreateSource,
 )
-from e3 import hash
-from e3.anod.checkout import CheckoutManager
-from e3.env import Env
 from e3.job.walk import Walk
+from e3.job.scheduler import DEFAULT_JOB_MAX_DURATION
 from e3.job import Job, EmptyJob
-from e3.net.http import HTTPSession
 from e3.anod.status import ReturnValue
 from e3.archive import unpack_archive
 from e3.fingerprint import Fingerprint
-from e3.fs import mkdir, sync_tree, rm, cp
-from e3.os.fs import cd
+from e3.fs import VCS_IGNORE_LIST, mkdir, rm, cp
+
+from lib.anod.cache import ArtifactCache, portable_uid
+from lib.anod.digest import DigestIndex
+from lib.anod.fingerprints import FingerprintStore
+from lib.anod.checkout import UxasCheckoutManager
+from lib.anod.gitcache import RevisionIndex, checkout_head
+from lib.anod.manifest import sync_with_manifest
+from lib.anod.jobserver import JobServer
+from lib.anod.metrics import BuildMetrics, DurationHistory, tree_size
+from lib.anod.remote import (
+    CHECKED_ENV,
+    FORWARDED_ENV,
+    PROTOCOL_VERSION,
+    RemoteError,
+)
+from lib.anod.runner import build_request, start_build, wait_build
 
 import json
 import logging
 import os
+import tempfile
+import threading
+import time
+import uuid
 
 from typing import TYPE_CHECKING
 
@@ -30,10 +46,71 @@ if TYPE_CHECKING:
     from e3.anod.spec import Anod
     from e3.collection.dag import DAG
     from e3.anod.sandbox import SandBox
+    from lib.anod.ccache import CompilerCache
+    from lib.anod.download import DownloadEngine
+    from lib.anod.gitcache import GitObjectCache
+    from lib.anod.sources import SourceTreeCache
+    from lib.anod.remote import WorkerPool
+    from lib.anod.store import BinaryStore
+    from typing import Any, Dict, List, Optional, Tuple
+
+
+class AnodFilesDigests(object):
+    """Digests of the spec and yaml files of Anod classes.
+
+    The files of a class (its spec file, the spec files of its ancestors and
+    its yaml files) are the same for all the actions of the spec, so the list
+    of elements is computed once per run and per class. Files shared by
+    several classes (e.g. common.anod) are looked up once per run.
+    """
+
+    def __init__(self, digest_index: DigestIndex):
+        """Initialize the cache.
+
+        :param digest_index: The index providing the digests of the files.
+        """
+        self.digest_index = digest_index
+        self.cache: Dict[Tuple[type, str], List[Tuple[str, str]]] = {}
+        self.file_digests: Dict[str, str] = {}
+
+    def file_digest(self, filename: str) -> str:
+        """Return the sha256 of a file, computed at most once per run.
+
+        :param filename: path to a file
+        """
+        if filename not in self.file_digests:
+            self.file_digests[filename] = self.digest_index.sha256(filename)
+        return self.file_digests[filename]
+
+    def get(self, anod_instance: Anod) -> List[Tuple[str, str]]:
+        """Return the fingerprint elements for the files of an Anod instance.
+
+        :param anod_instance: an Anod instance.
+        :return: a list of (basename, sha256) pairs, i.e. the elements that
+            Fingerprint.add_file would add for each file.
+        """
+        key = (anod_instance.__class__, anod_instance.spec_dir)
+        if key not in self.cache:
+            anod_specs = [
+                c.name
+                for c in anod_instance.__class__.__mro__
+                if c.__name__ != "Anod" and "Anod" in (sc.__name__ for sc in c.__mro__)
+            ]
+            filenames = [
+                os.path.join(anod_instance.spec_dir, spec_name + ".anod")
+                for spec_name in anod_specs
+            ] + [
+                os.path.join(anod_instance.spec_dir, yaml_name + ".yaml")
+                for yaml_name in anod_instance.data_files
+            ]
+            self.cache[key] = [
+                (os.path.basename(f), self.file_digest(f)) for f in filenames
+            ]
+        return self.cache[key]
 
 
 def add_anod_files_to_fingerprint(
-    anod_instance: Anod, fingerprint: Fingerprint
+    anod_instance: Anod, fingerprint: Fingerprint, anod_files: AnodFilesDigests
 ) -> None:
     """Add the Anod's spec and yaml files to the given fingerprint.
 
@@ -41,16 +118,11 @@ def add_anod_files_to_fingerprint(
     :type anod_instance: Anod
     :param fingerprint: The fingerprint to update.
     :type fingerprint: e3.fingerprint.Fingerprint.
+    :param anod_files: The digests of the Anod files.
+    :type anod_files: AnodFilesDigests
     """
-    anod_specs = [
-        c.name
-        for c in anod_instance.__class__.__mro__
-        if c.__name__ != "Anod" and "Anod" in (sc.__name__ for sc in c.__mro__)
-    ]
-    for spec_name in anod_specs:
-        fingerprint.add_file(os.path.join(anod_instance.spec_dir, spec_name + ".anod"))
-    for yaml_name in anod_instance.data_files:
-        fingerprint.add_file(os.path.join(anod_instance.spec_dir, yaml_name + ".yaml"))
+    for name, digest in anod_files.get(anod_instance):
+        fingerprint.add(name, digest)
 
     deps = getattr(anod_instance, "%s_deps" % anod_instance.kind, ())
     for dep in deps:
@@ -58,45 +130,362 @@ def add_anod_files_to_fingerprint(
             fingerprint.add(dep.name, dep.value)
 
 
+class ActionFingerprints(object):
+    """Fingerprints and artifact cache keys of the actions of a build.
+
+    They are computed in the same way whether the actions are executed
+    (UxasBuilder) or only planned (lib.anod.plan.UxasPlanner).
+    """
+
+    def __init__(
+        self,
+        actions: DAG,
+        sandbox: SandBox,
+        anod_files: AnodFilesDigests,
+        revisions: RevisionIndex,
+        artifact_cache: Optional[ArtifactCache] = None,
+        binary_store: Optional[BinaryStore] = None,
+    ):
+        """Initialize the fingerprints of a build.
+
+        :param actions: the DAG of actions of the build
+        :param sandbox: the build sandbox
+        :param anod_files: the digests of the spec and yaml files
+        :param revisions: the commits of the pinned revisions, used to
+            predict the result of checkouts
+        :param artifact_cache: the artifact cache of the build, if any
+        :param binary_store: the binary store of the build, if any
+        """
+        self.actions = actions
+        self.sandbox = sandbox
+        self.anod_files = anod_files
+        self.revisions = revisions
+        self.artifact_cache = artifact_cache
+        self.binary_store = binary_store
+
+    def compute(
+        self,
+        uid: str,
+        data: Any,
+        new_fingerprints: Dict[str, Optional[Fingerprint]],
+        is_prediction: bool = False,
+    ) -> Optional[Fingerprint]:
+        """Compute the fingerprint of an action.
+
+        :param uid: A unique Job ID.
+        :param data: the action
+        :param new_fingerprints: the fingerprints of the predecessors of the
+            action, by uid
+        :param is_prediction: see Walk.compute_fingerprint
+        :return: the fingerprint or None if it is not known (yet)
+        """
+        # All fingerprints start with the same minimum amount
+        # of data: The fingerprint of all the predecessors. They are
+        # recorded under portable uids, so that fingerprints computed on
+        # different machines can be compared.
+        f = Fingerprint()
+        for pred_uid in self.actions.get_predecessors(uid):
+            pred_fingerprint = new_fingerprints[str(pred_uid)]
+            if pred_fingerprint is None:
+                logging.debug(
+                    "Returning no fingerprint for %s"
+                    " (predecessor %s has no fingerprint)",
+                    uid,
+                    pred_uid,
+                )
+                return None
+            else:
+                f.add(portable_uid(str(pred_uid)), pred_fingerprint.checksum())
+        if isinstance(data, Checkout):
+            from e3.anod.checkout import CheckoutManager
+
+            m = CheckoutManager(name=data.repo_name, working_dir=self.sandbox.vcs_dir)
+            if is_prediction:
+                # The fingerprint of a checkout can only be predicted when
+                # its revision is pinned and already checked out. Otherwise
+                # the checkout is always executed.
+                commit = self.predict_checkout(data, m)
+                if commit is None:
+                    return None
+                f.add(data.repo_name + ".url", data.repo_data["url"])
+                f.add(data.repo_name + ".commit", commit)
+                return f
+
+            with open(m.metadata_file) as fd:
+                content = json.load(fd)
+            f.add(data.repo_name + ".url", content["url"])
+            f.add(data.repo_name + ".commit", content["new_commit"])
+        elif isinstance(data, (CreateSource, Build)):
+            add_anod_files_to_fingerprint(data.anod_instance, f, self.anod_files)
+        elif isinstance(data, InstallSource):
+            add_anod_files_to_fingerprint(data.spec, f, self.anod_files)
+        return f
+
+    def predict_checkout(self, data: Checkout, manager: Any) -> Optional[str]:
+        """Return the commit a checkout would produce, if known in advance.
+
+        This is the case when the checkout revision is pinned (a tag or a
+        commit hash), was already resolved in this sandbox, and the working
+        tree is still at the resolved commit. Neither git nor the network is
+        used. Local modifications of the working tree are not detected: use
+        --force to reset checkouts.
+
+        :param data: a Checkout action
+        :param manager: the checkout manager of the action (an
+            e3.anod.checkout.CheckoutManager)
+        :return: the commit or None if it cannot be predicted
+        """
+        repo_data = data.repo_data
+        if repo_data["vcs"] != "git":
+            return None
+        commit = self.revisions.get(repo_data["url"], repo_data.get("revision"))
+        if commit is None:
+            return None
+        try:
+            with open(manager.metadata_file) as fd:
+                content = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if (
+            content.get("url") != repo_data["url"]
+            or content.get("revision") != repo_data.get("revision")
+            or content.get("new_commit") != commit
+            or checkout_head(manager.working_dir) != commit
+        ):
+            return None
+        return commit
+
+    def artifact_cache_key(
+        self, uid: str, fingerprint: Optional[Fingerprint]
+    ) -> Optional[str]:
+        """Return the artifact cache key of a Build action.
+
+        :param uid: A unique Job ID.
+        :param fingerprint: the fingerprint of the action
+        :return: the key or None if the result of the action should not be
+            cached (no cache, unknown fingerprint or spec opting out)
+        """
+        if self.artifact_cache is None and self.binary_store is None:
+            return None
+        if fingerprint is None:
+            return None
+        if not getattr(self.actions[uid].anod_instance, "enable_artifact_cache", True):
+            return None
+        return ArtifactCache.key(uid, fingerprint)
+
+
 class UxasEmptyJob(EmptyJob):
-    def __init__(self, uid, data, notify_end, sandbox):
+    def __init__(self, uid, data, notify_end, sandbox, builder):
         super(UxasEmptyJob, self).__init__(uid, data, notify_end)
 
 
 class UxasJob(Job):
-    def __init__(self, uid, data, notify_end, sandbox):
+    def __init__(self, uid, data, notify_end, sandbox, builder):
         super(UxasJob, self).__init__(uid, data, notify_end)
         self.run_status = ReturnValue.unknown
         self.sandbox = sandbox
+        self.builder = builder
 
     @property
     def status(self):
         return self.run_status
 
+    @property
+    def metrics(self):
+        """Return the metrics of the job.
+
+        :rtype: lib.anod.metrics.ActionMetrics
+        """
+        return self.builder.metrics.get(self.uid, self.__class__.__name__)
+
+    @property
+    def priority(self):
+        """See Job.priority.
+
+        Jobs on the longest expected path to the end of the build come
+        first (see UxasBuilder.compute_priorities).
+        """
+        return self.builder.priorities.get(self.uid, 0)
+
+    def on_start(self, scheduler):
+        """See Job.on_start."""
+        super(UxasJob, self).on_start(scheduler)
+        # The removal of the fingerprint of the job must be recorded before
+        # it changes anything (see FingerprintStore)
+        self.builder.fingerprint_store.flush()
+        self.builder.metrics.record_start(self.uid, self.__class__.__name__)
+
+    def on_finish(self, scheduler):
+        """See Job.on_finish."""
+        super(UxasJob, self).on_finish(scheduler)
+        self.builder.metrics.record_end(self.uid, self.status.name, self.slot)
+
     def run(self):
+        # CPU time spent in the job thread. Jobs running external processes
+        # account for the CPU time of their processes themselves.
+        cpu_start = time.thread_time()
+        try:
+            self.execute()
+        finally:
+            self.metrics.cpu_user += time.thread_time() - cpu_start
+
+    def execute(self):
+        """Perform the job."""
         print(self.data)
 
 
 class UxasBuildJob(UxasJob):
-    def run(self):
+    def execute(self):
+        anod_instance = self.data.anod_instance
+        build_space = anod_instance.build_space
+        cache_key = self.builder.artifact_cache_key(self.uid)
+        incremental = self.builder.is_incremental(self.uid)
         try:
-            rm(self.data.anod_instance.build_space.build_dir, recursive=True)
-            mkdir(self.data.anod_instance.build_space.build_dir)
-            rm(self.data.anod_instance.build_space.install_dir, recursive=True)
-            mkdir(self.data.anod_instance.build_space.install_dir)
-            Env().store()
-            cd(self.data.anod_instance.build_space.build_dir)
-            self.data.anod_instance.jobs = Env().build.cpu.cores
-            self.data.anod_instance.build()
-            Env().restore()
-            self.run_status = ReturnValue.success
+            if not incremental:
+                rm(build_space.build_dir, recursive=True)
+            mkdir(build_space.build_dir)
+            if cache_key is not None and self.builder.restore_artifact(
+                self.uid, cache_key, build_space.install_dir
+            ):
+                self.metrics.restored = True
+                self.run_status = ReturnValue.success
+                return
+            if self.builder.fetch_only:
+                logging.error("%s is not available in the binary store", self.uid)
+                self.run_status = ReturnValue.missing
+                return
+
+            if not incremental or self.builder.requires_clean_install(self.uid):
+                rm(build_space.install_dir, recursive=True)
+            mkdir(build_space.install_dir)
+        except Exception:
+            logging.exception("got exception while building")
+            self.run_status = ReturnValue.failure
+            return
+
+        # Builds change the current directory and the environment, so run
+        # them in a separate interpreter: this keeps concurrent jobs
+        # isolated (see lib.anod.runner).
+        fingerprint = self.builder.new_fingerprints.get(self.uid)
+        request = build_request(
+            self.uid,
+            anod_instance,
+            self.sandbox,
+            self.builder.jobs,
+            artifact_cache=(
+                self.builder.artifact_cache.root_dir
+                if self.builder.artifact_cache is not None
+                else None
+            ),
+            key=cache_key,
+            fingerprint=fingerprint.elements if fingerprint is not None else None,
+        )
+        token = self.builder.jobserver.acquire()
+        try:
+            success, rusage = wait_build(start_build(request))
+        finally:
+            self.builder.jobserver.release(token)
+        self.metrics.cpu_user += rusage.ru_utime
+        self.metrics.cpu_system += rusage.ru_stime
+        self.metrics.max_rss = max(self.metrics.max_rss, rusage.ru_maxrss)
+        self.run_status = ReturnValue.success if success else ReturnValue.failure
+
+
+class UxasRemoteBuildJob(UxasJob):
+    """Build job performed by a worker (see lib.anod.remote)."""
+
+    def __init__(self, uid, data, notify_end, sandbox, builder):
+        super(UxasRemoteBuildJob, self).__init__(
+            uid, data, notify_end, sandbox, builder
+        )
+        self.queue_name = "remote"
+
+    def execute(self):
+        install_dir = self.data.anod_instance.build_space.install_dir
+        cache_key = self.builder.artifact_cache_key(self.uid)
+        try:
+            if cache_key is not None and self.builder.restore_artifact(
+                self.uid, cache_key, install_dir
+            ):
+                self.metrics.restored = True
+                self.run_status = ReturnValue.success
+                return
+
+            # Build spaces without sources are only created by builds
+            self.data.anod_instance.build_space.create(quiet=True)
+            request, entries = self.request()
+            result_cache = self.builder.transfer_cache
+            if cache_key is not None and self.builder.artifact_cache is not None:
+                result_cache = self.builder.artifact_cache
+            worker = self.builder.workers.acquire()
+            try:
+                logging.info("%s sent to worker %s", self.uid, worker)
+                success = worker.build(
+                    request,
+                    entries,
+                    self.data.anod_instance.build_space.src_dir,
+                    result_cache,
+                    tmp_dir=self.sandbox.tmp_dir,
+                )
+            finally:
+                self.builder.workers.release(worker)
+
+            if success and result_cache.restore(request["key"], install_dir):
+                self.run_status = ReturnValue.success
+            else:
+                self.run_status = ReturnValue.failure
+        except (OSError, RemoteError) as e:
+            logging.error("%s: remote build failed: %s", self.uid, e)
+            self.run_status = ReturnValue.failure
         except Exception:
             logging.exception("got exception while building")
             self.run_status = ReturnValue.failure
 
+    def request(self):
+        """Return the request sent to the worker.
+
+        The install trees of all the Build actions the action depends on,
+        directly or not, are sent along with the request, as dependencies
+        may need the ones of their own dependencies (e.g. to link).
+
+        :return: the request and the artifact caches containing the
+            install trees sent with it, by key
+        :rtype: (dict, dict[str, lib.anod.cache.ArtifactCache])
+        """
+        anod_instance = self.data.anod_instance
+        deps = []
+        entries = {}
+        for dep_uid in self.builder.build_dependencies(self.uid):
+            dep = self.builder.actions[dep_uid].anod_instance
+            key = self.builder.transfer_key(dep_uid)
+            cache = self.builder.artifact_cache
+            if cache is None or key not in cache:
+                cache = self.builder.transfer_cache
+                if key not in cache and not cache.store(
+                    key, dep_uid, dep.build_space.install_dir
+                ):
+                    raise OSError("cannot pack %s" % dep_uid)
+            deps.append([dep.build_space_name, key])
+            entries[key] = cache
+
+        fingerprint = self.builder.new_fingerprints.get(self.uid)
+        request = {
+            "version": PROTOCOL_VERSION,
+            "uid": self.uid,
+            "spec_name": anod_instance.name,
+            "qualifier": anod_instance.qualifier,
+            "build_space_name": anod_instance.build_space_name,
+            "anod_files": [list(f) for f in self.builder.anod_files.get(anod_instance)],
+            "env": {var: os.environ.get(var) for var in CHECKED_ENV + FORWARDED_ENV},
+            "deps": deps,
+            "key": self.builder.transfer_key(self.uid),
+            "fingerprint": fingerprint.elements if fingerprint is not None else None,
+        }
+        return request, entries
+
 
 class UxasInstallSource(UxasJob):
-    def run(self):
+    def execute(self):
         spec = self.data.spec
         source = self.data.source
         spec.build_space.create(quiet=True)
@@ -104,9 +493,29 @@ class UxasInstallSource(UxasJob):
 
         source.set_other_sources(getattr(spec, "%s_source_list" % spec.kind, []))
         if os.path.isdir(filename):
-            sync_tree(
-                filename, spec.build_space.src_dir, ignore=source.ignore, delete=True
+            # Only the files changed since the previous installation are
+            # copied, with their modification times, so that incremental
+            # builds only rebuild what depends on them.
+            sync_with_manifest(
+                filename,
+                spec.build_space.src_dir,
+                os.path.join(
+                    spec.build_space.root_dir, "%s_manifest.json" % source.name
+                ),
+                ignore=source.ignore,
+                clean=True,
             )
+        elif self.builder.source_cache is not None and source.unpack_cmd is None:
+            dest = os.path.join(spec.build_space.src_dir, source.dest)
+            cache = self.builder.source_cache
+            key = cache.key(
+                self.builder.digest_index.sha256(filename), source.remove_root_dir
+            )
+            if key not in cache:
+                cache.populate(key, filename, source.remove_root_dir)
+                self.metrics.bytes_unpacked += tree_size(cache.tree_path(key))
+            method = cache.stage(key, dest, ignore=source.ignore)
+            logging.debug("%s staged from source cache (%s)", source.name, method)
         else:
             mkdir(os.path.join(spec.build_space.src_dir, source.dest))
             unpack_archive(
@@ -119,57 +528,45 @@ class UxasInstallSource(UxasJob):
                 ignore=source.ignore,
                 delete=True,
             )
+            self.metrics.bytes_unpacked += tree_size(
+                os.path.join(spec.build_space.src_dir, source.dest)
+            )
         self.run_status = ReturnValue.success
 
 
-class UxasDownloadSource(UxasJob):
-    def run(self):
-        builder = self.data.builder
-        cache_dir = self.sandbox.tmp_cache_dir
+class UxasNetworkJob(UxasJob):
+    """Job limited by the network budget of the build (see UxasBuilder)."""
 
-        skip = False
-        if os.path.isfile(os.path.join(cache_dir, builder.filename)) and os.path.isfile(
-            os.path.join(cache_dir, builder.filename + ".sha1")
-        ):
-            with open(os.path.join(cache_dir, builder.filename + ".sha1"), "rb") as f:
-                checksum = f.read(1024).decode()
-            skip = checksum == hash.sha1(os.path.join(cache_dir, builder.filename))
-
-        if skip:
-            self.run_status = ReturnValue.skip
-        else:
-            if builder.url.startswith("https://") or builder.url.startswith("http://"):
+    def __init__(self, uid, data, notify_end, sandbox, builder):
+        super(UxasNetworkJob, self).__init__(uid, data, notify_end, sandbox, builder)
+        self.queue_name = "network"
 
-                if os.path.isfile(os.path.join(cache_dir, builder.filename)):
-                    rm(os.path.join(cache_dir, builder.filename))
-                if os.path.isfile(os.path.join(cache_dir, builder.filename + ".sha1")):
-                    rm(os.path.join(cache_dir, builder.filename + ".sha1"))
 
-                s = HTTPSession(base_urls=[builder.base_url])
-                result = s.download_file(
-                    url=builder.filename, dest=cache_dir, filename=builder.name
-                )
-                if result is None:
-                    rm(os.path.join(cache_dir, builder.filename))
-                    self.run_status = ReturnValue.failure
-                else:
-                    self.run_status = ReturnValue.success
-                    with open(
-                        os.path.join(cache_dir, builder.filename + ".sha1"), "w"
-                    ) as f:
-                        f.write(hash.sha1(os.path.join(cache_dir, builder.filename)))
-            else:
-                cp(
-                    os.path.join(self.sandbox.specs_dir, "patches", builder.url),
-                    cache_dir,
+class UxasDownloadSource(UxasNetworkJob):
+    def execute(self):
+        builder = self.data.builder
+        if builder.url.startswith("https://") or builder.url.startswith("http://"):
+            self.run_status = self.builder.download_engine.fetch(
+                builder.url, builder.filename
+            )
+            if self.run_status == ReturnValue.success:
+                self.metrics.bytes_downloaded += os.path.getsize(
+                    os.path.join(self.sandbox.tmp_cache_dir, builder.filename)
                 )
-                self.run_status = ReturnValue.success
+        else:
+            cp(
+                os.path.join(self.sandbox.specs_dir, "patches", builder.url),
+                self.sandbox.tmp_cache_dir,
+            )
+            self.run_status = ReturnValue.success
 
 
-class UxasCheckout(UxasJob):
-    def run(self):
-        manager = CheckoutManager(
-            name=self.data.repo_name, working_dir=self.sandbox.vcs_dir
+class UxasCheckout(UxasNetworkJob):
+    def execute(self):
+        manager = UxasCheckoutManager(
+            name=self.data.repo_name,
+            working_dir=self.sandbox.vcs_dir,
+            git_cache=self.builder.git_cache,
         )
         repo_data = self.data.repo_data
         result = manager.update(
@@ -177,6 +574,13 @@ class UxasCheckout(UxasJob):
             url=repo_data["url"],
             revision=repo_data.get("revision"),
         )
+        if result in (ReturnValue.success, ReturnValue.unchanged):
+            with open(manager.metadata_file) as fd:
+                metadata = json.load(fd)
+            if metadata["new_commit"]:
+                self.builder.revisions.record(
+                    metadata["url"], metadata["revision"], metadata["new_commit"]
+                )
         self.run_status = result
 
 
@@ -190,7 +594,7 @@ class RepositoryState(object):
 
 
 class UxasCreateSource(UxasJob):
-    def run(self):
+    def execute(self):
         source_name = self.data.source_name
         anod_instance = self.data.anod_instance
         builder = next(
@@ -202,9 +606,38 @@ class UxasCreateSource(UxasJob):
             repository_states[repo_name] = {
                 "working_dir": os.path.join(self.sandbox.vcs_dir, repo_name)
             }
-        builder.prepare_src(repository_states, source_dest)
+        if self.uses_default_prepare_src(builder):
+            # Same as the default prepare_src function, but incremental
+            sync_with_manifest(
+                repository_states[builder.checkout[0]]["working_dir"],
+                source_dest,
+                source_dest + "_manifest.json",
+                ignore=VCS_IGNORE_LIST,
+                clean=True,
+            )
+        else:
+            builder.prepare_src(repository_states, source_dest)
         self.run_status = ReturnValue.success
 
+    @staticmethod
+    def uses_default_prepare_src(builder):
+        """Return True if a source builder has no prepare_src function.
+
+        In that case e3 synchronizes the content of its single checkout,
+        using the function returned by SourceBuilder.prepare_src.
+
+        :param builder: a source builder
+        :type builder: e3.anod.package.SourceBuilder
+        :rtype: bool
+        """
+        if len(builder.checkout) != 1:
+            return False
+        prepare_src = builder.prepare_src
+        return (
+            getattr(prepare_src, "__module__", None) == "e3.anod.package"
+            and getattr(prepare_src, "__name__", None) == "default_prepare_src"
+        )
+
 
 class UxasBuilder(Walk):
 
@@ -217,77 +650,223 @@ class UxasBuilder(Walk):
         CreateSource: UxasCreateSource,
     }
 
-    def __init__(self, actions: DAG, sandbox: SandBox, force: bool):
+    # Expected durations (in seconds) of actions never run in the sandbox
+    DEFAULT_DURATIONS = {
+        Build: 60.0,
+        Checkout: 10.0,
+        DownloadSource: 10.0,
+        CreateSource: 2.0,
+        InstallSource: 5.0,
+    }
+
+    def __init__(
+        self,
+        actions: DAG,
+        sandbox: SandBox,
+        force: bool,
+        artifact_cache: Optional[ArtifactCache] = None,
+        source_cache: Optional[SourceTreeCache] = None,
+        git_cache: Optional[GitObjectCache] = None,
+        compiler_cache: Optional[CompilerCache] = None,
+        binary_store: Optional[BinaryStore] = None,
+        fetch_only: bool = False,
+        workers: Optional[WorkerPool] = None,
+        incremental: bool = False,
+        jobs: int = 1,
+        network_jobs: int = 4,
+        paranoid: bool = False,
+    ):
         self.sandbox = sandbox
         self.force = force
-        mkdir(self.fingerprints_dir)
-        super(UxasBuilder, self).__init__(actions)
+        self.artifact_cache = artifact_cache
+        self.source_cache = source_cache
+        self.git_cache = git_cache
+        self.compiler_cache = compiler_cache
+        self.binary_store = binary_store
+        self.fetch_only = fetch_only
+        self.workers = workers
+        self.incremental = incremental
+        self.jobs = jobs
+        self.network_jobs = network_jobs
+        self.jobserver = JobServer(jobs, sandbox)
+        self.metrics = BuildMetrics()
+        self.durations = DurationHistory(
+            os.path.join(sandbox.meta_dir, "durations.json")
+        )
+        self.priorities = self.compute_priorities(actions)
+        self.digest_index = DigestIndex(
+            os.path.join(sandbox.meta_dir, "digests.json"), paranoid=paranoid
+        )
+        self.anod_files = AnodFilesDigests(self.digest_index)
+        self.revisions = RevisionIndex(os.path.join(sandbox.meta_dir, "revisions.json"))
+        self.fingerprints = ActionFingerprints(
+            actions,
+            sandbox,
+            self.anod_files,
+            self.revisions,
+            artifact_cache=artifact_cache,
+            binary_store=binary_store,
+        )
+        self.__download_engine: Optional[DownloadEngine] = None
+        self.download_engine_lock = threading.Lock()
+        self.fingerprint_store = FingerprintStore.for_sandbox(sandbox)
+        self.fingerprint_store.start_run()
+        self.prefetch_sources(actions)
+        if compiler_cache is not None:
+            compiler_cache.setenv()
+        try:
+            with self.jobserver:
+                super(UxasBuilder, self).__init__(actions)
+        finally:
+            self.shutdown_download_engine()
+            self.fingerprint_store.close()
+            if workers is not None:
+                rm(self.transfer_cache.root_dir, recursive=True)
+            self.digest_index.save()
+            self.revisions.save()
+            self.durations.update(self.metrics)
+            self.durations.save()
+            self.report_compiler_cache()
+            metrics_file = self.metrics.write(sandbox.log_dir)
+            if metrics_file is not None:
+                logging.info("build metrics written to %s", metrics_file)
 
-    def compute_fingerprint(self, uid, data, is_prediction=False):
-        """See Walk.compute_fingerprint."""
-        if is_prediction and self.force:
-            # Force a rebuild
-            return None
+    def report_compiler_cache(self) -> None:
+        """Log and record the compiler cache statistics of the build."""
+        if self.compiler_cache is None:
+            return
+        stats = self.compiler_cache.stats_delta()
+        if stats is None:
+            return
+        self.metrics.summary["compiler_cache"] = stats
+        if stats["hits"] or stats["misses"]:
+            logging.info(
+                "compiler cache: %d hits, %d misses (%.0f%% hit rate)",
+                stats["hits"],
+                stats["misses"],
+                100.0 * stats["hits"] / (stats["hits"] + stats["misses"]),
+            )
 
-        # All fingerprints start with the same minimum amount
-        # of data: The fingerprint of all the predecessors.
-        f = Fingerprint()
-        for pred_uid in self.actions.get_predecessors(uid):
-            if self.new_fingerprints[pred_uid] is None:
-                logging.debug(
-                    "Returning no fingerprint for %s"
-                    " (predecessor %s has no fingerprint)",
-                    uid,
-                    pred_uid,
+    @property
+    def download_engine(self) -> DownloadEngine:
+        """Return the engine downloading source archives.
+
+        The engine (and the HTTP modules it needs) is only loaded by builds
+        that download something.
+        """
+        with self.download_engine_lock:
+            if self.__download_engine is None:
+                from lib.anod.download import DownloadEngine
+
+                self.__download_engine = DownloadEngine(
+                    self.sandbox.tmp_cache_dir,
+                    digest_index=self.digest_index,
+                    source_cache=self.source_cache,
+                    max_workers=self.network_jobs,
                 )
-                return None
-            else:
-                f.add(pred_uid, self.new_fingerprints[pred_uid].checksum())
-        if isinstance(data, Checkout):
-            if is_prediction:
-                # We cannot predict the fingerprint of a checkout without
-                # performing it, thus checkout will always be executed.
-                return None
+            return self.__download_engine
 
-            m = CheckoutManager(name=data.repo_name, working_dir=self.sandbox.vcs_dir)
-            with open(m.metadata_file) as fd:
-                content = json.load(fd)
-            f.add(data.repo_name + ".url", content["url"])
-            f.add(data.repo_name + ".commit", content["new_commit"])
-        elif isinstance(data, (CreateSource, Build)):
-            add_anod_files_to_fingerprint(data.anod_instance, f)
-        elif isinstance(data, InstallSource):
-            add_anod_files_to_fingerprint(data.spec, f)
-        return f
+    def shutdown_download_engine(self) -> None:
+        """Wait for the pending downloads, if any."""
+        with self.download_engine_lock:
+            if self.__download_engine is not None:
+                self.__download_engine.shutdown()
+                self.__download_engine = None
 
-    def save_fingerprint(self, uid, fingerprint):
-        """See Walk.save_fingerprint."""
-        filename = self.fingerprint_filename(uid)
-        if fingerprint is None:
-            rm(filename)
-        else:
-            fingerprint.save_to_file(filename)
+    def expected_duration(self, uid: str, data: Any) -> float:
+        """Return the expected duration of an action.
 
-    @property
-    def fingerprints_dir(self):
-        """Return the directory where fingerprints are stored.
+        :param uid: the action uid
+        :param data: the action
+        :return: the duration of the action in previous builds or, for
+            actions never run in this sandbox, a default estimate for its
+            kind of action (in seconds)
+        """
+        duration = self.durations.get(uid)
+        if duration is None:
+            duration = self.DEFAULT_DURATIONS.get(data.__class__, 0.0)
+        return duration
 
-        :rtype: str
+    def compute_priorities(self, actions: DAG) -> Dict[str, int]:
+        """Compute the scheduling priority of each action.
+
+        The priority of an action is the expected duration of the longest
+        path from this action to the end of the build (in ms), so that when
+        several actions are ready the ones starting long chains of
+        dependent actions are run first.
+
+        :param actions: the DAG of actions to perform
+        :return: a dict associating each action uid to its priority
         """
-        return os.path.join(self.sandbox.root_dir, "fingerprints")
+        order = []
+        successors: Dict[str, List[str]] = {}
+        for vertex_id, data in actions:
+            uid = str(vertex_id)
+            order.append((uid, data))
+            successors.setdefault(uid, [])
+            for pred_uid in actions.get_predecessors(uid):
+                successors.setdefault(str(pred_uid), []).append(uid)
 
-    def fingerprint_filename(self, uid):
-        """Return the full path to the fingerprint of the given job.
+        remaining: Dict[str, float] = {}
+        for uid, data in reversed(order):
+            remaining[uid] = self.expected_duration(uid, data) + max(
+                (remaining[succ_uid] for succ_uid in successors[uid]), default=0.0
+            )
+        return {uid: int(value * 1000) for uid, value in remaining.items()}
 
-        :param uid: A unique Job ID.
-        :type uid: str
-        :rtype: str
+    def prefetch_sources(self, actions: DAG) -> None:
+        """Start downloading the missing source archives.
+
+        Downloads run in the background while the walk performs the other
+        actions: DownloadSource jobs then only wait for their archive.
+
+        :param actions: the DAG of actions to perform
         """
-        return os.path.join(self.fingerprints_dir, uid + ".json")
+        for _, data in actions:
+            if not isinstance(data, DownloadSource):
+                continue
+            # Source builders of the specs have url and filename attributes
+            # (see common.anod)
+            builder: Any = data.builder
+            if not (
+                builder.url.startswith("https://") or builder.url.startswith("http://")
+            ):
+                continue
+            if not os.path.isfile(
+                os.path.join(self.sandbox.tmp_cache_dir, builder.filename)
+            ):
+                self.download_engine.submit(builder.url, builder.filename)
+
+    def set_scheduling_params(self):
+        """See Walk.set_scheduling_params."""
+        # The jobserver is what limits the CPU usage of builds, so up to
+        # self.jobs actions can run at the same time. Checkouts and downloads
+        # have their own queue: they wait for the network, not for CPUs.
+        self.queues = {"default": self.jobs, "network": self.network_jobs}
+        if self.workers is not None:
+            # Workers run as many builds as they have cores
+            self.queues["remote"] = self.workers.slots
+        self.tokens = self.jobs
+        self.job_timeout = DEFAULT_JOB_MAX_DURATION
+
+    def compute_fingerprint(
+        self, uid: str, data: Any, is_prediction: bool = False
+    ) -> Optional[Fingerprint]:
+        """See Walk.compute_fingerprint."""
+        if is_prediction and self.force:
+            # Force a rebuild
+            return None
+        return self.fingerprints.compute(
+            uid, data, self.new_fingerprints, is_prediction=is_prediction
+        )
+
+    def save_fingerprint(self, uid, fingerprint):
+        """See Walk.save_fingerprint."""
+        self.fingerprint_store.set(uid, fingerprint)
 
-    def load_previous_fingerprint(self, uid):
+    def load_previous_fingerprint(self, uid: str) -> Optional[Fingerprint]:
         """See Walk.load_previous_fingerprint."""
-        return Fingerprint.load_from_file(self.fingerprint_filename(uid))
+        return self.fingerprint_store.get(uid)
 
     def should_execute_action(self, uid, previous_fingerprint, new_fingerprint):
         """See Walk.should_execute_action."""
@@ -313,7 +892,152 @@ class UxasBuilder(Walk):
                 logging.info("%s triggered by:\n    %s", uid, "\n    ".join(data_str))
         return result
 
+    def artifact_cache_key(self, uid: str) -> Optional[str]:
+        """Return the artifact cache key of a Build action.
+
+        :param uid: A unique Job ID.
+        :return: the key or None if the result of the action should not be
+            cached (see ActionFingerprints.artifact_cache_key)
+        """
+        return self.fingerprints.artifact_cache_key(uid, self.new_fingerprints.get(uid))
+
+    def restore_artifact(self, uid, key, install_dir):
+        """Restore the install directory of a Build action without building.
+
+        The artifact cache is tried first, then the binary store. Entries
+        fetched from the binary store are added to the artifact cache.
+
+        :param uid: A unique Job ID.
+        :type uid: str
+        :param key: the artifact cache key of the action
+        :type key: str
+        :param install_dir: the install directory to populate
+        :type install_dir: str
+        :return: True if the install directory has been restored
+        :rtype: bool
+        """
+        if self.artifact_cache is not None and self.artifact_cache.restore(
+            key, install_dir
+        ):
+            logging.info("%s restored from artifact cache", uid)
+            return True
+        if self.binary_store is None:
+            return False
+
+        cache = self.artifact_cache
+        if cache is None:
+            cache = ArtifactCache(
+                tempfile.mkdtemp(prefix="binaries.", dir=self.sandbox.tmp_dir)
+            )
+        try:
+            if self.binary_store.fetch(key, cache) and cache.restore(key, install_dir):
+                logging.info(
+                    "%s fetched from binary store %s", uid, self.binary_store.location
+                )
+                return True
+            return False
+        finally:
+            if cache is not self.artifact_cache:
+                rm(cache.root_dir, recursive=True)
+
+    @property
+    def transfer_cache(self):
+        """Return the cache of the install trees exchanged with workers.
+
+        It holds the trees not in the artifact cache (e.g. when there is no
+        artifact cache, or for specs opting out of it).
+
+        :rtype: lib.anod.cache.ArtifactCache
+        """
+        return ArtifactCache(os.path.join(self.sandbox.tmp_dir, "remote"))
+
+    def transfer_key(self, uid):
+        """Return the key under which an install tree is sent to workers.
+
+        :param uid: A unique Job ID.
+        :type uid: str
+        :return: the artifact cache key of the action or, when its
+            fingerprint is unknown (e.g. for forced builds), a unique key
+        :rtype: str
+        """
+        fingerprint = self.new_fingerprints.get(uid)
+        if fingerprint is None:
+            return uuid.uuid4().hex
+        return ArtifactCache.key(uid, fingerprint)
+
+    def build_dependencies(self, uid):
+        """Return the Build actions an action depends on, directly or not.
+
+        :param uid: A unique Job ID.
+        :type uid: str
+        :rtype: list[str]
+        """
+        result = []
+        visited = set()
+        pending = list(self.actions.get_predecessors(uid))
+        while pending:
+            pred_uid = pending.pop()
+            if pred_uid in visited:
+                continue
+            visited.add(pred_uid)
+            if isinstance(self.actions[pred_uid], Build):
+                result.append(pred_uid)
+            pending.extend(self.actions.get_predecessors(pred_uid))
+        return result
+
+    def is_incremental(self, uid):
+        """Return True if the build directory of a Build action is kept.
+
+        Builds are incremental when requested on the command line or when
+        the spec sets incremental_build. A forced build is never incremental.
+
+        :param uid: A unique Job ID.
+        :type uid: str
+        :rtype: bool
+        """
+        if self.force:
+            return False
+        return self.incremental or getattr(
+            self.actions[uid].anod_instance, "incremental_build", False
+        )
+
+    def requires_clean_install(self, uid):
+        """Return True if an incremental build must start from an empty install.
+
+        The install directory is kept only when the fingerprint of the Build
+        action changed because of its installed sources: in that case the
+        build overwrites what it installed previously. Any other change
+        (spec files, dependencies, tools) may leave stale files behind.
+
+        :param uid: A unique Job ID.
+        :type uid: str
+        :rtype: bool
+        """
+        previous = self.prev_fingerprints.get(uid)
+        new = self.new_fingerprints.get(uid)
+        if previous is None or new is None:
+            return True
+
+        diff = previous.compare_to(new)
+        if diff is None:
+            return False
+
+        source_uids = {
+            portable_uid(pred_uid)
+            for pred_uid in self.actions.get_predecessors(uid)
+            if isinstance(self.actions[pred_uid], InstallSource)
+        }
+        changes = set().union(diff["updated"], diff["new"], diff["obsolete"])
+        if changes <= source_uids:
+            return False
+        logging.debug("%s: full reinstall required by %s", uid, sorted(changes))
+        return True
+
     def create_job(self, uid, data, predecessors, notify_end):
+        if self.workers is not None and not self.fetch_only and isinstance(data, Build):
+            return UxasRemoteBuildJob(
+                uid, data, notify_end, sandbox=self.sandbox, builder=self
+            )
         return self.JOB_CLASSES.get(data.__class__, UxasJob)(
-            uid, data, notify_end, sandbox=self.sandbox
+            uid, data, notify_end, sandbox=self.sandbox, builder=self
         )
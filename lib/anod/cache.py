@@ -0,0 +1,275 @@
+"""Content-addressed cache of build results shared between sandboxes."""
+
+from __future__ import annotations
+
+from e3.env import Env
+from e3.fs import mkdir, rm
+
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.spec import Anod
+    from e3.fingerprint import Fingerprint
+    from typing import Any, Dict, Optional
+
+
+# Subdirectories of an install tree containing text files that may record the
+# absolute installation prefix (pkg-config and CMake package files). These are
+# rewritten when an install tree is restored at a different location.
+RELOCATABLE_DIRS = (
+    os.path.join("lib", "pkgconfig"),
+    os.path.join("lib", "cmake"),
+    os.path.join("share", "pkgconfig"),
+    os.path.join("share", "cmake"),
+)
+
+
+def portable_uid(uid: str) -> str:
+    """Return an action uid without the name of the machine.
+
+    The uids of the actions performed in build spaces start with the name of
+    the machine (e.g. myhost.x86_64-linux.zeromq.build). Fingerprints and
+    cache keys use portable uids so that they are the same on all machines.
+
+    :param uid: an action uid
+    :return: the uid, without its machine name if it has one
+    """
+    machine = Env().build.machine + "."
+    return uid[len(machine) :] if uid.startswith(machine) else uid
+
+
+def relocate_install_dir(install_dir: str, old_prefix: str) -> None:
+    """Replace references to old_prefix by install_dir.
+
+    Only the files located in RELOCATABLE_DIRS are updated.
+
+    :param install_dir: the install directory to update
+    :param old_prefix: the location at which the install tree was created
+    """
+    if old_prefix == install_dir:
+        return
+
+    old = old_prefix.encode("utf-8")
+    new = install_dir.encode("utf-8")
+    for subdir in RELOCATABLE_DIRS:
+        for root, _, files in os.walk(os.path.join(install_dir, subdir)):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    continue
+                with open(path, "rb") as fd:
+                    content = fd.read()
+                if old in content:
+                    with open(path, "wb") as fd:
+                        fd.write(content.replace(old, new))
+
+
+def setenv_changes(anod_instance: Anod) -> Dict[str, str]:
+    """Return the environment variables set by the setenv method of a spec.
+
+    References to the install directory are replaced by ${prefix} and the
+    previous value of variables extended by setenv by ${<variable>}, e.g.
+    PATH is recorded as ${prefix}/bin:${PATH}.
+
+    :param anod_instance: the Anod instance of a Build action
+    :return: the new value of each variable set
+    """
+    if not hasattr(anod_instance, "setenv"):
+        return {}
+    install_dir = anod_instance.build_space.install_dir
+    saved_env = dict(os.environ)
+    result = {}
+    try:
+        anod_instance.setenv()
+        for var, value in os.environ.items():
+            previous = saved_env.get(var)
+            if value == previous:
+                continue
+            if previous and value.endswith(os.pathsep + previous):
+                value = value[: -len(previous)] + "${%s}" % var
+            result[var] = value.replace(install_dir, "${prefix}")
+    except Exception:
+        logging.debug("cannot compute the environment of %s", anod_instance.name)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+    return result
+
+
+def package_metadata(anod_instance: Anod, fingerprint: Fingerprint) -> Dict[str, Any]:
+    """Return the metadata packed with the install tree of a Build action.
+
+    :param anod_instance: the Anod instance of the action
+    :param fingerprint: the fingerprint of the action
+    :return: metadata for ArtifactCache.store
+    """
+    return {
+        "fingerprint": fingerprint.elements,
+        "setenv": setenv_changes(anod_instance),
+    }
+
+
+class ArtifactCache(object):
+    """Store of packed install trees indexed by Build fingerprints.
+
+    Entries are kept in root_dir/<key[:2]>/ as two files: <key>.tar.gz, the
+    packed install tree, and <key>.json, some metadata about the entry. Both
+    files are written to a temporary location first and then renamed so that
+    several sandboxes (or machines sharing the directory) can use the cache
+    concurrently.
+    """
+
+    def __init__(self, root_dir: str):
+        """Initialize an artifact cache.
+
+        :param root_dir: directory in which cache entries are stored
+        """
+        self.root_dir = os.path.abspath(root_dir)
+
+    @staticmethod
+    def key(uid: str, fingerprint: Fingerprint) -> str:
+        """Return the cache key of a Build action.
+
+        The action uid is part of the key so that two variants of a spec
+        (e.g. two qualifiers) with the same inputs never share an entry.
+
+        :param uid: the Build action uid
+        :param fingerprint: the fingerprint of the Build action
+        :return: the cache key, which does not depend on the machine (see
+            portable_uid)
+        """
+        return hashlib.sha256(
+            ("%s:%s" % (portable_uid(uid), fingerprint.checksum())).encode("utf-8")
+        ).hexdigest()
+
+    def archive_path(self, key: str) -> str:
+        """Return the path to the packed install tree of an entry.
+
+        :param key: a cache key
+        :return: a path
+        """
+        return os.path.join(self.root_dir, key[:2], key + ".tar.gz")
+
+    def metadata_path(self, key: str) -> str:
+        """Return the path to the metadata of an entry.
+
+        :param key: a cache key
+        :return: a path
+        """
+        return os.path.join(self.root_dir, key[:2], key + ".json")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isfile(self.archive_path(key)) and os.path.isfile(
+            self.metadata_path(key)
+        )
+
+    def load_metadata(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the metadata associated with an entry.
+
+        :param key: a cache key
+        :return: the metadata or None if there is no such entry
+        """
+        if key not in self:
+            return None
+        with open(self.metadata_path(key)) as fd:
+            return json.load(fd)
+
+    def tmp_file(self, key: str) -> str:
+        """Return a new temporary file next to the files of an entry.
+
+        :param key: a cache key
+        :return: the path to an empty file, to be passed to ArtifactCache.add
+            or removed
+        """
+        entry_dir = os.path.dirname(self.archive_path(key))
+        mkdir(entry_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        os.close(fd)
+        return tmp_file
+
+    def add(self, key: str, metadata_file: str, archive_file: str) -> None:
+        """Publish an entry whose files have been written.
+
+        :param key: the cache key
+        :param metadata_file: the metadata, returned by ArtifactCache.tmp_file
+        :param archive_file: the packed install tree, returned by
+            ArtifactCache.tmp_file
+        """
+        # The metadata is published first: an entry only becomes visible
+        # once its archive exists.
+        os.replace(metadata_file, self.metadata_path(key))
+        os.replace(archive_file, self.archive_path(key))
+
+    def store(
+        self,
+        key: str,
+        uid: str,
+        install_dir: str,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        """Pack an install directory into the cache.
+
+        :param key: the cache key (see ArtifactCache.key)
+        :param uid: the Build action uid
+        :param install_dir: the install directory to pack
+        :param metadata: additional metadata to record with the entry (see
+            package_metadata)
+        :return: True if the entry has been created
+        """
+        tmp_archive = None
+        tmp_metadata = None
+        try:
+            tmp_archive = self.tmp_file(key)
+            with tarfile.open(tmp_archive, mode="w:gz", compresslevel=6) as tar:
+                tar.add(install_dir, arcname=".")
+
+            tmp_metadata = self.tmp_file(key)
+            with open(tmp_metadata, "w") as f:
+                json.dump(dict(metadata or {}, uid=uid, prefix=install_dir), f)
+
+            self.add(key, tmp_metadata, tmp_archive)
+            logging.debug("stored %s in artifact cache (%s)", uid, key)
+            return True
+        except (OSError, tarfile.TarError):
+            logging.warning("cannot store %s in artifact cache", uid, exc_info=True)
+            for tmp_file in (tmp_archive, tmp_metadata):
+                if tmp_file is not None:
+                    rm(tmp_file)
+            return False
+
+    def restore(self, key: str, install_dir: str) -> bool:
+        """Restore an install directory from the cache.
+
+        :param key: the cache key (see ArtifactCache.key)
+        :param install_dir: the install directory to populate. Its previous
+            content is removed.
+        :return: True if the install directory has been restored, False if
+            there is no usable entry for key
+        """
+        metadata = self.load_metadata(key)
+        if metadata is None:
+            return False
+
+        rm(install_dir, recursive=True)
+        mkdir(install_dir)
+        try:
+            with tarfile.open(self.archive_path(key), mode="r:gz") as tar:
+                if hasattr(tarfile, "tar_filter"):
+                    tar.extractall(install_dir, filter="tar")
+                else:
+                    tar.extractall(install_dir)
+        except (OSError, tarfile.TarError):
+            logging.warning("cannot restore %s from artifact cache", key, exc_info=True)
+            rm(install_dir, recursive=True)
+            mkdir(install_dir)
+            return False
+
+        relocate_install_dir(install_dir, metadata["prefix"])
+        return True
@@ -0,0 +1,165 @@
+"""Compiler cache shared by the builds of a sandbox.
+
+The cache relies on ccache used in masquerade mode: a directory containing
+links named after the compilers (gcc, g++, cc, c++) pointing to ccache is
+put first in PATH, so that cmake, make and gprbuild use the cache without
+any change in the specs.
+
+Cache entries are keyed by ccache on the preprocessed sources and the
+compiler flags. The compiler itself is identified by
+OPENUXAS_COMPILER_VERSION rather than by hashing its executable, and paths
+are made relative to the sandbox, so that the objects compiled in one build
+space (e.g. uxas-release) can be reused in another one (e.g. after a build
+of uxas-gcov, or after a forced rebuild).
+"""
+
+from __future__ import annotations
+
+from e3.fs import mkdir, rm
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, Optional
+
+
+# Compilers intercepted in masquerade mode
+COMPILERS = ("gcc", "g++", "cc", "c++")
+
+# Statistics reported, by ccache --print-stats key
+STATS = {
+    "direct_cache_hit": "hits_direct",
+    "preprocessed_cache_hit": "hits_preprocessed",
+    "cache_miss": "misses",
+}
+
+# Same statistics in the output of ccache -s (ccache < 4)
+STATS_PATTERNS = {
+    "hits_direct": re.compile(r"^cache hit \(direct\)\s+(\d+)"),
+    "hits_preprocessed": re.compile(r"^cache hit \(preprocessed\)\s+(\d+)"),
+    "misses": re.compile(r"^cache miss\s+(\d+)"),
+}
+
+
+class CompilerCache(object):
+    """A ccache cache stored in a sandbox."""
+
+    def __init__(self, root_dir: str, ccache: str, base_dir: str):
+        """Initialize a compiler cache.
+
+        :param root_dir: directory containing the cache and the masquerade
+            directory
+        :param ccache: path to the ccache executable
+        :param base_dir: directory under which absolute paths are rewritten
+            as relative ones when computing cache keys (see CCACHE_BASEDIR)
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.ccache = ccache
+        self.base_dir = base_dir
+        self.cache_dir = os.path.join(self.root_dir, "cache")
+        self.bin_dir = os.path.join(self.root_dir, "bin")
+        self.initial_stats: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def find(cls, root_dir: str, base_dir: str) -> Optional[CompilerCache]:
+        """Return a compiler cache if ccache is installed.
+
+        :param root_dir: see CompilerCache
+        :param base_dir: see CompilerCache
+        :return: a compiler cache or None if ccache cannot be found
+        """
+        ccache = shutil.which("ccache")
+        if ccache is None:
+            logging.info("ccache not found: compiler cache disabled")
+            return None
+        return cls(root_dir, os.path.realpath(ccache), base_dir)
+
+    @property
+    def env(self) -> Dict[str, str]:
+        """Return the environment variables configuring ccache."""
+        return {
+            "CCACHE_DIR": self.cache_dir,
+            "CCACHE_BASEDIR": self.base_dir,
+            "CCACHE_COMPILERCHECK": "string:%s"
+            % os.environ.get("OPENUXAS_COMPILER_VERSION", "unknown"),
+            # Do not hash the current directory, which is specific to each
+            # build space, into the keys of objects with debug information
+            "CCACHE_NOHASHDIR": "1",
+        }
+
+    def setenv(self) -> None:
+        """Make the compilers run by builds use the cache.
+
+        The masquerade directory is (re)created and put first in PATH.
+        """
+        rm(self.bin_dir, recursive=True)
+        mkdir(self.bin_dir)
+        mkdir(self.cache_dir)
+        for compiler in COMPILERS:
+            os.symlink(self.ccache, os.path.join(self.bin_dir, compiler))
+        os.environ.update(self.env)
+        os.environ["PATH"] = os.pathsep.join(
+            [self.bin_dir] + [p for p in os.environ["PATH"].split(os.pathsep) if p]
+        )
+        self.initial_stats = self.stats()
+
+    def stats(self) -> Optional[Dict[str, int]]:
+        """Return the cache statistics.
+
+        :return: the number of hits and misses since the cache creation, or
+            None if they cannot be read
+        """
+        env = dict(os.environ, **self.env)
+        p = subprocess.run(
+            [self.ccache, "--print-stats"],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+        result = dict.fromkeys(STATS_PATTERNS, 0)
+        if p.returncode == 0:
+            for line in p.stdout.splitlines():
+                key, _, value = line.partition("\t")
+                if key in STATS and value.strip().isdigit():
+                    result[STATS[key]] = int(value)
+            return result
+
+        # Older versions of ccache
+        p = subprocess.run(
+            [self.ccache, "-s"],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+        if p.returncode != 0:
+            return None
+        for line in p.stdout.splitlines():
+            for name, pattern in STATS_PATTERNS.items():
+                m = pattern.match(line.strip())
+                if m:
+                    result[name] = int(m.group(1))
+        return result
+
+    def stats_delta(self) -> Optional[Dict[str, int]]:
+        """Return the statistics of the compilations since setenv.
+
+        Compilations performed at the same time by other builds in the same
+        sandbox are included.
+
+        :return: the number of hits and misses, or None if unknown
+        """
+        stats = self.stats()
+        if stats is None or self.initial_stats is None:
+            return None
+        initial_stats = self.initial_stats
+        result = {name: stats[name] - initial_stats[name] for name in stats}
+        result["hits"] = result["hits_direct"] + result["hits_preprocessed"]
+        return result
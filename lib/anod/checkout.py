@@ -0,0 +1,152 @@
+"""Checkouts of the repositories listed in specs/config/repositories.yaml."""
+
+from __future__ import annotations
+
+from e3.anod.checkout import CheckoutManager
+from e3.anod.status import ReturnValue
+from e3.fs import VCS_IGNORE_LIST, mkdir
+from e3.os.process import PIPE
+from e3.vcs.git import GitError, GitRepository
+
+from lib.anod.gitcache import read_shallow
+from lib.anod.manifest import sync_with_manifest
+
+import json
+import logging
+import os
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from lib.anod.gitcache import GitObjectCache
+    from typing import List, Optional, Tuple
+
+
+class UxasCheckoutManager(CheckoutManager):
+    """Checkout manager sharing git objects and syncing external trees.
+
+    Git repositories borrow their objects from a GitObjectCache, when one
+    is given. External repositories (local directories, e.g. set up by anod
+    devel-setup) are synchronized incrementally: a manifest of the checkout
+    is kept next to it so that only the files that changed are copied, with
+    their modification times.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        working_dir: str,
+        git_cache: Optional[GitObjectCache] = None,
+    ):
+        """Initialize a checkout manager.
+
+        :param name: see CheckoutManager
+        :param working_dir: see CheckoutManager
+        :param git_cache: the cache from which git objects are borrowed
+        """
+        super().__init__(name=name, working_dir=working_dir)
+        self.git_cache = git_cache
+        self.manifest_file = self.working_dir + "_manifest.json"
+
+    def update_git(
+        self, url: str, revision: Optional[str]
+    ) -> Tuple[ReturnValue, Optional[str], Optional[str]]:
+        """See CheckoutManager.update_git.
+
+        When a git cache is used, the revision is first fetched into the
+        cache, then the checkout is updated from the cache, which only
+        transfers refs.
+        """
+        if self.git_cache is None or revision is None:
+            return super().update_git(url=url, revision=revision)
+        try:
+            cache_repo, ref = self.git_cache.fetch(url, revision)
+        except GitError:
+            logging.exception("cannot fetch %s into the git cache", url)
+            return super().update_git(url=url, revision=revision)
+
+        git_dir = os.path.join(self.working_dir, ".git")
+        mkdir(self.working_dir)
+        GitRepository(working_tree=self.working_dir).git_cmd(["init", "-q"])
+        with open(os.path.join(git_dir, "objects", "info", "alternates"), "w") as f:
+            f.write(os.path.join(cache_repo, "objects") + "\n")
+
+        # The checkout does not get the shallow commits of the cache when
+        # fetching from it, as it already has all the objects.
+        shallow = read_shallow(git_dir) | read_shallow(cache_repo)
+        if shallow:
+            with open(os.path.join(git_dir, "shallow"), "w") as f:
+                f.write("".join(commit + "\n" for commit in sorted(shallow)))
+
+        return super().update_git(url=cache_repo, revision=ref)
+
+    def external_ignore_list(self, url: str) -> List[str]:
+        """Return the files of an external repository not to synchronize.
+
+        :param url: path to the repository
+        :return: the version control files and, for git repositories, the
+            files ignored by git (e.g. build products)
+        """
+        ignore_list = list(VCS_IGNORE_LIST)
+        if os.path.isdir(os.path.join(url, ".git")):
+            try:
+                output = (
+                    GitRepository(working_tree=url)
+                    .git_cmd(
+                        [
+                            "ls-files",
+                            "-o",
+                            "--ignored",
+                            "--exclude-standard",
+                            "--directory",
+                        ],
+                        output=PIPE,
+                    )
+                    .out
+                )
+                ignore_list.extend(
+                    "/%s" % f.strip().rstrip("/") for f in output.splitlines()
+                )
+            except GitError:
+                # Synchronize ignored files rather than failing
+                logging.debug("cannot get the files ignored in %s", url)
+        return ignore_list
+
+    def update_external(
+        self, url: str, revision: Optional[str]
+    ) -> Tuple[ReturnValue, str, str]:
+        """See CheckoutManager.update_external.
+
+        The commits returned are digests of the content of the checkout.
+
+        :param url: path to the repository
+        :param revision: ignored
+        """
+        old_commit = ""
+        if os.path.isfile(self.metadata_file) and os.path.isfile(self.manifest_file):
+            try:
+                with open(self.metadata_file) as fd:
+                    old_commit = json.load(fd).get("new_commit") or ""
+            except (OSError, ValueError):
+                pass
+
+        manifest, updated, removed = sync_with_manifest(
+            url,
+            self.working_dir,
+            self.manifest_file,
+            ignore=self.external_ignore_list(url),
+            clean=True,
+        )
+        if updated or removed:
+            logging.debug(
+                "%s: %d files updated, %d removed",
+                self.name,
+                len(updated),
+                len(removed),
+            )
+
+        new_commit = manifest.state()
+        if new_commit == old_commit:
+            return ReturnValue.unchanged, old_commit, new_commit
+        else:
+            return ReturnValue.success, old_commit, new_commit
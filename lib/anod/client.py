@@ -0,0 +1,152 @@
+"""Client side of the anod server.
+
+This module is imported by the anod front-end before anything else, so it
+must only depend on the standard library, and the modules needed to talk to
+the server are only imported when a server is running.
+"""
+
+from __future__ import annotations
+
+from lib.anod.paths import SBX_DIR
+
+import os
+import sys
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import socket
+    from typing import Any, Dict, List, Optional, Tuple
+
+
+# Environment variable giving the path to the server socket. Setting it to
+# an empty string disables the use of the server.
+SERVER_ENV_VAR = "OPENUXAS_ANOD_SERVER"
+
+# Commands that can be run by the server
+SERVER_COMMANDS = ("build", "import", "export", "printenv")
+
+
+def server_socket_path() -> Optional[str]:
+    """Return the path to the socket of the anod server.
+
+    :return: a path or None if the use of the server is disabled
+    """
+    path = os.environ.get(SERVER_ENV_VAR)
+    if path is None:
+        return os.path.join(SBX_DIR, "tmp", "anod-server.sock")
+    return path or None
+
+
+def send_message(
+    sock: socket.socket, message: Dict[str, Any], fds: Optional[List[int]] = None
+) -> None:
+    """Send a message, optionally passing file descriptors along.
+
+    :param sock: a connected Unix socket
+    :param message: a JSON serializable dict
+    :param fds: file descriptors to pass to the peer
+    """
+    import array
+    import json
+    import socket
+
+    data = json.dumps(message).encode("utf-8") + b"\n"
+    if fds:
+        sent = sock.sendmsg(
+            [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+        )
+        data = data[sent:]
+    sock.sendall(data)
+
+
+def receive_message(
+    sock: socket.socket, max_fds: int = 0
+) -> Optional[Tuple[Dict[str, Any], List[int]]]:
+    """Receive a message sent with send_message.
+
+    :param sock: a connected Unix socket
+    :param max_fds: maximum number of file descriptors expected
+    :return: the message and the file descriptors received, or None if the
+        connection was closed before a complete message was received
+    """
+    import array
+    import json
+    import socket
+
+    fds: List[int] = []
+    data = b""
+    while not data.endswith(b"\n"):
+        if max_fds and not fds:
+            fds_size = socket.CMSG_LEN(max_fds * array.array("i").itemsize)
+            chunk, ancdata, _, _ = sock.recvmsg(65536, fds_size)
+            for level, kind, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    received = array.array("i")
+                    received.frombytes(
+                        cmsg_data[: len(cmsg_data) - len(cmsg_data) % received.itemsize]
+                    )
+                    fds.extend(received)
+        else:
+            chunk = sock.recv(65536)
+        if not chunk:
+            for fd in fds:
+                os.close(fd)
+            return None
+        data += chunk
+    return json.loads(data.decode("utf-8")), fds
+
+
+def run_on_server(args: List[str]) -> Optional[int]:
+    """Run an anod command on the anod server, if it is running.
+
+    The server uses the standard streams, environment and working directory
+    of the current process.
+
+    :param args: the command line arguments (without the program name)
+    :return: the command exit status or None if the command has not been
+        sent to the server. Once sent, the command is never run locally: a
+        failure to get its result is reported with the exit status 1.
+    """
+    if not args or args[0] not in SERVER_COMMANDS:
+        return None
+    path = server_socket_path()
+    if path is None or not os.path.exists(path):
+        return None
+
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            send_message(
+                sock,
+                {
+                    "command": args[0],
+                    "args": args,
+                    "env": dict(os.environ),
+                    "cwd": os.getcwd(),
+                },
+                fds=[0, 1, 2],
+            )
+        except OSError:
+            return None
+
+        # The server may have started the command: running it again locally
+        # is not an option anymore
+        try:
+            result = receive_message(sock)
+        except OSError as e:
+            print("anod: lost connection to the anod server: %s" % e, file=sys.stderr)
+            return 1
+    except KeyboardInterrupt:
+        # Closing the connection makes the server interrupt the command
+        return 130
+    finally:
+        sock.close()
+
+    if result is None:
+        print("anod: lost connection to the anod server", file=sys.stderr)
+        return 1
+    return result[0].get("status", 1)
@@ -0,0 +1,142 @@
+"""Persistent index of file digests."""
+
+from __future__ import annotations
+
+import e3.hash
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional
+
+
+class DigestIndex(object):
+    """Cache of file digests validated by file status.
+
+    Each entry records the digests computed for a file along with the size,
+    modification time and inode of the file at that time. A digest is reused
+    as long as these are unchanged, so that large files (e.g. source
+    archives) are not read again on each build. In paranoid mode digests are
+    always recomputed.
+
+    The index can be used from several threads.
+    """
+
+    ALGORITHMS = ("sha1", "sha256")
+
+    def __init__(self, filename: str, paranoid: bool = False):
+        """Initialize a digest index.
+
+        :param filename: the file in which the index is stored. It is loaded
+            if it exists.
+        :param paranoid: if True, do not trust the recorded digests
+        """
+        self.filename = filename
+        self.paranoid = paranoid
+        self.entries: Dict[str, dict] = {}
+        self.modified = False
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fd:
+                    self.entries = json.load(fd)
+            except (OSError, ValueError):
+                logging.warning("ignoring invalid digest index %s", filename)
+
+    @staticmethod
+    def stat_key(path: str) -> List[int]:
+        """Return the file status used to validate the digests of a file.
+
+        :param path: a path
+        :return: the size, modification time in ns and inode of path
+        """
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def digest(self, path: str, algorithm: str = "sha256") -> str:
+        """Return the digest of a file.
+
+        :param path: path to a file
+        :param algorithm: sha1 or sha256
+        :return: the hexadecimal digest of the file content
+        """
+        assert algorithm in self.ALGORITHMS, "invalid algorithm %s" % algorithm
+        path = os.path.abspath(path)
+        stat_key = self.stat_key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if (
+                not self.paranoid
+                and entry is not None
+                and entry["stat"] == stat_key
+                and algorithm in entry
+            ):
+                return entry[algorithm]
+
+        result = getattr(e3.hash, algorithm)(path)
+        self.record(path, stat=stat_key, **{algorithm: result})
+        return result
+
+    def sha1(self, path: str) -> str:
+        """Return the SHA-1 of a file (see DigestIndex.digest)."""
+        return self.digest(path, "sha1")
+
+    def sha256(self, path: str) -> str:
+        """Return the SHA-256 of a file (see DigestIndex.digest)."""
+        return self.digest(path, "sha256")
+
+    def record(
+        self, path: str, stat: Optional[List[int]] = None, **digests: str
+    ) -> None:
+        """Record digests computed elsewhere for a file.
+
+        Digests recorded for a different status of the file are dropped.
+
+        :param path: path to a file
+        :param stat: the status of the file (see DigestIndex.stat_key) before
+            the digests were computed. Nothing is recorded if the file has
+            been modified since then.
+        :param digests: digests indexed by algorithm name
+        """
+        path = os.path.abspath(path)
+        stat_key = self.stat_key(path)
+        if stat is not None and stat != stat_key:
+            return
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry["stat"] != stat_key:
+                entry = {"stat": stat_key}
+                self.entries[path] = entry
+            entry.update(digests)
+            self.modified = True
+
+    def save(self) -> None:
+        """Write the index to its file if it has been modified."""
+        with self.lock:
+            if not self.modified:
+                return
+            # Forget files that no longer exist
+            entries = {
+                path: entry
+                for path, entry in self.entries.items()
+                if os.path.exists(path)
+            }
+            tmp_file: Optional[str] = None
+            try:
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=os.path.dirname(self.filename), suffix=".tmp"
+                )
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_file, self.filename)
+                self.modified = False
+            except OSError:
+                logging.warning("cannot save digest index", exc_info=True)
+                if tmp_file is not None and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
@@ -0,0 +1,198 @@
+"""Concurrent download of source archives."""
+
+from __future__ import annotations
+
+from e3.anod.status import ReturnValue
+from e3.archive import ArchiveError
+from e3.fs import rm
+
+from lib.anod.sources import TarStreamExtractor, root_dir_content, tar_compression
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import hashlib
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    from lib.anod.digest import DigestIndex
+    from lib.anod.sources import SourceTreeCache
+    from typing import Dict, Optional
+
+
+class DownloadEngine(object):
+    """Download files into a directory using a pool of threads.
+
+    All downloads share a single HTTP session, so connections to a given
+    server are kept alive and reused. The SHA-1 of each file is computed
+    while its content is written and stored in a <file>.sha1 file next to
+    it: a file whose checksum matches its .sha1 file is not downloaded
+    again. Checksums of files already present are looked up in a digest
+    index, so unchanged archives are not read again.
+
+    When a source tree cache is given, tar archives are also extracted into
+    it while they are downloaded, so that installing them in a build space
+    does not require unpacking them afterwards. The source tree is cached as
+    if unpacked with remove_root_dir=True, the default for sources.
+
+    Downloads are identified by their file name: requesting the same file
+    several times (e.g. once when prefetching and once from the job that
+    needs it) results in a single download.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    TIMEOUT = (60, 60)
+
+    def __init__(
+        self,
+        dest_dir: str,
+        digest_index: DigestIndex,
+        source_cache: Optional[SourceTreeCache] = None,
+        max_workers: int = 4,
+    ):
+        """Initialize a download engine.
+
+        :param dest_dir: directory in which files are downloaded
+        :param digest_index: index used to get the checksums of the files
+        :param source_cache: cache in which tar archives are extracted
+        :param max_workers: maximum number of concurrent downloads
+        """
+        self.dest_dir = dest_dir
+        self.digest_index = digest_index
+        self.source_cache = source_cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers, max_retries=3
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.downloads: Dict[str, Future[ReturnValue]] = {}
+        self.lock = threading.Lock()
+
+    def is_cached(self, filename: str) -> bool:
+        """Return True if a file has already been downloaded.
+
+        :param filename: name of the file in the destination directory
+        """
+        path = os.path.join(self.dest_dir, filename)
+        if not os.path.isfile(path) or not os.path.isfile(path + ".sha1"):
+            return False
+        with open(path + ".sha1", "rb") as f:
+            checksum = f.read(1024).decode()
+        return checksum == self.digest_index.sha1(path)
+
+    def submit(self, url: str, filename: str) -> Future[ReturnValue]:
+        """Schedule the download of a file, unless it is already scheduled.
+
+        :param url: the url of the file
+        :param filename: name of the file in the destination directory
+        :return: a future whose result is ReturnValue.skip if the file was
+            already there, ReturnValue.success if it has been downloaded and
+            ReturnValue.failure otherwise
+        """
+        with self.lock:
+            if filename not in self.downloads:
+                self.downloads[filename] = self.executor.submit(
+                    self.download, url, filename
+                )
+            return self.downloads[filename]
+
+    def fetch(self, url: str, filename: str) -> ReturnValue:
+        """Download a file, waiting for the download to complete.
+
+        See DownloadEngine.submit.
+        """
+        return self.submit(url, filename).result()
+
+    def download(self, url: str, filename: str) -> ReturnValue:
+        """Download a file unless it is already in the destination directory.
+
+        See DownloadEngine.submit.
+        """
+        if self.is_cached(filename):
+            return ReturnValue.skip
+
+        path = os.path.join(self.dest_dir, filename)
+        tmp_path = path + ".part"
+        rm(path + ".sha1")
+        extractor = None
+        extract_dir = None
+        compression = tar_compression(filename)
+        try:
+            logging.info("downloading %s", url)
+            checksum = hashlib.sha1()
+            sha256 = hashlib.sha256()
+            with closing(
+                self.session.get(url, stream=True, timeout=self.TIMEOUT)
+            ) as response:
+                response.raise_for_status()
+                if self.source_cache is not None and compression is not None:
+                    extract_dir = self.source_cache.tmp_dir()
+                    extractor = TarStreamExtractor(compression, extract_dir)
+                with open(tmp_path, "wb") as fd:
+                    for chunk in response.iter_content(self.CHUNK_SIZE):
+                        fd.write(chunk)
+                        checksum.update(chunk)
+                        sha256.update(chunk)
+                        if extractor is not None:
+                            extractor.write(chunk)
+            os.replace(tmp_path, path)
+            with open(path + ".sha1", "w") as f:
+                f.write(checksum.hexdigest())
+            self.digest_index.record(
+                path, sha1=checksum.hexdigest(), sha256=sha256.hexdigest()
+            )
+            if extractor is not None and extract_dir is not None:
+                self.add_to_source_cache(
+                    filename, extractor, extract_dir, sha256.hexdigest()
+                )
+            return ReturnValue.success
+        except (requests.exceptions.RequestException, OSError):
+            logging.warning("cannot download %s", url, exc_info=True)
+            rm(tmp_path)
+            return ReturnValue.failure
+        finally:
+            if extractor is not None:
+                try:
+                    extractor.close()
+                except ArchiveError:
+                    pass
+            if extract_dir is not None:
+                rm(extract_dir, recursive=True)
+
+    def add_to_source_cache(
+        self,
+        filename: str,
+        extractor: TarStreamExtractor,
+        extract_dir: str,
+        digest: str,
+    ) -> None:
+        """Add an archive extracted during its download to the source cache.
+
+        :param filename: the archive name
+        :param extractor: the extractor that was given the archive
+        :param extract_dir: the directory in which it extracted the archive
+        :param digest: the sha256 of the archive
+        """
+        assert self.source_cache is not None
+        try:
+            extractor.close()
+            key = self.source_cache.key(digest, True)
+            if key not in self.source_cache:
+                self.source_cache.add(key, root_dir_content(extract_dir, True))
+        except (ArchiveError, OSError) as e:
+            # The archive is unpacked when installed instead
+            logging.debug("cannot extract %s while downloading: %s", filename, e)
+
+    def shutdown(self) -> None:
+        """Wait for the pending downloads and release the connections."""
+        self.executor.shutdown(wait=True)
+        self.session.close()
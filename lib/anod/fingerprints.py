@@ -0,0 +1,307 @@
+"""Persistent store of the fingerprints of the actions of a sandbox."""
+
+from __future__ import annotations
+
+from e3.fingerprint import Fingerprint
+from e3.fs import mkdir, rm
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.sandbox import SandBox
+    from typing import Dict, List, Optional, Tuple
+
+
+class FingerprintStore(object):
+    """SQLite database of the fingerprints recorded by the builds.
+
+    The current fingerprint of each action is the one of its last successful
+    execution, as expected by UxasBuilder.load_previous_fingerprint. Each
+    build is a run, numbered from 1, and the fingerprints recorded by the
+    last runs are kept as history.
+
+    All the current fingerprints are loaded when the store is opened.
+    Changes are buffered and written in a single transaction when flushed:
+    UxasBuilder flushes them whenever an action is executed, so that the
+    removal of the fingerprint of an action (see Walk.get_job) is recorded
+    before the action changes anything. Otherwise, a build killed while
+    performing an action could leave the previous fingerprint of the action,
+    and the next build would skip it.
+
+    The store can be used from several threads.
+    """
+
+    # Number of runs whose fingerprints are kept in the history (in addition
+    # to the current fingerprints)
+    HISTORY_RUNS = 50
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            run INTEGER NOT NULL,
+            uid TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            elements TEXT NOT NULL,
+            PRIMARY KEY (run, uid)
+        );
+        CREATE TABLE IF NOT EXISTS current (
+            uid TEXT PRIMARY KEY,
+            run INTEGER NOT NULL
+        );
+    """
+
+    def __init__(
+        self, filename: str, legacy_dir: Optional[str] = None, read_only: bool = False
+    ):
+        """Open a fingerprint store, creating it if needed.
+
+        :param filename: the database file
+        :param legacy_dir: directory of the fingerprints saved by previous
+            versions, one JSON file per action. They are imported when the
+            database is created, then the directory is removed.
+        :param read_only: if True, the store is only read: the database is
+            neither created nor modified, and the fingerprints of legacy_dir
+            are loaded without being imported when there is no database
+            (e.g. for anod build --plan)
+        """
+        self.filename = filename
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        # Changes not written yet, by uid (None for a removed fingerprint)
+        self.pending: Dict[str, Optional[Fingerprint]] = {}
+        self.run: Optional[int] = None
+
+        created = not os.path.isfile(filename)
+        if read_only and created:
+            # Nothing recorded yet: an empty database that is never written
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        elif read_only:
+            self.db = sqlite3.connect(
+                "file:%s?mode=ro" % pathname2url(filename),
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            mkdir(os.path.dirname(filename))
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            # Transactions are committed without waiting for the disk: a
+            # power failure may lose the last ones, but not corrupt the
+            # database
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        if not read_only or created:
+            with self.db:
+                self.db.executescript(self.SCHEMA)
+
+        self.fingerprints: Dict[str, Fingerprint] = {}
+        if created and legacy_dir is not None and os.path.isdir(legacy_dir):
+            if read_only:
+                self.fingerprints = self.load_legacy(legacy_dir)
+            else:
+                self.import_legacy(legacy_dir)
+
+        self.fingerprints.update(
+            (uid, self.make_fingerprint(elements))
+            for uid, elements in self.db.execute(
+                "SELECT current.uid, elements FROM current JOIN history"
+                " ON current.run = history.run AND current.uid = history.uid"
+            )
+        )
+
+    @classmethod
+    def for_sandbox(cls, sandbox: SandBox, read_only: bool = False) -> FingerprintStore:
+        """Open the fingerprint store of a sandbox.
+
+        :param sandbox: the sandbox
+        :param read_only: see FingerprintStore
+        """
+        return cls(
+            os.path.join(sandbox.meta_dir, "fingerprints.db"),
+            legacy_dir=os.path.join(sandbox.root_dir, "fingerprints"),
+            read_only=read_only,
+        )
+
+    @staticmethod
+    def make_fingerprint(elements: str) -> Fingerprint:
+        """Return the fingerprint stored in the database.
+
+        :param elements: the JSON encoded elements of the fingerprint
+        """
+        result = Fingerprint()
+        result.elements = json.loads(elements)
+        return result
+
+    @staticmethod
+    def load_legacy(legacy_dir: str) -> Dict[str, Fingerprint]:
+        """Load the fingerprint files of previous versions.
+
+        :param legacy_dir: the directory containing the files
+        :return: the fingerprints by uid
+        """
+        result = {}
+        for name in sorted(os.listdir(legacy_dir)):
+            if not name.endswith(".json"):
+                continue
+            fingerprint = Fingerprint.load_from_file(os.path.join(legacy_dir, name))
+            if fingerprint is not None:
+                result[name[: -len(".json")]] = fingerprint
+        return result
+
+    def import_legacy(self, legacy_dir: str) -> None:
+        """Import the fingerprint files of previous versions as a first run.
+
+        :param legacy_dir: the directory containing the files
+        """
+        self.start_run()
+        fingerprints = self.load_legacy(legacy_dir)
+        self.pending.update(fingerprints)
+        self.flush()
+        rm(legacy_dir, recursive=True)
+        logging.info("imported %d fingerprints from %s", len(fingerprints), legacy_dir)
+
+    def start_run(self) -> int:
+        """Start recording the fingerprints of a new build.
+
+        The fingerprints of the runs older than the last HISTORY_RUNS ones
+        are dropped, except the current ones.
+
+        :return: the run number
+        """
+        assert not self.read_only, "read-only fingerprint store"
+        with self.lock, self.db:
+            run = self.db.execute(
+                "INSERT INTO runs (start) VALUES (?)", (time.time(),)
+            ).lastrowid
+            assert run is not None
+            self.db.execute(
+                "DELETE FROM history WHERE run <= ?"
+                " AND NOT EXISTS (SELECT 1 FROM current"
+                " WHERE current.run = history.run AND current.uid = history.uid)",
+                (run - self.HISTORY_RUNS,),
+            )
+            self.db.execute(
+                "DELETE FROM runs WHERE id <= ? AND id NOT IN"
+                " (SELECT run FROM history)",
+                (run - self.HISTORY_RUNS,),
+            )
+            self.run = run
+        return run
+
+    def get(self, uid: str) -> Optional[Fingerprint]:
+        """Return the current fingerprint of an action.
+
+        :param uid: the action uid
+        :return: the fingerprint or None if there is none
+        """
+        with self.lock:
+            return self.fingerprints.get(uid)
+
+    def set(self, uid: str, fingerprint: Optional[Fingerprint]) -> None:
+        """Record the current fingerprint of an action (see flush).
+
+        :param uid: the action uid
+        :param fingerprint: the new fingerprint, None to remove it
+        """
+        assert self.run is not None, "no run started"
+        with self.lock:
+            if fingerprint is None:
+                self.fingerprints.pop(uid, None)
+            else:
+                self.fingerprints[uid] = fingerprint
+            self.pending[uid] = fingerprint
+
+    def flush(self) -> None:
+        """Write the pending changes in a single transaction."""
+        with self.lock:
+            if not self.pending:
+                return
+            with self.db:
+                for uid, fingerprint in self.pending.items():
+                    if fingerprint is None:
+                        self.db.execute("DELETE FROM current WHERE uid = ?", (uid,))
+                        continue
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)",
+                        (
+                            self.run,
+                            uid,
+                            fingerprint.checksum(),
+                            json.dumps(fingerprint.elements, sort_keys=True),
+                        ),
+                    )
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO current VALUES (?, ?)", (uid, self.run)
+                    )
+            self.pending = {}
+
+    def close(self) -> None:
+        """Write the pending changes and close the database."""
+        if not self.read_only:
+            self.flush()
+        self.db.close()
+
+    def runs(self) -> List[Tuple[int, float]]:
+        """Return the runs of the history.
+
+        :return: the number and start time of each run, oldest first
+        """
+        with self.lock:
+            return list(self.db.execute("SELECT id, start FROM runs ORDER BY id"))
+
+    def history(self, uid: str) -> List[Tuple[int, Fingerprint]]:
+        """Return the fingerprints recorded for an action.
+
+        :param uid: the action uid
+        :return: the run number and fingerprint of each recorded
+            fingerprint, oldest first
+        """
+        with self.lock:
+            return [
+                (run, self.make_fingerprint(elements))
+                for run, elements in self.db.execute(
+                    "SELECT run, elements FROM history WHERE uid = ? ORDER BY run",
+                    (uid,),
+                )
+            ]
+
+    def changes_since(self, run: int) -> Dict[str, Optional[Dict[str, List[str]]]]:
+        """Return the actions whose fingerprint changed since a run.
+
+        :param run: a run number
+        :return: for each action whose current fingerprint differs from the
+            one it had after the given run, the changed elements of the
+            fingerprint as returned by Fingerprint.compare_to, or None if the
+            action had no fingerprint after the given run
+        """
+        with self.lock:
+            previous = {
+                uid: self.make_fingerprint(elements)
+                for uid, elements in self.db.execute(
+                    "SELECT uid, elements FROM history"
+                    " WHERE run = (SELECT MAX(run) FROM history AS h"
+                    " WHERE h.uid = history.uid AND h.run <= ?)",
+                    (run,),
+                )
+            }
+            current = dict(self.fingerprints)
+
+        result: Dict[str, Optional[Dict[str, List[str]]]] = {}
+        for uid, fingerprint in current.items():
+            if uid not in previous:
+                result[uid] = None
+                continue
+            diff = previous[uid].compare_to(fingerprint)
+            if diff is not None:
+                result[uid] = {key: sorted(value) for key, value in diff.items()}
+        return result
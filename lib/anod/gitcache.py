@@ -0,0 +1,260 @@
+"""Git object store shared between sandboxes.
+
+Each repository URL gets a bare repository in the cache, into which the
+revisions needed by builds are fetched. Checkouts then borrow its objects
+through git alternates, so that the objects of a repository are downloaded
+and stored once whatever the number of sandboxes using it.
+"""
+
+from __future__ import annotations
+
+from e3.fs import mkdir
+from e3.vcs.git import GitError, GitRepository
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterator, Optional, Set, Tuple
+
+
+COMMIT_REVISION = re.compile(r"^[0-9a-f]{40}$")
+# Tags are assumed to follow semantic versioning (e.g. v4.3.1 or 1.2.1) and
+# never to be moved once published.
+TAG_REVISION = re.compile(r"^v?\d+(\.\d+)+$")
+
+
+def classify_revision(revision: Optional[str]) -> str:
+    """Return the kind of a git revision.
+
+    :param revision: a git revision from specs/config/repositories.yaml
+    :return: "commit" or "tag" for revisions that always designate the same
+        commit, "branch" for the others
+    """
+    if revision is None:
+        return "branch"
+    if COMMIT_REVISION.match(revision):
+        return "commit"
+    if TAG_REVISION.match(revision):
+        return "tag"
+    return "branch"
+
+
+def is_pinned_revision(revision: Optional[str]) -> bool:
+    """Return True if a revision always designates the same commit.
+
+    Pinned revisions are only fetched once.
+
+    :param revision: a git revision from specs/config/repositories.yaml
+    """
+    return classify_revision(revision) != "branch"
+
+
+def read_shallow(git_dir: str) -> Set[str]:
+    """Return the shallow commits of a repository.
+
+    :param git_dir: the repository git directory
+    :return: the commits whose parents are not available
+    """
+    try:
+        with open(os.path.join(git_dir, "shallow")) as f:
+            return set(f.read().split())
+    except FileNotFoundError:
+        return set()
+
+
+class RevisionIndex(object):
+    """Commits to which the pinned revisions of a sandbox were resolved.
+
+    The index is updated by successful checkouts. Since pinned revisions do
+    not move, a checkout whose revision is in the index, and whose working
+    tree is still at the recorded commit, does not need to be updated.
+
+    The index can be used from several threads.
+    """
+
+    def __init__(self, filename: str):
+        """Initialize a revision index.
+
+        :param filename: the file in which the index is stored. It is loaded
+            if it exists.
+        """
+        self.filename = filename
+        self.entries: Dict[str, str] = {}
+        self.modified = False
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fd:
+                    self.entries = json.load(fd)
+            except (OSError, ValueError):
+                logging.warning("ignoring invalid revision index %s", filename)
+
+    @staticmethod
+    def entry_key(url: str, revision: str) -> str:
+        return "%s@%s" % (url, revision)
+
+    def get(self, url: str, revision: Optional[str]) -> Optional[str]:
+        """Return the commit to which a pinned revision was resolved.
+
+        :param url: the repository URL
+        :param revision: the revision
+        :return: a commit hash or None if the revision is not pinned or has
+            not been resolved yet
+        """
+        if revision is None or not is_pinned_revision(revision):
+            return None
+        with self.lock:
+            return self.entries.get(self.entry_key(url, revision))
+
+    def record(self, url: str, revision: Optional[str], commit: str) -> None:
+        """Record the commit to which a revision was resolved.
+
+        Revisions that are not pinned are ignored.
+
+        :param url: the repository URL
+        :param revision: the revision
+        :param commit: the commit hash
+        """
+        if revision is None or not is_pinned_revision(revision):
+            return
+        key = self.entry_key(url, revision)
+        with self.lock:
+            if self.entries.get(key) != commit:
+                self.entries[key] = commit
+                self.modified = True
+
+    def save(self) -> None:
+        """Write the index to its file if it has been modified."""
+        with self.lock:
+            if not self.modified:
+                return
+            tmp_file: Optional[str] = None
+            try:
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=os.path.dirname(self.filename), suffix=".tmp"
+                )
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp_file, self.filename)
+                self.modified = False
+            except OSError:
+                logging.warning("cannot save revision index", exc_info=True)
+                if tmp_file is not None and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+
+def checkout_head(working_dir: str) -> Optional[str]:
+    """Return the commit checked out in a working tree, without running git.
+
+    :param working_dir: a checkout made by CheckoutManager
+    :return: the commit hash or None if HEAD is not detached (checkouts are
+        always detached) or cannot be read
+    """
+    try:
+        with open(os.path.join(working_dir, ".git", "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    return head if COMMIT_REVISION.match(head) else None
+
+
+class GitObjectCache(object):
+    """Bare repositories holding the git objects of checkouts.
+
+    Pinned revisions are fetched with depth 1 and only once. Other
+    revisions are fetched in full on each update. Fetched revisions are
+    stored under refs/anod/<revision> and objects are never pruned, since
+    checkouts borrowing them may still need them.
+    """
+
+    def __init__(self, root_dir: str):
+        """Initialize a git object cache.
+
+        :param root_dir: directory in which bare repositories are stored
+        """
+        self.root_dir = os.path.abspath(root_dir)
+
+    def repo_path(self, url: str) -> str:
+        """Return the path to the bare repository of a URL.
+
+        :param url: a repository URL
+        """
+        name = url.rstrip("/").rsplit("/", 1)[-1]
+        if name.endswith(".git"):
+            name = name[:-4]
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root_dir, "%s-%s.git" % (name, digest[:16]))
+
+    @staticmethod
+    def ref(revision: str) -> str:
+        """Return the ref under which a revision is stored in the cache.
+
+        :param revision: a git revision
+        """
+        return "refs/anod/%s" % revision
+
+    @contextmanager
+    def locked(self, url: str) -> Iterator[GitRepository]:
+        """Lock the bare repository of a URL, creating it if needed.
+
+        Concurrent builds in other sandboxes may update the same
+        repository.
+
+        :param url: a repository URL
+        :return: the locked repository
+        """
+        path = self.repo_path(url)
+        mkdir(self.root_dir)
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                repo = GitRepository(working_tree=path)
+                if not os.path.isfile(os.path.join(path, "HEAD")):
+                    mkdir(path)
+                    repo.git_cmd(["init", "--bare", "-q"])
+                    repo.git_cmd(["config", "gc.pruneExpire", "never"])
+                    repo.git_cmd(["config", "uploadpack.allowAnySHA1InWant", "true"])
+                yield repo
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fetch(self, url: str, revision: str) -> Tuple[str, str]:
+        """Make a revision available in the cache.
+
+        :param url: the repository URL
+        :param revision: the revision to fetch
+        :return: the path to the bare repository and the ref of the revision
+        :raise GitError: if the revision cannot be fetched
+        """
+        ref = self.ref(revision)
+        with self.locked(url) as repo:
+            pinned = is_pinned_revision(revision)
+            if pinned:
+                try:
+                    repo.git_cmd(["rev-parse", "-q", "--verify", ref + "^{commit}"])
+                    logging.debug("%s %s found in the git cache", url, revision)
+                    return repo.working_tree, ref
+                except GitError:
+                    pass
+            logging.debug("fetching %s %s into the git cache", url, revision)
+            repo.git_cmd(
+                [
+                    "fetch",
+                    "-q",
+                    "--no-tags",
+                    "--depth=1" if pinned else None,
+                    url,
+                    "+%s:%s" % (revision, ref),
+                ]
+            )
+        return repo.working_tree, ref
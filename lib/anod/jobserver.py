@@ -0,0 +1,194 @@
+"""GNU make jobserver shared by all the build jobs of an anod build."""
+
+from __future__ import annotations
+
+from e3.fs import mkdir, rm
+from e3.os.fs import chmod
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.sandbox import SandBox
+    from typing import Optional
+
+
+# Environment variable giving the path of the jobserver named pipe to the
+# make wrapper.
+JOBSERVER_ENV_VAR = "OPENUXAS_JOBSERVER"
+
+MAKE_WRAPPER = '''#!{python}
+"""Run make as a client of the anod jobserver, if there is one running."""
+
+import os
+import sys
+
+MAKE = {make!r}
+
+
+def strip_jobs_options(args):
+    """Remove -j options: they would make make ignore the jobserver."""
+    result = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+            if arg.isdigit():
+                continue
+        if arg in ("-j", "--jobs"):
+            skip_next = True
+        elif not arg.startswith(("-j", "--jobs=")):
+            result.append(arg)
+    return result
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    fifo = os.environ.get("{env_var}")
+    makeflags = os.environ.get("MAKEFLAGS", "")
+    if fifo and os.path.exists(fifo) and "--jobserver" not in makeflags:
+        fd = os.open(fifo, os.O_RDWR)
+        os.set_inheritable(fd, True)
+        args = strip_jobs_options(args)
+        os.environ["MAKEFLAGS"] = "-j --jobserver-auth=%d,%d %s" % (fd, fd, makeflags)
+    os.execv(MAKE, [MAKE] + args)
+'''
+
+
+class JobServer(object):
+    """Pool of job tokens limiting the number of concurrent build processes.
+
+    The pool is a named pipe holding one token per process allowed to run
+    and is shared using the GNU make jobserver protocol. Each build job takes
+    a token for the duration of its build: that is the implicit token of the
+    first make it launches. Additional make jobs, including those of
+    sub-makes and of makes launched by other build jobs, take their tokens
+    from the same pipe. The number of compilations running at a given time
+    thus never exceeds the size of the pool, whatever the number of build
+    jobs running.
+
+    make finds the pipe through a wrapper installed in the sandbox bin
+    directory, which is put first in PATH while the jobserver is running.
+    The wrapper drops -j options from its command line, as an explicit -j
+    would make make create its own pool, and falls back to running make
+    directly when no jobserver is running.
+
+    Build tools that do not support the protocol (e.g. b2 or gprbuild) are
+    run with a -j value matching the tokens they reserve from the pipe (see
+    Common.job_slots in specs/common.anod).
+    """
+
+    def __init__(self, jobs: int, sandbox: SandBox):
+        """Initialize a jobserver.
+
+        :param jobs: number of tokens in the pool
+        :param sandbox: the sandbox in which the wrapper is installed
+        """
+        self.jobs = jobs
+        self.sandbox = sandbox
+        self.fd: Optional[int] = None
+        self.tmp_dir: Optional[str] = None
+        self.saved_env: Optional[dict] = None
+
+    @property
+    def make_wrapper(self) -> str:
+        """Return the path to the make wrapper."""
+        return os.path.join(self.sandbox.bin_dir, "make")
+
+    def install_make_wrapper(self) -> bool:
+        """Install the make wrapper in the sandbox bin directory.
+
+        :return: False if make cannot be found
+        """
+        search_path = os.pathsep.join(
+            d
+            for d in os.environ.get("PATH", "").split(os.pathsep)
+            if os.path.abspath(d) != os.path.abspath(self.sandbox.bin_dir)
+        )
+        make = shutil.which("make", path=search_path)
+        if make is None:
+            return False
+
+        content = MAKE_WRAPPER.format(
+            python=sys.executable, make=make, env_var=JOBSERVER_ENV_VAR
+        )
+        if os.path.isfile(self.make_wrapper):
+            with open(self.make_wrapper) as fd:
+                if fd.read() == content:
+                    return True
+
+        mkdir(self.sandbox.bin_dir)
+        with open(self.make_wrapper, "w") as fd:
+            fd.write(content)
+        chmod("a+x", self.make_wrapper)
+        return True
+
+    def start(self) -> None:
+        """Create the token pool and make it visible to make."""
+        if not self.install_make_wrapper():
+            logging.warning("cannot find make: jobserver disabled")
+            return
+
+        self.tmp_dir = tempfile.mkdtemp(prefix="jobserver.", dir=self.sandbox.tmp_dir)
+        fifo = os.path.join(self.tmp_dir, "fifo")
+        os.mkfifo(fifo)
+        self.fd = os.open(fifo, os.O_RDWR)
+        os.write(self.fd, b"+" * self.jobs)
+
+        self.saved_env = {
+            k: os.environ.get(k) for k in (JOBSERVER_ENV_VAR, "PATH", "MAKEFLAGS")
+        }
+        os.environ[JOBSERVER_ENV_VAR] = fifo
+        os.environ["PATH"] = os.pathsep.join(
+            [self.sandbox.bin_dir, os.environ.get("PATH", "")]
+        )
+        os.environ.pop("MAKEFLAGS", None)
+        logging.debug("jobserver started with %s tokens", self.jobs)
+
+    def stop(self) -> None:
+        """Destroy the token pool."""
+        if self.fd is None:
+            return
+
+        os.close(self.fd)
+        self.fd = None
+        if self.tmp_dir is not None:
+            rm(self.tmp_dir, recursive=True)
+            self.tmp_dir = None
+        if self.saved_env is not None:
+            for k, v in self.saved_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+            self.saved_env = None
+
+    def acquire(self) -> Optional[bytes]:
+        """Take a token from the pool, waiting for one to be available.
+
+        :return: the token, to be given back to release, or None if the
+            jobserver is not running
+        """
+        if self.fd is None:
+            return None
+        return os.read(self.fd, 1)
+
+    def release(self, token: Optional[bytes]) -> None:
+        """Give back a token taken with acquire.
+
+        :param token: the token returned by acquire
+        """
+        if token is not None and self.fd is not None:
+            os.write(self.fd, token)
+
+    def __enter__(self) -> JobServer:
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
@@ -0,0 +1,264 @@
+"""Incremental synchronization of source trees based on file manifests."""
+
+from __future__ import annotations
+
+from e3 import hash
+from e3.fs import mkdir, rm
+
+from fnmatch import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import (
+        Dict,
+        Iterable,
+        Iterator,
+        List,
+        Optional,
+        Sequence,
+        Set,
+        Tuple,
+    )
+
+    # (size, modification time in ns, mode, sha256 or symlink target)
+    ManifestEntry = Tuple[int, int, int, str]
+
+
+class IgnoreList(object):
+    """Paths excluded from a synchronization.
+
+    Patterns follow the conventions of e3.fs.sync_tree: patterns starting
+    with / are paths relative to the root of the tree, other patterns are
+    matched against file and directory names.
+    """
+
+    def __init__(self, patterns: Optional[Iterable[str]] = None):
+        """Initialize an ignore list.
+
+        :param patterns: the patterns
+        """
+        self.paths: Set[str] = set()
+        self.names: List[str] = []
+        for pattern in patterns or ():
+            if pattern.startswith("/"):
+                self.paths.add(pattern.rstrip("/"))
+            else:
+                self.names.append(pattern)
+
+    def __contains__(self, rel_path: str) -> bool:
+        if "/" + rel_path in self.paths:
+            return True
+        name = os.path.basename(rel_path)
+        return any(fnmatch(name, pattern) for pattern in self.names)
+
+
+class FileManifest(object):
+    """Content of a synchronized tree, as of its last synchronization.
+
+    For each file the manifest records its size, modification time, mode and
+    digest. A file whose size and modification time did not change since
+    the last synchronization is neither read nor copied again.
+    """
+
+    def __init__(self, filename: str):
+        """Initialize a manifest.
+
+        :param filename: the file in which the manifest is stored. It is
+            loaded if it exists.
+        """
+        self.filename = filename
+        self.entries: Dict[str, ManifestEntry] = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fd:
+                    self.entries = {
+                        path: tuple(entry) for path, entry in json.load(fd).items()
+                    }
+            except (OSError, ValueError):
+                logging.warning("ignoring invalid manifest %s", filename)
+
+    def save(self) -> None:
+        """Write the manifest to its file."""
+        mkdir(os.path.dirname(self.filename))
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.filename)
+        except OSError:
+            rm(tmp_file)
+            raise
+
+    def state(self) -> str:
+        """Return a digest of the tree content.
+
+        It only depends on the paths, modes and contents of the files, not
+        on their modification times.
+        """
+        result = hashlib.sha256()
+        for path in sorted(self.entries):
+            _, _, mode, digest = self.entries[path]
+            result.update(("%s:%o:%s\n" % (path, mode, digest)).encode("utf-8"))
+        return result.hexdigest()
+
+
+def walk_tree(
+    root_dir: str, ignore: IgnoreList
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield the directories, files and symbolic links of a tree.
+
+    Directories are yielded before their content.
+
+    :param root_dir: the tree root directory
+    :param ignore: the paths to skip
+    :return: an iterator over (relative path, status) pairs
+    """
+    for root, dirs, files in os.walk(root_dir):
+        rel_root = os.path.relpath(root, root_dir)
+        if rel_root == ".":
+            rel_root = ""
+        kept_dirs = []
+        for name in dirs:
+            rel_path = os.path.join(rel_root, name)
+            if rel_path in ignore:
+                continue
+            st = os.lstat(os.path.join(root, name))
+            yield rel_path, st
+            # Symbolic links to directories are synchronized as links
+            if stat.S_ISDIR(st.st_mode):
+                kept_dirs.append(name)
+        dirs[:] = kept_dirs
+        for name in files:
+            rel_path = os.path.join(rel_root, name)
+            if rel_path not in ignore:
+                yield rel_path, os.lstat(os.path.join(root, name))
+
+
+def parent_dirs(rel_path: str) -> List[str]:
+    """Return the parent directories of a relative path.
+
+    :param rel_path: a relative path
+    """
+    result = []
+    parent = os.path.dirname(rel_path)
+    while parent:
+        result.append(parent)
+        parent = os.path.dirname(parent)
+    return result
+
+
+def is_up_to_date(dest: str, entry: ManifestEntry) -> bool:
+    """Return True if a file of the destination tree matches its entry.
+
+    :param dest: the file path
+    :param entry: the manifest entry of the source file
+    """
+    try:
+        st = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(entry[2]):
+        return False
+    if stat.S_ISDIR(st.st_mode):
+        return True
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(dest) == entry[3]
+    return (st.st_size, st.st_mtime_ns, st.st_mode) == entry[:3]
+
+
+def sync_with_manifest(
+    src_dir: str,
+    dest_dir: str,
+    manifest_file: str,
+    ignore: Optional[Sequence[str]] = None,
+    clean: bool = False,
+) -> Tuple[FileManifest, List[str], List[str]]:
+    """Synchronize a tree, only copying the files that changed.
+
+    Modification times are preserved, so that the files that did not change
+    are not rebuilt by make-like tools. The destination tree is assumed to
+    be only modified by this function: its files are checked with a single
+    stat call and are only written if they are missing or have a different
+    size or modification time. Source files are only read when their size
+    or modification time changed since the previous synchronization.
+
+    :param src_dir: the directory to synchronize
+    :param dest_dir: the directory to update
+    :param manifest_file: the file in which the content of dest_dir is
+        recorded between synchronizations
+    :param ignore: see IgnoreList
+    :param clean: if True and dest_dir has no manifest yet (e.g. it was
+        created by another synchronization method), remove the files of
+        dest_dir that are not in src_dir. Otherwise only the files that were
+        synchronized and are no longer in src_dir are removed.
+    :return: the updated manifest, the paths updated in dest_dir and the
+        paths removed from dest_dir
+    """
+    manifest = FileManifest(manifest_file)
+    clean = clean and not manifest.entries
+    ignore_list = IgnoreList(ignore)
+    entries: Dict[str, ManifestEntry] = {}
+    updated = []
+
+    mkdir(dest_dir)
+    for rel_path, st in walk_tree(src_dir, ignore_list):
+        src = os.path.join(src_dir, rel_path)
+        dest = os.path.join(dest_dir, rel_path)
+        previous = manifest.entries.get(rel_path)
+
+        if stat.S_ISDIR(st.st_mode):
+            entry: ManifestEntry = (0, 0, stat.S_IFDIR, "")
+        elif stat.S_ISLNK(st.st_mode):
+            entry = (0, 0, stat.S_IFLNK, os.readlink(src))
+        elif previous is not None and previous[:3] == (
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_mode,
+        ):
+            entry = previous
+        else:
+            entry = (st.st_size, st.st_mtime_ns, st.st_mode, hash.sha256(src))
+        entries[rel_path] = entry
+
+        if is_up_to_date(dest, entry):
+            continue
+        if os.path.lexists(dest):
+            rm(dest, recursive=True)
+        if stat.S_ISDIR(entry[2]):
+            mkdir(dest)
+        elif stat.S_ISLNK(entry[2]):
+            os.symlink(entry[3], dest)
+        else:
+            shutil.copy2(src, dest)
+        updated.append(rel_path)
+
+    # Remove what is no longer in the source tree. Files that were never
+    # part of the manifest (e.g. build products) are kept.
+    removed = sorted(set(manifest.entries) - set(entries), reverse=True)
+    for rel_path in removed:
+        path = os.path.join(dest_dir, rel_path)
+        if os.path.lexists(path):
+            rm(path, recursive=True)
+
+    if clean:
+        # Ignored paths are neither synchronized nor removed
+        for rel_path, _ in list(walk_tree(dest_dir, ignore_list)):
+            if rel_path not in entries and not any(
+                parent in removed for parent in parent_dirs(rel_path)
+            ):
+                rm(os.path.join(dest_dir, rel_path), recursive=True)
+                removed.append(rel_path)
+
+    manifest.entries = entries
+    manifest.save()
+    return manifest, updated, removed
@@ -0,0 +1,274 @@
+"""Collection of per-action metrics during an anod build."""
+
+from __future__ import annotations
+
+from e3.fs import mkdir
+
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional
+
+
+class ActionMetrics(object):
+    """Metrics of a single action."""
+
+    def __init__(self, uid: str, kind: str):
+        """Initialize the metrics of an action.
+
+        :param uid: the action uid
+        :param kind: the kind of action (e.g. the job class name)
+        """
+        self.uid = uid
+        self.kind = kind
+        self.status: Optional[str] = None
+        self.slot: Optional[int] = None
+        # Times are in seconds since the epoch
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        # CPU times in seconds, peak RSS in kilobytes
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.max_rss = 0
+        self.bytes_downloaded = 0
+        self.bytes_unpacked = 0
+        # True if the result of the action was restored from a cache rather
+        # than computed
+        self.restored = False
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Return the wall clock duration of the action in seconds."""
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the metrics as a JSON serializable dict."""
+        return {
+            "uid": self.uid,
+            "kind": self.kind,
+            "status": self.status,
+            "slot": self.slot,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "cpu_user": self.cpu_user,
+            "cpu_system": self.cpu_system,
+            "max_rss": self.max_rss,
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_unpacked": self.bytes_unpacked,
+            "restored": self.restored,
+        }
+
+
+class BuildMetrics(object):
+    """Metrics of all the actions executed by an anod build.
+
+    Metrics are recorded by the jobs, which run in separate threads. At the
+    end of the build they are written to two files: a JSON file listing the
+    metrics of each action and a trace file in the Chrome trace event format,
+    which can be loaded in chrome://tracing or https://ui.perfetto.dev to
+    display the actions run by each scheduler slot over time.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the metrics of a build."""
+        self.start = time.time()
+        self.actions: Dict[str, ActionMetrics] = {}
+        # Build-wide figures (e.g. compiler cache statistics), indexed by
+        # subsystem name
+        self.summary: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def get(self, uid: str, kind: str = "") -> ActionMetrics:
+        """Return the metrics of an action, creating them if needed.
+
+        :param uid: the action uid
+        :param kind: the kind of action
+        """
+        with self.lock:
+            if uid not in self.actions:
+                self.actions[uid] = ActionMetrics(uid, kind)
+            return self.actions[uid]
+
+    def record_start(self, uid: str, kind: str) -> None:
+        """Record the start of an action.
+
+        :param uid: the action uid
+        :param kind: the kind of action
+        """
+        self.get(uid, kind).start = time.time()
+
+    def record_end(self, uid: str, status: str, slot: Optional[int]) -> None:
+        """Record the end of an action.
+
+        :param uid: the action uid
+        :param status: the final status of the action
+        :param slot: the scheduler slot in which the action ran
+        """
+        metrics = self.get(uid)
+        metrics.end = time.time()
+        metrics.status = status
+        metrics.slot = slot
+
+    def trace_events(self) -> List[Dict[str, Any]]:
+        """Return the actions as Chrome trace events."""
+        events: List[Dict[str, Any]] = []
+        slots = set()
+        for metrics in self.actions.values():
+            if metrics.start is None or metrics.end is None:
+                continue
+            slot = metrics.slot if metrics.slot is not None else 0
+            slots.add(slot)
+            events.append(
+                {
+                    "name": metrics.uid,
+                    "cat": metrics.kind,
+                    "ph": "X",
+                    "ts": int((metrics.start - self.start) * 1e6),
+                    "dur": int((metrics.end - metrics.start) * 1e6),
+                    "pid": 1,
+                    "tid": slot,
+                    "args": {
+                        k: v
+                        for k, v in metrics.as_dict().items()
+                        if k not in ("uid", "kind", "start", "end", "slot")
+                    },
+                }
+            )
+        for slot in sorted(slots):
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": slot,
+                    "args": {"name": "slot %s" % slot},
+                }
+            )
+        return events
+
+    def write(self, log_dir: str) -> Optional[str]:
+        """Write the metrics and the trace of the build.
+
+        :param log_dir: directory in which files are created
+        :return: the path to the metrics file, or None if it cannot be written
+        """
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.start))
+        metrics_file = os.path.join(log_dir, "build-metrics-%s.json" % timestamp)
+        trace_file = os.path.join(log_dir, "build-trace-%s.json" % timestamp)
+        with self.lock:
+            actions = sorted(
+                self.actions.values(),
+                key=lambda m: m.start if m.start is not None else self.start,
+            )
+            try:
+                mkdir(log_dir)
+                with open(metrics_file, "w") as fd:
+                    json.dump(
+                        {
+                            "start": self.start,
+                            "end": time.time(),
+                            "actions": [m.as_dict() for m in actions],
+                            "summary": self.summary,
+                        },
+                        fd,
+                        indent=2,
+                    )
+                with open(trace_file, "w") as fd:
+                    json.dump(
+                        {"traceEvents": self.trace_events(), "displayTimeUnit": "ms"},
+                        fd,
+                    )
+            except OSError:
+                logging.warning("cannot write build metrics", exc_info=True)
+                return None
+        return metrics_file
+
+
+def tree_size(path: str) -> int:
+    """Return the total size of the files in a directory.
+
+    :param path: a directory
+    :return: a size in bytes (symbolic links are not followed)
+    """
+    result = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                result += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return result
+
+
+class DurationHistory(object):
+    """Durations of the actions executed by previous builds.
+
+    The history is stored in a JSON file mapping action uids to durations in
+    seconds. The recorded duration is a moving average of the durations of
+    the successful executions of the action (skipped actions and results
+    restored from a cache are ignored).
+    """
+
+    # Weight of the last execution in the recorded duration
+    SMOOTHING = 0.5
+
+    def __init__(self, filename: str):
+        """Initialize a duration history.
+
+        :param filename: the file in which the history is stored. It is
+            loaded if it exists.
+        """
+        self.filename = filename
+        self.durations: Dict[str, float] = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fd:
+                    self.durations = json.load(fd)
+            except (OSError, ValueError):
+                logging.warning("ignoring invalid duration history %s", filename)
+
+    def get(self, uid: str) -> Optional[float]:
+        """Return the expected duration of an action.
+
+        :param uid: the action uid
+        :return: a duration in seconds or None if the action was never run
+        """
+        return self.durations.get(uid)
+
+    def update(self, metrics: BuildMetrics) -> None:
+        """Update the history with the actions of a build.
+
+        :param metrics: the metrics of the build
+        """
+        for action in metrics.actions.values():
+            duration = action.duration
+            if action.status not in ("success", "unchanged") or duration is None:
+                continue
+            if action.restored:
+                continue
+            previous = self.durations.get(action.uid)
+            if previous is None:
+                self.durations[action.uid] = duration
+            else:
+                self.durations[action.uid] = (
+                    self.SMOOTHING * duration + (1 - self.SMOOTHING) * previous
+                )
+
+    def save(self) -> None:
+        """Write the history to its file."""
+        try:
+            mkdir(os.path.dirname(self.filename))
+            with open(self.filename + ".tmp", "w") as fd:
+                json.dump(self.durations, fd, indent=2, sort_keys=True)
+            os.replace(self.filename + ".tmp", self.filename)
+        except OSError:
+            logging.warning("cannot save duration history", exc_info=True)
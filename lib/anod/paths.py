@@ -18,3 +18,9 @@ SBX_DIR = os.path.join(
     REPO_DIR,
     "sbx",
 )
+
+# Caches shared by all the sandboxes
+CACHE_DIR = os.path.join(
+    REPO_DIR,
+    "cache",
+)
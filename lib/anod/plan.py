@@ -0,0 +1,183 @@
+"""Prediction of what anod build would do (anod build --plan).
+
+The scheduled DAG is walked in dependency order, computing the fingerprint
+of each action as UxasBuilder does before executing it (see
+lib.anod.build.ActionFingerprints). As the fingerprint
+of an executed action does not depend on its execution (except for
+checkouts), the predictions of all the actions can be chained without
+executing anything.
+"""
+
+from __future__ import annotations
+
+from e3.anod.action import Build, Checkout, Root
+
+from lib.anod.build import ActionFingerprints, AnodFilesDigests, UxasBuilder
+from lib.anod.digest import DigestIndex
+from lib.anod.fingerprints import FingerprintStore
+from lib.anod.gitcache import RevisionIndex
+from lib.anod.metrics import DurationHistory
+
+import os
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.sandbox import SandBox
+    from e3.collection.dag import DAG
+    from e3.fingerprint import Fingerprint
+    from lib.anod.cache import ArtifactCache
+    from typing import Any, Dict, List, Optional
+
+
+# Decisions of the actions of a plan
+SKIP = "skip"
+RUN = "run"
+UNKNOWN = "unknown"
+
+
+class UxasPlanner(object):
+    """Plan of a build, computed without executing any action.
+
+    The fingerprints are computed as by UxasBuilder, but nothing is executed
+    and no fingerprint is recorded.
+    """
+
+    def __init__(
+        self,
+        actions: DAG,
+        sandbox: SandBox,
+        force: bool,
+        artifact_cache: Optional[ArtifactCache] = None,
+        paranoid: bool = False,
+    ):
+        """Initialize a planner.
+
+        :param actions: the DAG of actions to perform
+        :param sandbox: the build sandbox
+        :param force: True if everything is rebuilt (anod build --force)
+        :param artifact_cache: the artifact cache used by the build, if any
+        :param paranoid: see UxasBuilder
+        """
+        self.actions = actions
+        self.force = force
+        self.artifact_cache = artifact_cache
+        self.new_fingerprints: Dict[str, Optional[Fingerprint]] = {}
+        self.fingerprint_store = FingerprintStore.for_sandbox(sandbox, read_only=True)
+        self.durations = DurationHistory(
+            os.path.join(sandbox.meta_dir, "durations.json")
+        )
+        self.fingerprints = ActionFingerprints(
+            actions,
+            sandbox,
+            AnodFilesDigests(
+                DigestIndex(
+                    os.path.join(sandbox.meta_dir, "digests.json"), paranoid=paranoid
+                )
+            ),
+            RevisionIndex(os.path.join(sandbox.meta_dir, "revisions.json")),
+            artifact_cache=artifact_cache,
+        )
+
+    def expected_duration(self, uid: str, data: Any) -> float:
+        """Return the expected duration of an action.
+
+        :param uid: the action uid
+        :param data: the action
+        :return: a duration in seconds (see UxasBuilder.expected_duration)
+        """
+        duration = self.durations.get(uid)
+        if duration is None:
+            duration = UxasBuilder.DEFAULT_DURATIONS.get(data.__class__, 0.0)
+        return duration
+
+    def plan(self) -> List[Dict[str, Any]]:
+        """Return the actions of the build, in dependency order.
+
+        :return: for each action its uid, description, decision (skip, run
+            or unknown when it depends on the result of a checkout), the
+            reason of the decision and its expected duration in seconds
+        """
+        result = []
+        for vertex_id, data in self.actions:
+            if isinstance(data, Root):
+                continue
+            uid = str(vertex_id)
+            previous = self.fingerprint_store.get(uid)
+            new = None
+            if not self.force:
+                new = self.fingerprints.compute(
+                    uid, data, self.new_fingerprints, is_prediction=True
+                )
+            self.new_fingerprints[uid] = new
+
+            if self.force:
+                decision, reason = RUN, "forced"
+            elif previous is None:
+                decision, reason = RUN, "never built"
+            elif new is None and isinstance(data, Checkout):
+                decision, reason = UNKNOWN, "revision not known in advance"
+            elif new is None:
+                # The fingerprint of a predecessor is only known once it
+                # has been executed
+                decision, reason = UNKNOWN, "depends on " + ", ".join(
+                    str(pred_uid)
+                    for pred_uid in self.actions.get_predecessors(uid)
+                    if self.new_fingerprints.get(str(pred_uid)) is None
+                )
+            elif new != previous:
+                decision, reason = RUN, "changed"
+                diff = previous.compare_to(new)
+                if diff is not None:
+                    reason += ": " + " ".join(
+                        ["(M)%s" % el for el in diff["updated"]]
+                        + ["(+)%s" % el for el in diff["new"]]
+                        + ["(-)%s" % el for el in diff["obsolete"]]
+                    )
+            else:
+                decision, reason = SKIP, "up to date"
+
+            duration = self.expected_duration(uid, data)
+            if decision == SKIP:
+                duration = 0.0
+            elif isinstance(data, Build) and self.artifact_cache is not None:
+                key = self.fingerprints.artifact_cache_key(uid, new)
+                if key is not None and key in self.artifact_cache:
+                    reason += ", restored from the artifact cache"
+                    duration = 0.0
+
+            result.append(
+                {
+                    "uid": uid,
+                    "action": str(data),
+                    "decision": decision,
+                    "reason": reason,
+                    "duration": round(duration, 1),
+                }
+            )
+        return result
+
+    def summary(self, plan: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Return the totals of a plan.
+
+        :param plan: a plan returned by plan
+        :return: the number of actions of each decision, the expected total
+            duration of the actions and the expected duration of the
+            longest chain of dependent actions, i.e. of the build when
+            enough cores are available (in seconds)
+        """
+        result: Dict[str, Any] = {SKIP: 0, RUN: 0, UNKNOWN: 0}
+        end: Dict[str, float] = {}
+        for entry in plan:
+            result[entry["decision"]] += 1
+            end[entry["uid"]] = entry["duration"] + max(
+                (
+                    end[pred_uid]
+                    for pred_uid in self.actions.get_predecessors(entry["uid"])
+                    if pred_uid in end
+                ),
+                default=0.0,
+            )
+        result["duration"] = round(sum(entry["duration"] for entry in plan), 1)
+        result["critical_path"] = round(max(end.values(), default=0.0), 1)
+        return result
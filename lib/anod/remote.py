@@ -0,0 +1,606 @@
+"""Remote execution of Build actions.
+
+anod worker runs a daemon performing Build actions on behalf of anod build
+--worker HOST:PORT, the coordinator. The coordinator still performs the
+checkouts, downloads and source installations, then sends each Build action
+to a worker along with its installed sources and the install trees of the
+Build actions it depends on. The worker builds in its own sandbox and sends
+back the build output, as it is produced, and the resulting install tree.
+
+Workers and coordinator must use the same specs, tools and platform: this
+is checked for each action. Install trees are transferred in the artifact
+cache format (see lib.anod.cache) and workers keep the ones they receive or
+produce in their own artifact cache, so that a dependency is sent at most
+once to each worker. A worker can serve a single coordinator at a time.
+
+There is no authentication: workers should only listen on trusted networks.
+
+Messages are JSON lines, each optionally followed by a binary payload whose
+size is given by the "size" key of the message.
+"""
+
+from __future__ import annotations
+
+from e3.env import Env
+from e3.fs import mkdir, rm
+
+from lib.anod.cache import ArtifactCache
+from lib.anod.runner import build_request, start_build, wait_build
+
+from contextlib import closing
+import codecs
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.sandbox import SandBox
+    from io import BufferedIOBase
+    from lib.anod.jobserver import JobServer
+    from typing import Any, Dict, List, Optional, Tuple
+
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 7643
+CONNECT_TIMEOUT = 10
+CHUNK_SIZE = 1024 * 1024
+
+# Environment variables that must have the same value on the coordinator
+# and on the workers (the tool versions, set by check_common_tools).
+CHECKED_ENV = ("OPENUXAS_COMPILER_VERSION", "OPENUXAS_CMAKE_VERSION")
+
+# Environment variables of the coordinator used by the workers' builds
+FORWARDED_ENV = ("OPENUXAS_CMAKE_GENERATOR",)
+
+
+class RemoteError(Exception):
+    """Error reported by a worker or caused by an invalid message."""
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Parse a worker address.
+
+    :param address: HOST or HOST:PORT
+    :return: the host and the port
+    """
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+
+def send_message(
+    stream: BufferedIOBase, message: Dict[str, Any], payload: Optional[str] = None
+) -> None:
+    """Send a message.
+
+    :param stream: the connection stream
+    :param message: a JSON serializable dict
+    :param payload: a file whose content is sent after the message
+    """
+    if payload is not None:
+        message = dict(message, size=os.path.getsize(payload))
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    if payload is not None:
+        with open(payload, "rb") as fd:
+            shutil.copyfileobj(fd, stream, CHUNK_SIZE)
+    stream.flush()
+
+
+def receive_message(
+    stream: BufferedIOBase, payload: Optional[str] = None
+) -> Dict[str, Any]:
+    """Receive a message sent with send_message.
+
+    :param stream: the connection stream
+    :param payload: the file in which the payload of the message, if any,
+        is written. The payload is discarded when None.
+    :return: the message
+    :raise RemoteError: if the connection is closed or the message is
+        invalid
+    """
+    line = stream.readline()
+    if not line.endswith(b"\n"):
+        raise RemoteError("connection closed")
+    try:
+        message = json.loads(line.decode("utf-8"))
+    except ValueError as e:
+        raise RemoteError("invalid message: %s" % e) from e
+
+    size = message.get("size", 0)
+    fd = open(payload, "wb") if payload is not None else None
+    try:
+        while size > 0:
+            data = stream.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise RemoteError("connection closed")
+            if fd is not None:
+                fd.write(data)
+            size -= len(data)
+    finally:
+        if fd is not None:
+            fd.close()
+    return message
+
+
+def pack_tree(root_dir: str, filename: str) -> None:
+    """Pack a directory.
+
+    :param root_dir: the directory
+    :param filename: the archive to create
+    """
+    # Compression is kept low: archives are sent once, on a local network
+    with tarfile.open(filename, mode="w:gz", compresslevel=1) as tar:
+        tar.add(root_dir, arcname=".")
+
+
+def unpack_tree(filename: str, root_dir: str) -> None:
+    """Unpack an archive created by pack_tree.
+
+    :param filename: the archive
+    :param root_dir: the directory in which the archive is unpacked
+    """
+    with tarfile.open(filename, mode="r:gz") as tar:
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(root_dir, filter="tar")
+        else:
+            tar.extractall(root_dir)
+
+
+def send_entry(stream: BufferedIOBase, cache: ArtifactCache, key: str) -> None:
+    """Send an artifact cache entry.
+
+    :param stream: the connection stream
+    :param cache: the cache containing the entry
+    :param key: the entry key
+    """
+    send_message(
+        stream,
+        {"key": key, "metadata": cache.load_metadata(key)},
+        payload=cache.archive_path(key),
+    )
+
+
+def receive_entry(stream: BufferedIOBase, cache: ArtifactCache, key: str) -> None:
+    """Receive an entry sent with send_entry and add it to a cache.
+
+    :param stream: the connection stream
+    :param cache: the cache to which the entry is added
+    :param key: the key under which the entry is added
+    """
+    archive = cache.tmp_file(key)
+    metadata_file = cache.tmp_file(key)
+    try:
+        message = receive_message(stream, payload=archive)
+        with open(metadata_file, "w") as f:
+            json.dump(message["metadata"], f)
+        cache.add(key, metadata_file, archive)
+    finally:
+        rm(archive)
+        rm(metadata_file)
+
+
+class Worker(object):
+    """A worker, as seen by the coordinator."""
+
+    def __init__(self, address: str):
+        """Initialize a worker.
+
+        :param address: HOST or HOST:PORT
+        """
+        self.address = parse_address(address)
+        # Number of builds the worker can run at the same time
+        self.cores = 0
+        # Number of builds currently sent to the worker
+        self.running = 0
+
+    def __str__(self) -> str:
+        return "%s:%d" % self.address
+
+    def connect(self) -> socket.socket:
+        """Open a connection to the worker."""
+        sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        return sock
+
+    def hello(self) -> None:
+        """Check that the worker can be used and get its number of cores.
+
+        :raise RemoteError: if the worker cannot be used
+        """
+        with closing(self.connect()) as sock, sock.makefile("rwb") as stream:
+            send_message(stream, {"command": "hello"})
+            reply = receive_message(stream)
+        if reply.get("version") != PROTOCOL_VERSION:
+            raise RemoteError("protocol version mismatch")
+        if reply.get("platform") != Env().platform:
+            raise RemoteError("worker platform is %s" % reply.get("platform"))
+        self.cores = reply["cores"]
+
+    def build(
+        self,
+        request: Dict[str, Any],
+        entries: Dict[str, ArtifactCache],
+        src_dir: str,
+        result_cache: ArtifactCache,
+        tmp_dir: str,
+    ) -> bool:
+        """Perform a Build action on the worker.
+
+        :param request: the action (see UxasRemoteBuildJob.request)
+        :param entries: the artifact caches containing the install trees of
+            the dependencies, by key
+        :param src_dir: the installed sources of the action
+        :param result_cache: the cache to which the resulting install tree
+            is added, under request["key"]
+        :param tmp_dir: directory in which temporary files are created
+        :return: True if the build succeeded
+        :raise RemoteError: if the worker cannot perform the action
+        """
+        with closing(self.connect()) as sock, sock.makefile("rwb") as stream:
+            send_message(stream, dict(request, command="build"))
+            reply = receive_message(stream)
+            if "error" in reply:
+                raise RemoteError(reply["error"])
+
+            for key in reply["missing"]:
+                send_entry(stream, entries[key], key)
+
+            fd, sources = tempfile.mkstemp(dir=tmp_dir, suffix=".tar.gz")
+            os.close(fd)
+            try:
+                pack_tree(src_dir, sources)
+                send_message(stream, {"sources": True}, payload=sources)
+            finally:
+                rm(sources)
+
+            while True:
+                # The build output comes first, then the status and, on success,
+                # the resulting install tree
+                reply = receive_message(stream)
+                if "output" not in reply:
+                    break
+                sys.stdout.write(reply["output"])
+                sys.stdout.flush()
+
+            if "error" in reply:
+                raise RemoteError(reply["error"])
+            if reply["status"] != "success":
+                return False
+            receive_entry(stream, result_cache, request["key"])
+            return True
+
+
+class WorkerPool(object):
+    """The workers of a coordinator.
+
+    Each worker runs as many builds at the same time as it has cores. Builds
+    go to the least loaded worker, relative to its number of cores.
+    """
+
+    def __init__(self, addresses: List[str]):
+        """Initialize a pool, leaving out the workers that cannot be used.
+
+        :param addresses: the worker addresses (see Worker)
+        """
+        self.workers: List[Worker] = []
+        self.condition = threading.Condition()
+        for address in addresses:
+            worker = Worker(address)
+            try:
+                worker.hello()
+            except (OSError, RemoteError) as e:
+                logging.warning("worker %s cannot be used: %s", worker, e)
+                continue
+            logging.info("worker %s: %d cores", worker, worker.cores)
+            self.workers.append(worker)
+
+    @property
+    def slots(self) -> int:
+        """Return the number of builds the workers can run at the same time."""
+        return sum(worker.cores for worker in self.workers)
+
+    def acquire(self) -> Worker:
+        """Return a worker able to run one more build, waiting if needed.
+
+        The worker must be given back with release.
+        """
+        with self.condition:
+            while True:
+                available = [w for w in self.workers if w.running < w.cores]
+                if available:
+                    worker = min(available, key=lambda w: w.running / w.cores)
+                    worker.running += 1
+                    return worker
+                self.condition.wait()
+
+    def release(self, worker: Worker) -> None:
+        """Give back a worker returned by acquire.
+
+        :param worker: the worker
+        """
+        with self.condition:
+            worker.running -= 1
+            self.condition.notify()
+
+
+class WorkerServer(object):
+    """Daemon performing the Build actions sent by a coordinator."""
+
+    # Install trees restored from the artifact cache are marked with the key
+    # of their entry, so that they are not restored again
+    KEY_FILE = "remote_key"
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        sandbox: SandBox,
+        spec_dir: str,
+        artifact_cache: ArtifactCache,
+        jobserver: JobServer,
+        jobs: int,
+    ):
+        """Initialize a worker daemon.
+
+        :param address: the host and port to listen on
+        :param sandbox: the sandbox in which actions are performed
+        :param spec_dir: the spec directory
+        :param artifact_cache: cache keeping the install trees received
+            from the coordinator and the ones built
+        :param jobserver: the jobserver shared by the builds
+        :param jobs: number of builds run at the same time
+        """
+        self.address = address
+        self.sandbox = sandbox
+        self.spec_dir = spec_dir
+        self.artifact_cache = artifact_cache
+        self.jobserver = jobserver
+        self.jobs = jobs
+        self.context_lock = threading.Lock()
+        self.build_space_locks: Dict[str, threading.Lock] = {}
+
+    def serve(self) -> int:
+        """Accept connections until interrupted."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(16)
+        logging.info("worker listening on %s:%d", *listener.getsockname()[:2])
+        try:
+            while True:
+                conn, peer = listener.accept()
+                threading.Thread(
+                    target=self.handle_connection, args=(conn, peer), daemon=True
+                ).start()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            listener.close()
+
+    def handle_connection(self, conn: socket.socket, peer: Tuple[str, int]) -> None:
+        """Handle a connection from a coordinator.
+
+        :param conn: the connection
+        :param peer: the address of the coordinator
+        """
+        try:
+            with closing(conn), conn.makefile("rwb") as stream:
+                request = receive_message(stream)
+                if request.get("command") == "hello":
+                    send_message(
+                        stream,
+                        {
+                            "version": PROTOCOL_VERSION,
+                            "platform": Env().platform,
+                            "cores": self.jobs,
+                        },
+                    )
+                elif request.get("command") == "build":
+                    logging.info("building %s for %s", request["uid"], peer[0])
+                    try:
+                        self.build(stream, request)
+                    except RemoteError as e:
+                        logging.error("%s: %s", request["uid"], e)
+                        send_message(stream, {"error": str(e)})
+                    except Exception as e:
+                        logging.exception("cannot build %s", request["uid"])
+                        send_message(stream, {"error": "worker error: %s" % e})
+        except (OSError, RemoteError):
+            logging.warning("connection with %s lost", peer[0], exc_info=True)
+        except Exception:
+            logging.exception("error while handling a request from %s", peer[0])
+
+    def build_space_lock(self, name: str) -> threading.Lock:
+        """Return the lock of a build space.
+
+        :param name: the build space name
+        """
+        with self.context_lock:
+            return self.build_space_locks.setdefault(name, threading.Lock())
+
+    def load_actions(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the Build actions needed to perform a request.
+
+        :param request: a build request
+        :return: the Build actions of the requested spec and of its
+            dependencies, by build space name
+        :raise RemoteError: if the specs or tools differ from the
+            coordinator ones
+        """
+        # Loaded here: specs are only loaded by workers receiving requests
+        from e3.anod.action import Build
+        from e3.env import BaseEnv
+        from lib.anod.build import AnodFilesDigests
+        from lib.anod.digest import DigestIndex
+        from lib.anod.util import create_anod_context
+
+        if request.get("version") != PROTOCOL_VERSION:
+            raise RemoteError("protocol version mismatch")
+        for var in CHECKED_ENV:
+            if request["env"].get(var) != os.environ.get(var):
+                raise RemoteError(
+                    "%s differs: %s on the worker" % (var, os.environ.get(var))
+                )
+
+        with self.context_lock:
+            ac = create_anod_context(self.spec_dir)
+            ac.add_anod_action(
+                name=request["spec_name"],
+                primitive="build",
+                qualifier=request["qualifier"],
+                sandbox=self.sandbox,
+                upload=False,
+                env=BaseEnv.from_env(),
+            )
+            actions = ac.schedule(resolver=ac.always_create_source_resolver)
+
+        result = {
+            data.anod_instance.build_space_name: data
+            for _, data in actions
+            if isinstance(data, Build)
+        }
+        target = result.get(request["build_space_name"])
+        if target is None:
+            raise RemoteError("no build space %s" % request["build_space_name"])
+        anod_files = AnodFilesDigests(
+            DigestIndex(os.path.join(self.sandbox.meta_dir, "digests.json"))
+        )
+        if [list(f) for f in anod_files.get(target.anod_instance)] != request[
+            "anod_files"
+        ]:
+            raise RemoteError("the specs of the worker differ")
+        return result
+
+    def restore(self, data: Any, key: str) -> None:
+        """Restore the install tree of a dependency.
+
+        :param data: the Build action of the dependency
+        :param key: the artifact cache key of the install tree
+        """
+        build_space = data.anod_instance.build_space
+        key_file = os.path.join(build_space.root_dir, self.KEY_FILE)
+        with self.build_space_lock(data.anod_instance.build_space_name):
+            if os.path.isfile(key_file):
+                with open(key_file) as f:
+                    if f.read() == key:
+                        return
+            rm(key_file)
+            if not self.artifact_cache.restore(key, build_space.install_dir):
+                raise RemoteError("cannot restore %s" % data.anod_instance.name)
+            with open(key_file, "w") as f:
+                f.write(key)
+
+    def build(self, stream: BufferedIOBase, request: Dict[str, Any]) -> None:
+        """Perform a build request.
+
+        :param stream: the connection stream
+        :param request: the request
+        """
+        actions = self.load_actions(request)
+        cache = self.artifact_cache
+        send_message(
+            stream, {"missing": [key for _, key in request["deps"] if key not in cache]}
+        )
+        for _, key in request["deps"]:
+            if key not in cache:
+                receive_entry(stream, cache, key)
+        for name, key in request["deps"]:
+            self.restore(actions[name], key)
+
+        data = actions[request["build_space_name"]]
+        anod_instance = data.anod_instance
+        build_space = anod_instance.build_space
+        with self.build_space_lock(anod_instance.build_space_name):
+            rm(os.path.join(build_space.root_dir, self.KEY_FILE))
+            for d in (build_space.src_dir, build_space.build_dir):
+                rm(d, recursive=True)
+                mkdir(d)
+            fd, sources = tempfile.mkstemp(dir=self.sandbox.tmp_dir, suffix=".tar.gz")
+            os.close(fd)
+            try:
+                receive_message(stream, payload=sources)
+                unpack_tree(sources, build_space.src_dir)
+            finally:
+                rm(sources)
+
+            key = request["key"]
+            if self.run_build(stream, data, request) and key in cache:
+                with open(os.path.join(build_space.root_dir, self.KEY_FILE), "w") as f:
+                    f.write(key)
+                send_message(stream, {"status": "success"})
+                send_entry(stream, cache, key)
+            else:
+                send_message(stream, {"status": "failure"})
+
+    def run_build(
+        self, stream: BufferedIOBase, data: Any, request: Dict[str, Any]
+    ) -> bool:
+        """Build in a new interpreter, sending its output to the coordinator.
+
+        The install tree is added to the artifact cache by the build process
+        (see lib.anod.runner).
+
+        :param stream: the connection stream
+        :param data: the Build action, as scheduled by the worker. Its uid
+            starts with the name of the worker machine, while the uid of the
+            request starts with the name of the coordinator machine (see
+            lib.anod.cache.portable_uid).
+        :param request: the build request
+        :return: True if the build succeeded
+        """
+        anod_instance = data.anod_instance
+        env = dict(os.environ)
+        for var in FORWARDED_ENV:
+            if request["env"].get(var) is None:
+                env.pop(var, None)
+            else:
+                env[var] = request["env"][var]
+        build_space = anod_instance.build_space
+        rm(build_space.install_dir, recursive=True)
+        mkdir(build_space.install_dir)
+
+        token = self.jobserver.acquire()
+        try:
+            process = start_build(
+                build_request(
+                    data.uid,
+                    anod_instance,
+                    self.sandbox,
+                    self.jobs,
+                    artifact_cache=self.artifact_cache.root_dir,
+                    key=request["key"],
+                    fingerprint=request["fingerprint"],
+                ),
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            assert process.stdout is not None
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            connected = True
+            with process.stdout as output:
+                while True:
+                    chunk = os.read(output.fileno(), CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if connected:
+                        try:
+                            send_message(stream, {"output": decoder.decode(chunk)})
+                        except OSError:
+                            # Let the build complete: its result is cached
+                            connected = False
+            success, _ = wait_build(process)
+            if not connected:
+                raise RemoteError("connection lost during the build")
+            return success
+        finally:
+            self.jobserver.release(token)
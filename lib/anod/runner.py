@@ -0,0 +1,175 @@
+"""Performance of Build actions in separate Python interpreters.
+
+Builds change the current directory and the environment of the process
+performing them, so they cannot be performed by the threads running the
+jobs of anod build or anod worker. Forking these processes is not safe
+either: the other threads may hold locks (of the logging module, of the
+download engine, of the fingerprint store...) that would never be released
+in the child.
+
+Each build is thus performed by a new interpreter, running this module. It
+receives a description of the build (see build_request) on its standard
+input, loads the specs to create the Anod instance of the action again,
+builds it and adds the resulting install tree to the artifact cache.
+"""
+
+from __future__ import annotations
+
+from lib.anod.paths import REPO_DIR
+
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.sandbox import SandBox
+    from e3.anod.spec import Anod
+    from typing import Any, Dict, Optional, Tuple
+
+
+def console_log_level() -> int:
+    """Return the level of the messages logged on the console."""
+    levels = [
+        handler.level
+        for handler in logging.getLogger("").handlers
+        if not isinstance(handler, logging.FileHandler)
+    ]
+    return min(levels, default=logging.INFO)
+
+
+def build_request(
+    uid: str,
+    anod_instance: Anod,
+    sandbox: SandBox,
+    jobs: int,
+    artifact_cache: Optional[str] = None,
+    key: Optional[str] = None,
+    fingerprint: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Return the description of a build performed by start_build.
+
+    :param uid: the uid of the Build action
+    :param anod_instance: the Anod instance of the action
+    :param sandbox: the sandbox of the action
+    :param jobs: the jobs attribute given to the Anod instance
+    :param artifact_cache: directory of the artifact cache in which the
+        install tree is stored, if any
+    :param key: the artifact cache key of the install tree
+    :param fingerprint: the elements of the fingerprint of the action,
+        stored with the install tree
+    """
+    env = anod_instance.env
+    return {
+        "uid": uid,
+        "spec_name": anod_instance.name,
+        "qualifier": anod_instance.qualifier,
+        "platforms": [env.build.platform, env.host.platform, env.target.platform],
+        "sandbox_dir": sandbox.root_dir,
+        "spec_dir": sandbox.specs_dir,
+        "jobs": jobs,
+        "artifact_cache": artifact_cache if key is not None else None,
+        "key": key,
+        "fingerprint": fingerprint,
+        "log_level": console_log_level(),
+    }
+
+
+def start_build(request: Dict[str, Any], **kwargs: Any) -> subprocess.Popen:
+    """Start a build in a new interpreter.
+
+    :param request: the description of the build (see build_request)
+    :param kwargs: additional arguments of subprocess.Popen, e.g. env or
+        stdout
+    :return: the process performing the build (see wait_build)
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "lib.anod.runner"],
+        stdin=subprocess.PIPE,
+        cwd=REPO_DIR,
+        **kwargs,
+    )
+    assert process.stdin is not None
+    with process.stdin:
+        process.stdin.write(json.dumps(request).encode("utf-8"))
+    return process
+
+
+def wait_build(process: subprocess.Popen) -> Tuple[bool, Any]:
+    """Wait for the end of a build started by start_build.
+
+    :param process: the process performing the build
+    :return: True if the build succeeded, and the resource usage of the
+        process (see os.wait4)
+    """
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+    return process.returncode == 0, rusage
+
+
+def perform_build(request: Dict[str, Any]) -> int:
+    """Perform a build in the current process.
+
+    :param request: the description of the build (see build_request)
+    :return: the process exit status
+    """
+    from e3.anod.action import Build
+    from e3.env import BaseEnv
+    from lib.anod.cache import ArtifactCache, setenv_changes
+    from lib.anod.util import create_anod_context, create_anod_sandbox
+
+    env = BaseEnv.from_env()
+    env.set_env(*request["platforms"])
+    ac = create_anod_context(request["spec_dir"])
+    action = ac.add_anod_action(
+        name=request["spec_name"],
+        primitive="build",
+        qualifier=request["qualifier"],
+        sandbox=create_anod_sandbox(request["sandbox_dir"], request["spec_dir"]),
+        upload=False,
+        env=env,
+    )
+    if not isinstance(action, Build) or action.uid != request["uid"]:
+        logging.error("cannot create %s (got %s)", request["uid"], action.uid)
+        return 1
+
+    # The build primitive is defined by the spec, not by the Anod class
+    anod_instance: Any = action.anod_instance
+    build_space = anod_instance.build_space
+    try:
+        os.chdir(build_space.build_dir)
+        anod_instance.jobs = request["jobs"]
+        anod_instance.build()
+        if request["artifact_cache"] is not None:
+            ArtifactCache(request["artifact_cache"]).store(
+                request["key"],
+                request["uid"],
+                build_space.install_dir,
+                metadata={
+                    "fingerprint": request["fingerprint"],
+                    "setenv": setenv_changes(anod_instance),
+                },
+            )
+    except Exception:
+        logging.exception("got exception while building")
+        return 1
+    return 0
+
+
+def main() -> int:
+    """Perform the build described on the standard input."""
+    import e3.log
+
+    request = json.load(sys.stdin)
+    e3.log.activate(level=request["log_level"])
+    return perform_build(request)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
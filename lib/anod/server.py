@@ -0,0 +1,429 @@
+"""Long-running anod server.
+
+The server accepts anod commands on a Unix socket (see lib.anod.client) and
+runs them with the standard streams, environment and working directory of
+the client. Between commands it keeps in memory the loaded specs, the result
+of the tool checks and, for printenv, the resolved Anod instances, so that
+repeated commands do not pay for them again.
+
+printenv commands are run by the server process itself. Other commands are
+run in a forked process, which inherits the state of the server.
+"""
+
+from __future__ import annotations
+
+from lib.anod.client import SERVER_ENV_VAR, receive_message, send_message
+from lib.anod.paths import REPO_DIR, SPEC_DIR
+from lib.anod.util import check_common_tools, clear_spec_repositories
+
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+import logging
+import os
+import runpy
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.spec import Anod
+    from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# Path to the anod front-end, run by the processes performing commands
+ANOD_SCRIPT = os.path.join(REPO_DIR, "anod")
+
+# Directory containing the Python code of anod. The server stops when it
+# changes, as it would keep running the old code.
+LIB_DIR = os.path.join(REPO_DIR, "lib")
+
+
+def peer_uid(conn: socket.socket) -> Optional[int]:
+    """Return the user id of the process connected to a Unix socket.
+
+    :param conn: the connection
+    :return: the user id, or None if the platform does not provide it
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def files_state(root_dir: str, extensions: Tuple[str, ...] = ()) -> Tuple:
+    """Return a value that changes whenever files of a directory change.
+
+    :param root_dir: the directory to scan (recursively)
+    :param extensions: if not empty, only consider files with these
+        extensions
+    :return: a tuple of (path, size, modification time) tuples
+    """
+    result = []
+    for root, dirs, files in os.walk(root_dir):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        for name in files:
+            if extensions and not name.endswith(extensions):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result.append((path, st.st_size, st.st_mtime_ns))
+    return tuple(sorted(result))
+
+
+def sandbox_state(sandbox_dir: str) -> Tuple:
+    """Return a value that changes whenever a sandbox configuration changes.
+
+    :param sandbox_dir: the sandbox root directory
+    """
+    result: List[Tuple[str, Optional[int]]] = []
+    for path in (
+        os.path.join(sandbox_dir, "meta", "sandbox.yaml"),
+        os.path.join(sandbox_dir, "user.yaml"),
+    ):
+        try:
+            result.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            result.append((path, None))
+    return tuple(result)
+
+
+class AnodServer(object):
+    """Server running anod commands on behalf of clients."""
+
+    def __init__(self, socket_path: str, idle_timeout: float):
+        """Initialize a server.
+
+        :param socket_path: path to the Unix socket to listen on
+        :param idle_timeout: time (in seconds) after which the server stops
+            if it received no command
+        """
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.listener: Optional[socket.socket] = None
+        self.running = False
+        self.last_activity = time.time()
+        self.spec_state = files_state(SPEC_DIR)
+        self.code_state = files_state(LIB_DIR, (".py",))
+        # printenv Anod instances, indexed by spec name, qualifier and
+        # sandbox directory. Each instance is stored along with the state of
+        # its sandbox when it was created.
+        self.anod_instances: Dict[Tuple[str, Optional[str], str], Tuple[Any, Anod]] = {}
+        # Connections of the commands running in forked processes
+        self.children: Dict[int, socket.socket] = {}
+
+    def check_state(self) -> bool:
+        """Discard the data that are no longer valid.
+
+        :return: False if the server code changed, in which case the server
+            must stop
+        """
+        if files_state(LIB_DIR, (".py",)) != self.code_state:
+            logging.info("anod code changed, stopping")
+            return False
+        spec_state = files_state(SPEC_DIR)
+        if spec_state != self.spec_state:
+            logging.info("specs changed, discarding loaded specs")
+            self.spec_state = spec_state
+            clear_spec_repositories()
+            self.anod_instances.clear()
+        return True
+
+    def is_running(self) -> bool:
+        """Return True if another server is listening on the socket."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def serve(self) -> int:
+        """Accept commands until the server is stopped.
+
+        :return: the process exit status
+        """
+        if self.is_running():
+            logging.error("an anod server is already running on %s", self.socket_path)
+            return 1
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+
+        # Commands run with the rights of the server: only its user may
+        # connect (see also handle_connection)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        saved_umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.socket_path)
+        finally:
+            os.umask(saved_umask)
+        self.listener.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logging.info("anod server listening on %s", self.socket_path)
+
+        # Load what can be loaded without a client
+        self.preload()
+
+        self.running = True
+        try:
+            while self.running:
+                conns = list(self.children.values())
+                readable, _, _ = select.select([self.listener] + conns, [], [], 1.0)
+                for sock in readable:
+                    if sock is self.listener:
+                        conn, _ = self.listener.accept()
+                        self.last_activity = time.time()
+                        self.handle_connection(conn)
+                    else:
+                        self.check_client(sock)
+                self.reap_children()
+                if (
+                    not self.children
+                    and time.time() - self.last_activity > self.idle_timeout
+                ):
+                    logging.info("no command received recently, stopping")
+                    self.running = False
+        finally:
+            self.listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        return 0
+
+    def preload(self) -> None:
+        """Import the modules used by anod commands and load the specs."""
+        # Imported here for their side effect only
+        import e3.anod.checkout  # noqa: F401
+        import e3.anod.context  # noqa: F401
+        import e3.anod.loader  # noqa: F401
+        import lib.anod.build  # noqa: F401
+        import lib.anod.download  # noqa: F401
+        from lib.anod.util import create_anod_context
+
+        create_anod_context(SPEC_DIR)
+
+    def handle_connection(self, conn: socket.socket) -> None:
+        """Handle a new client connection.
+
+        :param conn: the connection
+        """
+        fds: List[int] = []
+        uid = peer_uid(conn)
+        if uid is not None and uid != os.getuid():
+            logging.warning("rejecting a connection from uid %d", uid)
+            conn.close()
+            return
+        try:
+            message = receive_message(conn, max_fds=3)
+            if message is None:
+                conn.close()
+                return
+            request, fds = message
+            command = request.get("command")
+
+            if command == "ping":
+                send_message(conn, {"status": 0, "pid": os.getpid()})
+            elif command == "stop":
+                send_message(conn, {"status": 0})
+                self.running = False
+            elif len(fds) != 3:
+                # Let the client run the command itself
+                send_message(conn, {"status": None})
+            elif not self.check_state():
+                send_message(conn, {"status": None})
+                self.running = False
+            elif command == "printenv":
+                send_message(conn, {"status": self.printenv(request, fds)})
+            else:
+                self.start_command(request, fds, conn)
+                return
+        except Exception:
+            logging.exception("error while handling a command")
+            try:
+                send_message(conn, {"status": None})
+            except OSError:
+                pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+        conn.close()
+
+    @contextmanager
+    def client_environment(self, request: Dict[str, Any]) -> Iterator[None]:
+        """Use the environment and working directory of a client.
+
+        :param request: the client request
+        """
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+            os.chdir(saved_cwd)
+
+    def printenv(self, request: Dict[str, Any], fds: List[int]) -> Optional[int]:
+        """Run a printenv command.
+
+        :param request: the client request
+        :param fds: the client standard streams
+        :return: the command exit status
+        """
+        from lib.anod_printenv import (
+            add_printenv_arguments,
+            get_anod_instance,
+            print_anod_env,
+        )
+
+        parser = ArgumentParser(prog="anod printenv")
+        parser.add_argument("-v", "--verbose", action="count", default=0)
+        add_printenv_arguments(parser)
+
+        root_logger = logging.getLogger("")
+        saved_level = root_logger.level
+        with open(fds[1], "w", closefd=False) as out, open(
+            fds[2], "w", closefd=False
+        ) as err, redirect_stdout(out), redirect_stderr(err), self.client_environment(
+            request
+        ):
+            try:
+                args, _ = parser.parse_known_args(request["args"][1:])
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 2
+
+            root_logger.setLevel(logging.ERROR)
+            try:
+                check_common_tools()
+                key = (
+                    args.spec_name,
+                    args.qualifier,
+                    os.path.abspath(args.sandbox_dir),
+                )
+                state = sandbox_state(key[2])
+                cached = self.anod_instances.get(key)
+                if cached is not None and cached[0] == state:
+                    anod_instance = cached[1]
+                else:
+                    anod_instance = get_anod_instance(
+                        args.spec_name, args.qualifier, args.sandbox_dir
+                    )
+                    self.anod_instances[key] = (state, anod_instance)
+                print_anod_env(anod_instance, args)
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            finally:
+                root_logger.setLevel(saved_level)
+        return 0
+
+    def start_command(
+        self, request: Dict[str, Any], fds: List[int], conn: socket.socket
+    ) -> None:
+        """Run a command in a forked process.
+
+        :param request: the client request
+        :param fds: the client standard streams
+        :param conn: the client connection, to which the exit status of the
+            command is sent when it completes
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with self.client_environment(request):
+            pid = os.fork()
+            if pid == 0:
+                self.run_command(request, fds)
+        self.children[pid] = conn
+
+    def run_command(self, request: Dict[str, Any], fds: List[int]) -> None:
+        """Run a command by running the anod front-end (in a forked process).
+
+        :param request: the client request
+        :param fds: the client standard streams
+        """
+        status = 1
+        try:
+            # Put the command in its own process group, so that it can be
+            # interrupted with all the processes it runs.
+            os.setpgid(0, 0)
+            if self.listener is not None:
+                self.listener.close()
+            for conn in self.children.values():
+                conn.close()
+            for index, fd in enumerate(fds):
+                os.dup2(fd, index)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            root_logger = logging.getLogger("")
+            for handler in list(root_logger.handlers):
+                root_logger.removeHandler(handler)
+
+            # Do not forward the command to the server again
+            os.environ[SERVER_ENV_VAR] = ""
+            sys.argv = [ANOD_SCRIPT] + request["args"]
+            runpy.run_path(ANOD_SCRIPT, run_name="__main__")
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def check_client(self, conn: socket.socket) -> None:
+        """Interrupt a command whose client has disconnected.
+
+        :param conn: the connection of a command running in a forked process
+        """
+        for pid, child_conn in self.children.items():
+            if child_conn is conn:
+                try:
+                    data = conn.recv(1024)
+                except OSError:
+                    data = b""
+                if not data:
+                    logging.info("client of process %s disconnected", pid)
+                    try:
+                        os.killpg(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                return
+
+    def reap_children(self) -> None:
+        """Send the exit status of completed commands to their clients."""
+        for pid in list(self.children):
+            result, status = os.waitpid(pid, os.WNOHANG)
+            if result == 0:
+                continue
+            conn = self.children.pop(pid)
+            if os.WIFEXITED(status):
+                exit_status = os.WEXITSTATUS(status)
+            else:
+                exit_status = 128 + os.WTERMSIG(status)
+            try:
+                send_message(conn, {"status": exit_status})
+            except OSError:
+                pass
+            conn.close()
+            self.last_activity = time.time()
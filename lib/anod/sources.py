@@ -0,0 +1,424 @@
+"""Cache of unpacked source archives shared between build spaces."""
+
+from __future__ import annotations
+
+from e3.archive import ArchiveError, unpack_archive
+from e3.fs import mkdir, rm, sync_tree
+
+from lib.anod.manifest import IgnoreList
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import IO, List, Optional, Union
+    from typing_extensions import Literal
+
+
+# Tar archive extensions and the corresponding compression
+TAR_EXTENSIONS = (
+    (".tar", ""),
+    (".tar.gz", "gz"),
+    (".tgz", "gz"),
+    (".tar.bz2", "bz2"),
+    (".tbz2", "bz2"),
+    (".tar.xz", "xz"),
+)
+
+# Decompressors able to use several cores, by order of preference. They
+# are used instead of the Python modules when available.
+PARALLEL_DECOMPRESSORS = {
+    "gz": (["pigz", "-dc"],),
+    "bz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"]),
+    "xz": (["xz", "-dc", "-T0"],),
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def tar_compression(filename: str) -> Optional[str]:
+    """Return the compression of a tar archive.
+
+    :param filename: an archive name
+    :return: gz, bz2, xz, an empty string for uncompressed archives or None
+        if filename is not a tar archive
+    """
+    for ext, compression in TAR_EXTENSIONS:
+        if filename.endswith(ext):
+            return compression
+    return None
+
+
+def decompressor_command(compression: str) -> Optional[List[str]]:
+    """Return a parallel decompressor command line, if one is installed.
+
+    :param compression: gz, bz2 or xz
+    :return: a command reading compressed data on its standard input and
+        writing the uncompressed data on its standard output
+    """
+    for cmd in PARALLEL_DECOMPRESSORS.get(compression, ()):
+        if shutil.which(cmd[0]) is not None:
+            return cmd
+    return None
+
+
+class TarStreamExtractor(object):
+    """Extract a tar archive as its content is written to the extractor.
+
+    Decompression is done by a parallel decompressor process when one is
+    available, otherwise by Python. In both cases it runs, along with the
+    extraction, concurrently with the code writing the data, e.g. a
+    download.
+    """
+
+    def __init__(self, compression: str, dest_dir: str):
+        """Start an extraction.
+
+        :param compression: the archive compression (see tar_compression)
+        :param dest_dir: directory in which the archive is extracted
+        """
+        self.dest_dir = dest_dir
+        self.error: Optional[BaseException] = None
+        self.process: Optional[subprocess.Popen] = None
+        cmd = decompressor_command(compression) if compression else None
+        if cmd is not None:
+            self.process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            assert self.process.stdin is not None and self.process.stdout is not None
+            self.input: IO[bytes] = self.process.stdin
+            tar_input: IO[bytes] = self.process.stdout
+        else:
+            read_fd, write_fd = os.pipe()
+            self.input = os.fdopen(write_fd, "wb")
+            tar_input = os.fdopen(read_fd, "rb")
+        self.thread: Optional[threading.Thread] = threading.Thread(
+            target=self.extract, args=(tar_input,)
+        )
+        self.thread.start()
+
+    def extract(self, fileobj: IO[bytes]) -> None:
+        """Extract the archive (in a separate thread).
+
+        :param fileobj: the stream from which the archive is read. tarfile
+            decompresses it if needed.
+        """
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+                if hasattr(tarfile, "tar_filter"):
+                    tar.extractall(self.dest_dir, filter="tar")
+                else:
+                    tar.extractall(self.dest_dir)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Consume the remaining data so that writers never block
+            while fileobj.read(CHUNK_SIZE):
+                pass
+            fileobj.close()
+
+    def write(self, data: bytes) -> None:
+        """Give the next chunk of the archive.
+
+        :param data: the chunk
+        """
+        if self.error is not None:
+            return
+        try:
+            self.input.write(data)
+        except OSError as e:
+            # The decompressor died: the error is reported by close
+            self.error = e
+
+    def close(self) -> None:
+        """Wait for the end of the extraction.
+
+        :raise ArchiveError: if the archive cannot be extracted
+        """
+        if self.thread is None:
+            return
+        try:
+            self.input.close()
+        except OSError:
+            pass
+        self.thread.join()
+        self.thread = None
+        if self.process is not None and self.process.wait() != 0 and not self.error:
+            self.error = ArchiveError(
+                origin="TarStreamExtractor",
+                message="decompressor exited with status %s" % self.process.returncode,
+            )
+        if self.error is not None:
+            raise ArchiveError(
+                origin="TarStreamExtractor",
+                message="cannot extract archive: %s" % self.error,
+            )
+
+
+def root_dir_content(
+    tmp_dir: str, remove_root_dir: Union[bool, Literal["auto"]]
+) -> str:
+    """Return the directory to use as source tree after an extraction.
+
+    This implements the remove_root_dir parameter of unpack_archive.
+
+    :param tmp_dir: the directory in which an archive was extracted
+    :param remove_root_dir: see e3.archive.unpack_archive
+    :return: tmp_dir or its single subdirectory
+    """
+    if not remove_root_dir:
+        return tmp_dir
+    entries = os.listdir(tmp_dir)
+    if len(entries) == 1:
+        path = os.path.join(tmp_dir, entries[0])
+        if os.path.isdir(path) and not os.path.islink(path):
+            return path
+    if remove_root_dir == "auto":
+        return tmp_dir
+    raise ArchiveError(
+        origin="unpack_archive", message="archive does not have a unique root dir"
+    )
+
+
+def make_tree_writable(root_dir: str) -> None:
+    """Give the owner write permission on all the files of a tree.
+
+    :param root_dir: the tree root directory
+    """
+    for root, _, files in os.walk(root_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and not st.st_mode & stat.S_IWUSR:
+                os.chmod(path, st.st_mode | stat.S_IWUSR)
+
+
+def clear_tree(root_dir: str, ignore: IgnoreList) -> None:
+    """Remove the content of a directory, except ignored paths.
+
+    :param root_dir: the directory to clear
+    :param ignore: the paths to keep, as for sync_tree
+    """
+    for root, dirs, files in os.walk(root_dir):
+        rel_root = os.path.relpath(root, root_dir)
+        if rel_root == ".":
+            rel_root = ""
+        kept_dirs = []
+        for name in dirs:
+            rel_path = os.path.join(rel_root, name)
+            if rel_path in ignore:
+                continue
+            path = os.path.join(root, name)
+            if not os.path.islink(path) and (
+                ignore.names
+                or any(p.startswith("/%s/" % rel_path) for p in ignore.paths)
+            ):
+                # Some of its content may be kept
+                kept_dirs.append(name)
+            else:
+                rm(path, recursive=True)
+        dirs[:] = kept_dirs
+        for name in files:
+            if os.path.join(rel_root, name) not in ignore:
+                rm(os.path.join(root, name))
+
+
+def link_tree(src_dir: str, dest_dir: str, ignore: Optional[IgnoreList] = None) -> None:
+    """Reproduce a tree using hard links.
+
+    :param src_dir: the tree to reproduce
+    :param dest_dir: an existing directory, empty except for ignored paths
+    :param ignore: the paths of src_dir not to reproduce, as for sync_tree
+    """
+    if ignore is None:
+        ignore = IgnoreList()
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        if rel_root == ".":
+            rel_root = ""
+        target_root = os.path.join(dest_dir, rel_root)
+        kept_dirs = []
+        for name in dirs:
+            if os.path.join(rel_root, name) in ignore:
+                continue
+            path = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            else:
+                mkdir(target)
+                kept_dirs.append(name)
+        dirs[:] = kept_dirs
+        for name in files:
+            if os.path.join(rel_root, name) in ignore:
+                continue
+            path = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            else:
+                os.link(path, target)
+
+
+class SourceTreeCache(object):
+    """Store of unpacked source archives.
+
+    Each archive is unpacked once in root_dir/<key[:2]>/<key>, where the key
+    depends on the archive content and on the unpack parameters, and is then
+    staged into build spaces instead of being unpacked again. Staging uses,
+    in order of preference:
+
+    - reflinks (copy-on-write clones, on filesystems supporting them);
+    - hard links to the cached files. These files are read-only so that a
+      build cannot modify the cache in place: tools replacing files (such as
+      patch) break the link and work as usual. As root can write read-only
+      files, hard links are not used when running as root;
+    - plain copies, e.g. when the cache is on another filesystem.
+    """
+
+    def __init__(self, root_dir: str):
+        """Initialize a source tree cache.
+
+        :param root_dir: directory in which unpacked trees are stored
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        # Set to False once reflinks are known not to work
+        self.use_reflinks = True
+        # Permissions do not prevent root from modifying the cache through
+        # a hard link
+        self.use_hardlinks = not hasattr(os, "geteuid") or os.geteuid() != 0
+
+    @staticmethod
+    def key(archive_digest: str, remove_root_dir: Union[bool, Literal["auto"]]) -> str:
+        """Return the cache key of an unpacked archive.
+
+        :param archive_digest: the sha256 of the archive
+        :param remove_root_dir: see e3.archive.unpack_archive
+        :return: the cache key
+        """
+        return hashlib.sha256(
+            json.dumps([archive_digest, remove_root_dir]).encode("utf-8")
+        ).hexdigest()
+
+    def tree_path(self, key: str) -> str:
+        """Return the path to an unpacked tree.
+
+        :param key: a cache key
+        :return: a path
+        """
+        return os.path.join(self.root_dir, key[:2], key)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isdir(self.tree_path(key))
+
+    def add(self, key: str, tree_dir: str) -> None:
+        """Move an unpacked tree into the cache.
+
+        :param key: the cache key (see SourceTreeCache.key)
+        :param tree_dir: the tree. It must be on the same filesystem as the
+            cache (see SourceTreeCache.tmp_dir).
+        """
+        for root, _, files in os.walk(tree_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    os.chmod(path, st.st_mode & ~0o222)
+        mkdir(os.path.dirname(self.tree_path(key)))
+        try:
+            os.rename(tree_dir, self.tree_path(key))
+        except OSError:
+            # Another process may have populated the same entry
+            if key not in self:
+                raise
+            rm(tree_dir, recursive=True)
+
+    def tmp_dir(self) -> str:
+        """Return a new temporary directory in the cache."""
+        mkdir(self.root_dir)
+        return tempfile.mkdtemp(dir=self.root_dir, suffix=".tmp")
+
+    def populate(
+        self, key: str, filename: str, remove_root_dir: Union[bool, Literal["auto"]]
+    ) -> None:
+        """Unpack an archive into the cache.
+
+        :param key: the cache key (see SourceTreeCache.key)
+        :param filename: the archive
+        :param remove_root_dir: see e3.archive.unpack_archive
+        """
+        tmp_dir = self.tmp_dir()
+        try:
+            compression = tar_compression(filename)
+            if compression is None:
+                unpack_archive(
+                    filename=filename, dest=tmp_dir, remove_root_dir=remove_root_dir
+                )
+                tree_dir = tmp_dir
+            else:
+                extractor = TarStreamExtractor(compression, tmp_dir)
+                try:
+                    with open(filename, "rb") as fd:
+                        while True:
+                            data = fd.read(CHUNK_SIZE)
+                            if not data:
+                                break
+                            extractor.write(data)
+                finally:
+                    extractor.close()
+                tree_dir = root_dir_content(tmp_dir, remove_root_dir)
+            self.add(key, tree_dir)
+        finally:
+            if os.path.exists(tmp_dir):
+                rm(tmp_dir, recursive=True)
+
+    def stage(self, key: str, dest_dir: str, ignore: Optional[List[str]] = None) -> str:
+        """Reproduce an unpacked tree in a build space.
+
+        :param key: the cache key of an entry
+        :param dest_dir: the destination directory. Its previous content is
+            removed, except ignored paths.
+        :param ignore: paths neither staged nor removed, as for sync_tree
+            (e.g. the other sources installed in dest_dir, see
+            e3.anod.package.Source.ignore)
+        :return: the staging method used (reflink, hardlink or copy)
+        """
+        tree = self.tree_path(key)
+        ignore_list = IgnoreList(ignore)
+        mkdir(dest_dir)
+        clear_tree(dest_dir, ignore_list)
+
+        # cp cannot skip the ignored paths
+        if self.use_reflinks and not ignore:
+            p = subprocess.run(
+                ["cp", "-a", "--reflink=always", tree + "/.", dest_dir],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if p.returncode == 0:
+                make_tree_writable(dest_dir)
+                return "reflink"
+            self.use_reflinks = False
+            clear_tree(dest_dir, ignore_list)
+
+        if self.use_hardlinks:
+            try:
+                link_tree(tree, dest_dir, ignore_list)
+                return "hardlink"
+            except OSError as e:
+                logging.debug("cannot hardlink %s: %s", tree, e)
+                clear_tree(dest_dir, ignore_list)
+
+        sync_tree(tree, dest_dir, ignore=ignore)
+        make_tree_writable(dest_dir)
+        return "copy"
@@ -0,0 +1,194 @@
+"""Stores of prebuilt install trees shared between machines.
+
+A binary store holds entries in the format of the artifact cache (see
+lib.anod.cache.ArtifactCache): <key[:2]>/<key>.tar.gz, the packed install
+tree, and <key>.json, its metadata. It is either a directory (e.g. on a
+shared filesystem) or an HTTP endpoint serving such a directory. Entries are
+added by anod export and fetched by builds into the artifact cache, from
+which they are restored and relocated as usual.
+"""
+
+from __future__ import annotations
+
+from e3.fs import mkdir, rm
+
+import abc
+import logging
+import os
+import shutil
+import tempfile
+
+import requests
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from lib.anod.cache import ArtifactCache
+    from typing import Dict, Optional
+
+
+class BinaryStore(abc.ABC):
+    """A store of prebuilt install trees."""
+
+    def __init__(self, location: str):
+        """Initialize a binary store.
+
+        :param location: the store location
+        """
+        self.location = location
+
+    @staticmethod
+    def open(location: str) -> BinaryStore:
+        """Return the store at a given location.
+
+        :param location: a directory or an http(s) URL
+        """
+        if location.startswith("http://") or location.startswith("https://"):
+            return HTTPBinaryStore(location)
+        return DirectoryBinaryStore(location)
+
+    @staticmethod
+    def entry_files(key: str) -> Dict[str, str]:
+        """Return the paths of the files of an entry, relative to the store.
+
+        :param key: an artifact cache key
+        :return: the paths of the metadata and archive files
+        """
+        return {
+            "metadata": "%s/%s.json" % (key[:2], key),
+            "archive": "%s/%s.tar.gz" % (key[:2], key),
+        }
+
+    @abc.abstractmethod
+    def get(self, path: str, filename: str) -> bool:
+        """Copy a file of the store.
+
+        :param path: the path of the file, relative to the store
+        :param filename: the destination file
+        :return: False if the file does not exist
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, filename: str, path: str) -> None:
+        """Add a file to the store.
+
+        :param filename: the file to add
+        :param path: the path of the file, relative to the store
+        """
+        raise NotImplementedError
+
+    def fetch(self, key: str, cache: ArtifactCache) -> bool:
+        """Copy an entry of the store into an artifact cache.
+
+        :param key: the entry key (see ArtifactCache.key)
+        :param cache: the artifact cache
+        :return: True if the entry is in the artifact cache
+        """
+        if key in cache:
+            return True
+        files = self.entry_files(key)
+        tmp_files: Dict[str, str] = {}
+        try:
+            for kind in ("metadata", "archive"):
+                tmp_files[kind] = cache.tmp_file(key)
+                if not self.get(files[kind], tmp_files[kind]):
+                    return False
+            cache.add(key, tmp_files["metadata"], tmp_files["archive"])
+            return True
+        except (OSError, requests.exceptions.RequestException):
+            logging.warning(
+                "cannot fetch %s from %s", key, self.location, exc_info=True
+            )
+            return False
+        finally:
+            for tmp_file in tmp_files.values():
+                rm(tmp_file)
+
+    def publish(self, key: str, cache: ArtifactCache) -> None:
+        """Copy an entry of an artifact cache into the store.
+
+        :param key: the entry key
+        :param cache: the artifact cache containing the entry
+        """
+        files = self.entry_files(key)
+        # The archive is published first so that the entry is complete
+        # when its metadata becomes visible.
+        self.put(cache.archive_path(key), files["archive"])
+        self.put(cache.metadata_path(key), files["metadata"])
+
+
+class DirectoryBinaryStore(BinaryStore):
+    """A binary store in a directory.
+
+    The directory can also be used as an artifact cache, or served over
+    HTTP to be used as an HTTPBinaryStore.
+    """
+
+    def __init__(self, location: str):
+        """See BinaryStore."""
+        super().__init__(os.path.abspath(location))
+
+    def get(self, path: str, filename: str) -> bool:
+        """See BinaryStore.get."""
+        src = os.path.join(self.location, path)
+        if not os.path.isfile(src):
+            return False
+        shutil.copyfile(src, filename)
+        return True
+
+    def put(self, filename: str, path: str) -> None:
+        """See BinaryStore.put."""
+        dest = os.path.join(self.location, path)
+        mkdir(os.path.dirname(dest))
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp_file)
+            os.replace(tmp_file, dest)
+        except OSError:
+            rm(tmp_file)
+            raise
+
+
+class HTTPBinaryStore(BinaryStore):
+    """A binary store accessed over HTTP.
+
+    Files are read with GET requests and added with PUT requests: servers
+    not accepting PUT (e.g. a plain static file server) give read-only
+    stores.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    TIMEOUT = (60, 60)
+
+    def __init__(self, location: str):
+        """See BinaryStore."""
+        super().__init__(location.rstrip("/"))
+        self.__session: Optional[requests.Session] = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self.__session is None:
+            self.__session = requests.Session()
+        return self.__session
+
+    def url(self, path: str) -> str:
+        return "%s/%s" % (self.location, path)
+
+    def get(self, path: str, filename: str) -> bool:
+        """See BinaryStore.get."""
+        with self.session.get(self.url(path), stream=True, timeout=self.TIMEOUT) as r:
+            if r.status_code == 404:
+                return False
+            r.raise_for_status()
+            with open(filename, "wb") as fd:
+                for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                    fd.write(chunk)
+        return True
+
+    def put(self, filename: str, path: str) -> None:
+        """See BinaryStore.put."""
+        with open(filename, "rb") as fd:
+            r = self.session.put(self.url(path), data=fd, timeout=self.TIMEOUT)
+        r.raise_for_status()
@@ -1,14 +1,23 @@
 from __future__ import annotations
 
-from e3.anod.loader import AnodSpecRepository
-from e3.anod.context import AnodContext
-from e3.anod.sandbox import SandBox
-from e3.os.process import Run
-
 import logging
 import os
+import shutil
 import sys
 
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.context import AnodContext
+    from e3.anod.loader import AnodSpecRepository
+    from e3.anod.sandbox import SandBox
+    from typing import Dict, Optional, Tuple
+
+# Results of check_tool and loaded spec repositories. They are only reused
+# by long-running processes such as the anod server (see lib.anod.server).
+TOOL_VERSIONS: Dict[Tuple[str, str, int], str] = {}
+SPEC_REPOSITORIES: Dict[str, AnodSpecRepository] = {}
+
 
 def check_tool(tool: str) -> str:
     """Check tool version and return its version.
@@ -20,10 +29,23 @@ def check_tool(tool: str) -> str:
     :return: the tool version
     :rtype: str
     """
+    # The version of a given executable is checked only once
+    key: Optional[Tuple[str, str, int]] = None
+    path = shutil.which(tool)
+    if path is not None:
+        key = (tool, path, os.stat(path).st_mtime_ns)
+        if key in TOOL_VERSIONS:
+            logging.info("%s version: %s", tool, TOOL_VERSIONS[key])
+            return TOOL_VERSIONS[key]
+
+    from e3.os.process import Run
+
     try:
         p = Run([tool, "--version"])
         version = p.out.splitlines()[0]
         logging.info("%s version: %s", tool, version)
+        if key is not None:
+            TOOL_VERSIONS[key] = version
         return version
     except Exception:
         logging.critical("cannot find %s", tool)
@@ -41,10 +63,23 @@ def check_common_tools() -> None:
 
 
 def create_anod_context(spec_dir: str) -> AnodContext:
-    return AnodContext(AnodSpecRepository(spec_dir))
+    # Loading specs requires most of e3.anod: import it only when needed
+    from e3.anod.context import AnodContext
+    from e3.anod.loader import AnodSpecRepository
+
+    if spec_dir not in SPEC_REPOSITORIES:
+        SPEC_REPOSITORIES[spec_dir] = AnodSpecRepository(spec_dir)
+    return AnodContext(SPEC_REPOSITORIES[spec_dir])
+
+
+def clear_spec_repositories() -> None:
+    """Forget the loaded spec repositories, e.g. after a spec change."""
+    SPEC_REPOSITORIES.clear()
 
 
 def create_anod_sandbox(sbx_dir: str, spec_dir: str) -> SandBox:
+    from e3.anod.sandbox import SandBox
+
     sbx = SandBox()
     sbx.root_dir = sbx_dir
     sbx.specs_dir = spec_dir
@@ -4,16 +4,23 @@
 
 from __future__ import annotations
 
-from lib.anod.build import UxasBuilder
 from lib.anod.util import check_common_tools, create_anod_context, create_anod_sandbox
-from lib.anod.paths import REPO_DIR, SPEC_DIR, SBX_DIR
+from lib.anod.paths import CACHE_DIR, REPO_DIR, SPEC_DIR, SBX_DIR
 
 from e3.anod.status import ReturnValue
-from e3.env import BaseEnv
+from e3.env import BaseEnv, Env
 from e3.main import Main
 
+import itertools
+import json
+import logging
 import os
 
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional, Tuple
+
 
 # Uxas repo root directory
 OPENUXAS_ROOT_DIR = os.path.dirname(REPO_DIR)
@@ -28,16 +35,126 @@ BUILD_SUCCESS = [
 ]
 
 
-def do_build(m: Main, set_prog: bool = True) -> int:
-    """Perform the build."""
+def parse_matrix(matrix: List[str]) -> List[Tuple[Optional[str], str, List[str]]]:
+    """Parse the values of --matrix.
+
+    :param matrix: a list of [SPEC:]KEY=VALUE1,VALUE2,...
+    :return: the spec (None for all the specs), key and values of each entry
+    :raise ValueError: if a value is invalid
+    """
+    result = []
+    for entry in matrix:
+        key, _, values = entry.partition("=")
+        spec_name, _, key = key.rpartition(":")
+        if not key or not values:
+            raise ValueError(
+                "invalid matrix %s: expecting [SPEC:]KEY=VALUE1,VALUE2" % entry
+            )
+        result.append((spec_name or None, key, values.split(",")))
+    return result
+
+
+def matrix_qualifiers(
+    spec_name: str,
+    qualifier: Optional[str],
+    matrix: List[Tuple[Optional[str], str, List[str]]],
+) -> List[Optional[str]]:
+    """Return the qualifiers of the variants of a spec.
+
+    :param spec_name: the spec name
+    :param qualifier: the qualifier of the spec
+    :param matrix: the matrix returned by parse_matrix
+    :return: the qualifier combined with each combination of the matrix
+        values (the matrix values override the ones of the qualifier)
+    """
+    matrix = [entry for entry in matrix if entry[0] in (None, spec_name)]
+    keys = {key for _, key, _ in matrix}
+    base = [
+        item
+        for item in (qualifier or "").split(",")
+        if item and item.partition("=")[0] not in keys
+    ]
+    return [
+        ",".join(base + list(combination)) or None
+        for combination in itertools.product(
+            *(["%s=%s" % (key, value) for value in values] for _, key, values in matrix)
+        )
+    ]
+
+
+def print_plan(output_format: str, **kwargs: Any) -> int:
+    """Print what a build would do, without building.
+
+    :param output_format: text or json
+    :param kwargs: the arguments of UxasPlanner
+    :return: the exit status of anod build --plan
+    """
+    from lib.anod.plan import UxasPlanner
+
+    planner = UxasPlanner(**kwargs)
+    plan = planner.plan()
+    summary = planner.summary(plan)
+    if output_format == "json":
+        print(json.dumps({"actions": plan, "summary": summary}, indent=2))
+        return 0
+
+    for entry in plan:
+        print(
+            "%-7s %6.0fs  %s (%s)"
+            % (entry["decision"], entry["duration"], entry["action"], entry["reason"])
+        )
+    print(
+        "%d to run, %d unknown, %d to skip: %.0fs of work, %.0fs with enough cores"
+        % (
+            summary["run"],
+            summary["unknown"],
+            summary["skip"],
+            summary["duration"],
+            summary["critical_path"],
+        )
+    )
+    return 0
+
+
+def do_build(m: Main, set_prog: bool = True, fetch_only: bool = False) -> int:
+    """Perform the build.
+
+    :param fetch_only: only fetch build results from the binary store
+        instead of building (anod import)
+    """
     if set_prog:
-        m.argument_parser.prog = m.argument_parser.prog + " build"
+        m.argument_parser.prog = m.argument_parser.prog + (
+            " import" if fetch_only else " build"
+        )
     m.argument_parser.add_argument(
         "spec_name",
-        help="spec to build. This is "
-        "the basename of an .anod file (without the extension)",
+        nargs="+",
+        metavar="SPEC[:QUALIFIER]",
+        help="specs to build, in a single build sharing their common "
+        "dependencies. A spec is the basename of an .anod file (without the "
+        "extension), optionally followed by its qualifier",
+    )
+    m.argument_parser.add_argument(
+        "--qualifier", help="qualifier of the specs given without one"
+    )
+    m.argument_parser.add_argument(
+        "--matrix",
+        action="append",
+        default=[],
+        metavar="[SPEC:]KEY=VALUE1,VALUE2",
+        help="build each spec, or only SPEC, once per value of a qualifier "
+        "key, in the same build (can be repeated: all the combinations are "
+        "built). Variants must have distinct build spaces",
+    )
+    m.argument_parser.add_argument(
+        "--plan",
+        nargs="?",
+        const="text",
+        choices=("text", "json"),
+        help="print the actions that would be performed, with the reason "
+        "and their expected duration, instead of building (default format: "
+        "text)",
     )
-    m.argument_parser.add_argument("--qualifier", help="optional qualifier")
     m.argument_parser.add_argument(
         "--sandbox-dir",
         help="directory in which build artefacts are stored",
@@ -49,41 +166,223 @@ def do_build(m: Main, set_prog: bool = True) -> int:
         action="store_true",
         default=False,
     )
+    m.argument_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="maximum number of processes run at the same time by the build "
+        "tools of all the specs being built (default: number of cores)",
+        default=Env().build.cpu.cores,
+    )
+    m.argument_parser.add_argument(
+        "--network-jobs",
+        type=int,
+        help="maximum number of checkouts and downloads performed at the "
+        "same time (default: %(default)s)",
+        default=4,
+    )
+    m.argument_parser.add_argument(
+        "--worker",
+        action="append",
+        metavar="HOST[:PORT]",
+        help="send the builds to a worker started with anod worker (can be "
+        "repeated). Checkouts and downloads are still performed locally",
+    )
+    m.argument_parser.add_argument(
+        "--incremental",
+        help="keep build directories between builds so that only the parts "
+        "affected by a change are rebuilt",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--cmake-generator",
+        choices=("make", "ninja"),
+        help="build tool used by all the cmake based specs, instead of the "
+        "one chosen by each spec (ninja falls back to make if not installed)",
+    )
+    m.argument_parser.add_argument(
+        "--paranoid",
+        help="recompute the checksums of all files instead of trusting "
+        "the ones recorded for unchanged files",
+        action="store_true",
+    )
+    m.argument_parser.add_argument(
+        "--artifact-cache",
+        help="directory in which build results are cached across sandboxes",
+        default=os.environ.get(
+            "OPENUXAS_ARTIFACT_CACHE", os.path.join(CACHE_DIR, "artifacts")
+        ),
+    )
+    m.argument_parser.add_argument(
+        "--no-artifact-cache",
+        help="neither use nor populate the artifact cache",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--source-cache",
+        help="directory in which unpacked source archives are cached",
+        default=os.environ.get(
+            "OPENUXAS_SOURCE_CACHE", os.path.join(CACHE_DIR, "sources")
+        ),
+    )
+    m.argument_parser.add_argument(
+        "--no-source-cache",
+        help="unpack source archives in each build space",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--git-cache",
+        help="directory in which git objects are cached across sandboxes",
+        default=os.environ.get("OPENUXAS_GIT_CACHE", os.path.join(CACHE_DIR, "git")),
+    )
+    m.argument_parser.add_argument(
+        "--no-git-cache",
+        help="clone repositories independently in each sandbox",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--binary-store",
+        help="directory or http(s) URL from which prebuilt build results are "
+        "fetched (see anod export)",
+        default=os.environ.get("OPENUXAS_BINARY_STORE"),
+    )
+    m.argument_parser.add_argument(
+        "--no-compiler-cache",
+        help="do not use ccache, even if it is installed",
+        action="store_true",
+        default=False,
+    )
     m.parse_args()
+    assert m.args is not None
+
+    if fetch_only and not m.args.binary_store:
+        m.argument_parser.error("no binary store (see --binary-store)")
+
+    try:
+        matrix = parse_matrix(m.args.matrix)
+    except ValueError as e:
+        m.argument_parser.error(str(e))
+
+    # Not needed to parse the command line: loaded late to keep --help fast
+    from lib.anod.build import UxasBuilder
+    from lib.anod.cache import ArtifactCache
+    from lib.anod.ccache import CompilerCache
+    from lib.anod.gitcache import GitObjectCache
+    from lib.anod.remote import WorkerPool
+    from lib.anod.sources import SourceTreeCache
+    from lib.anod.store import BinaryStore
 
     check_common_tools()
 
+    if m.args.cmake_generator is not None:
+        # Read by Common.cmake_build
+        os.environ["OPENUXAS_CMAKE_GENERATOR"] = m.args.cmake_generator
+
     ac = create_anod_context(SPEC_DIR)
     sbx = create_anod_sandbox(m.args.sandbox_dir, SPEC_DIR)
 
     sbx.create_dirs()
 
-    ac.add_anod_action(
-        name=m.args.spec_name,
-        primitive="build",
-        qualifier=m.args.qualifier,
+    # All the targets are scheduled together so that the actions they
+    # share are performed once, and independent ones run concurrently
+    targets: Dict[str, Optional[str]] = {}
+    for target in m.args.spec_name:
+        spec_name, sep, target_qualifier = target.partition(":")
+        for qualifier in matrix_qualifiers(
+            spec_name, target_qualifier if sep else m.args.qualifier, matrix
+        ):
+            action = ac.add_anod_action(
+                name=spec_name,
+                primitive="build",
+                qualifier=qualifier,
+                sandbox=sbx,
+                upload=False,
+                env=BaseEnv.from_env(),
+            )
+            if targets.setdefault(action.uid, qualifier) != qualifier:
+                m.argument_parser.error(
+                    "%s: variants %s and %s share the same build space"
+                    % (spec_name, targets[action.uid], qualifier)
+                )
+    actions = ac.schedule(resolver=ac.always_create_source_resolver)
+
+    artifact_cache = None
+    if not m.args.no_artifact_cache:
+        artifact_cache = ArtifactCache(m.args.artifact_cache)
+
+    if m.args.plan:
+        return print_plan(
+            m.args.plan,
+            actions=actions,
+            sandbox=sbx,
+            force=m.args.force,
+            artifact_cache=artifact_cache,
+            paranoid=m.args.paranoid,
+        )
+
+    source_cache = None
+    if not m.args.no_source_cache:
+        source_cache = SourceTreeCache(m.args.source_cache)
+
+    git_cache = None
+    if not m.args.no_git_cache:
+        git_cache = GitObjectCache(m.args.git_cache)
+
+    workers = None
+    if m.args.worker and not fetch_only:
+        workers = WorkerPool(m.args.worker)
+        if not workers.workers:
+            logging.warning("no worker available: building locally")
+            workers = None
+
+    binary_store = None
+    if m.args.binary_store:
+        binary_store = BinaryStore.open(m.args.binary_store)
+
+    compiler_cache = None
+    if not m.args.no_compiler_cache and not fetch_only:
+        # Paths under the sandbox are made relative so that objects can be
+        # shared between build spaces
+        compiler_cache = CompilerCache.find(
+            os.path.join(sbx.root_dir, "ccache"), base_dir=sbx.root_dir
+        )
+
+    walker = UxasBuilder(
+        actions,
         sandbox=sbx,
-        upload=False,
-        env=BaseEnv.from_env(),
+        force=m.args.force,
+        artifact_cache=artifact_cache,
+        source_cache=source_cache,
+        git_cache=git_cache,
+        compiler_cache=compiler_cache,
+        binary_store=binary_store,
+        fetch_only=fetch_only,
+        workers=workers,
+        incremental=m.args.incremental,
+        jobs=max(1, m.args.jobs),
+        network_jobs=max(1, m.args.network_jobs),
+        paranoid=m.args.paranoid,
     )
-    actions = ac.schedule(resolver=ac.always_create_source_resolver)
 
-    walker = UxasBuilder(actions, sandbox=sbx, force=m.args.force)
+    # The status of the root node is always unknown: the result is the one
+    # of the targets
+    status = 0
+    for uid in targets:
+        result = walker.job_status.get(uid, ReturnValue.failure)
+        if result not in BUILD_SUCCESS:
+            logging.error("%s: %s", uid, result.name)
+            if status == 0:
+                status = result.value
+    return status
 
-    # TODO: something with walker.job_status['root'], assuming we can get a
-    # useful value there. Right now, it's always 'unknown'
-    #
-    # In the meantime, python > 3.6 guarantees the order of keys in a dict.
-    # The job_status dict has as its penultimate entry the thing we asked to
-    # build or the last thing that failed (the last non-root node). It's ugly,
-    # but _should_ be safe to use this, until we have resolution for root
-    # always reporting unknown.
-    result: ReturnValue = list(walker.job_status.values())[-2]
 
-    if result in BUILD_SUCCESS:
-        return 0
-    else:
-        return result.value
+def do_import(m: Main, set_prog: bool = True) -> int:
+    """Fetch the build results of specs and of their dependencies."""
+    return do_build(m, set_prog=set_prog, fetch_only=True)
 
 
 if __name__ == "__main__":
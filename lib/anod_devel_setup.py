@@ -4,7 +4,7 @@
 
 from __future__ import annotations
 
-from lib.anod.paths import REPO_DIR, SPEC_DIR
+from lib.anod.paths import CACHE_DIR, REPO_DIR, SPEC_DIR
 
 from e3.main import Main
 
@@ -24,6 +24,9 @@ REPOSITORIES_YAML_PATH = os.path.join(SPEC_DIR, CONFIG_DIR_NAME, REPOSITORIES_FI
 
 DEFAULT_REPO_DIR = os.path.join(REPO_DIR, "develop")
 
+# Git objects shared with the sandboxes (see anod build --git-cache)
+GIT_CACHE_DIR = os.environ.get("OPENUXAS_GIT_CACHE", os.path.join(CACHE_DIR, "git"))
+
 DEFAULT_UXAS_DIR = os.path.join(DEFAULT_REPO_DIR, "OpenUxAS")
 UXAS_YAML_KEY = "openuxas"
 
@@ -86,7 +89,8 @@ def check_out(name: str, remote: str, refspec: str, clone_dir: str) -> None:
     Check out the given repository.
 
     This is a deep (non-shallow) checkout, which differs from e3's typical
-    operation.
+    operation. Objects already in the git cache are copied from it rather
+    than downloaded again; the clone does not depend on the cache afterwards.
     """
     if not os.path.exists(clone_dir):
         logging.info(
@@ -94,7 +98,16 @@ def check_out(name: str, remote: str, refspec: str, clone_dir: str) -> None:
             % (name, remote, refspec, clone_dir)
         )
 
-        subprocess.run(["git", "clone", remote, clone_dir])
+        from lib.anod.gitcache import GitObjectCache, read_shallow
+
+        reference = GitObjectCache(GIT_CACHE_DIR).repo_path(remote)
+        if os.path.isdir(reference) and not read_shallow(reference):
+            reference_args = ["--reference-if-able", reference, "--dissociate"]
+        else:
+            # git cannot borrow objects from a shallow repository
+            reference_args = []
+
+        subprocess.run(["git", "clone"] + reference_args + [remote, clone_dir])
         subprocess.run(["git", "checkout", refspec], cwd=clone_dir)
 
 
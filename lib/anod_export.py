@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""Export of build results to a binary store."""
+
+from __future__ import annotations
+
+from lib.anod.util import check_common_tools, create_anod_context, create_anod_sandbox
+from lib.anod.paths import CACHE_DIR, SPEC_DIR, SBX_DIR
+
+from e3.env import BaseEnv
+from e3.main import Main
+
+import logging
+import os
+
+
+def do_export(m: Main, set_prog: bool = True) -> int:
+    """Export the build results of a spec and its dependencies.
+
+    The install directories of the Build actions are packed with their
+    fingerprint, as recorded by the last build in the sandbox, so that the
+    builds of other sandboxes computing the same fingerprint fetch them
+    instead of building (see anod build --binary-store and anod import).
+    """
+    if set_prog:
+        m.argument_parser.prog = m.argument_parser.prog + " export"
+    m.argument_parser.add_argument(
+        "spec_name",
+        help="spec to export. This is "
+        "the basename of an .anod file (without the extension)",
+    )
+    m.argument_parser.add_argument("--qualifier", help="optional qualifier")
+    m.argument_parser.add_argument(
+        "--sandbox-dir",
+        help="directory in which build artefacts are stored",
+        default=SBX_DIR,
+    )
+    m.argument_parser.add_argument(
+        "--binary-store",
+        help="directory or http(s) URL (accepting PUT requests) to which "
+        "build results are exported",
+        default=os.environ.get("OPENUXAS_BINARY_STORE"),
+    )
+    m.argument_parser.add_argument(
+        "--artifact-cache",
+        help="artifact cache in which build results are packed before being "
+        "exported (entries created by anod build are reused)",
+        default=os.environ.get(
+            "OPENUXAS_ARTIFACT_CACHE", os.path.join(CACHE_DIR, "artifacts")
+        ),
+    )
+    m.parse_args()
+    assert m.args is not None
+
+    if not m.args.binary_store:
+        m.argument_parser.error("no binary store (see --binary-store)")
+
+    # Not needed to parse the command line: loaded late to keep --help fast
+    from e3.anod.action import Build
+    from lib.anod.cache import ArtifactCache, package_metadata
+    from lib.anod.fingerprints import FingerprintStore
+    from lib.anod.store import BinaryStore
+
+    import requests
+
+    check_common_tools()
+
+    ac = create_anod_context(SPEC_DIR)
+    sbx = create_anod_sandbox(m.args.sandbox_dir, SPEC_DIR)
+
+    ac.add_anod_action(
+        name=m.args.spec_name,
+        primitive="build",
+        qualifier=m.args.qualifier,
+        sandbox=sbx,
+        upload=False,
+        env=BaseEnv.from_env(),
+    )
+    actions = ac.schedule(resolver=ac.always_create_source_resolver)
+
+    store = BinaryStore.open(m.args.binary_store)
+    cache = ArtifactCache(m.args.artifact_cache)
+    fingerprints = FingerprintStore.for_sandbox(sbx, read_only=True)
+
+    status = 0
+    for vertex_id, data in actions:
+        if not isinstance(data, Build):
+            continue
+        uid = str(vertex_id)
+        anod_instance = data.anod_instance
+        if not getattr(anod_instance, "enable_artifact_cache", True):
+            logging.info("%s: not exportable", uid)
+            continue
+
+        # Saved by the last successful build (see UxasBuilder)
+        fingerprint = fingerprints.get(uid)
+        install_dir = anod_instance.build_space.install_dir
+        if fingerprint is None or not os.path.isdir(install_dir):
+            logging.error("%s: not built, run anod build first", uid)
+            status = 1
+            continue
+
+        key = ArtifactCache.key(uid, fingerprint)
+        metadata = cache.load_metadata(key)
+        if metadata is None or "fingerprint" not in metadata:
+            if not cache.store(
+                key,
+                uid,
+                install_dir,
+                metadata=package_metadata(anod_instance, fingerprint),
+            ):
+                status = 1
+                continue
+        try:
+            store.publish(key, cache)
+            logging.info("%s exported (%s)", uid, key)
+        except (OSError, requests.exceptions.RequestException) as e:
+            logging.error("%s: cannot export to %s: %s", uid, store.location, e)
+            status = 1
+
+    fingerprints.close()
+    return status
+
+
+if __name__ == "__main__":
+    exit(do_export(Main(), set_prog=False))
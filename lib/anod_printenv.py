@@ -7,12 +7,20 @@ from __future__ import annotations
 from lib.anod.util import check_common_tools, create_anod_context, create_anod_sandbox
 from lib.anod.paths import SPEC_DIR, SBX_DIR
 
+from e3.anod.action import Build
 from e3.main import Main
 from e3.env import BaseEnv
 
+from argparse import ArgumentParser, Namespace
 import logging
 import os
 
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from e3.anod.spec import Anod
+    from typing import Optional
+
 # Help users who can't remember to use eval.
 BANNER = """
 # ----------------------------------------------------------------------------
@@ -27,56 +35,62 @@ BANNER = """
 """
 
 
-def do_printenv(m: Main, set_prog: bool = True) -> int:
-    """Print the environment for the given spec."""
-    if set_prog:
-        m.argument_parser.prog = m.argument_parser.prog + " printenv"
-    m.argument_parser.add_argument(
+def add_printenv_arguments(parser: ArgumentParser) -> None:
+    """Add the printenv options to an argument parser."""
+    parser.add_argument(
         "spec_name",
         help="spec to build. This is "
         "the basename of an .anod file (without the extension)",
     )
-    m.argument_parser.add_argument("--qualifier", help="optional qualifier")
-    m.argument_parser.add_argument(
+    parser.add_argument("--qualifier", help="optional qualifier")
+    parser.add_argument(
         "--sandbox-dir",
         help="directory in which build artifacts are stored",
         default=SBX_DIR,
     )
-    m.argument_parser.add_argument(
+    parser.add_argument(
         "--build-env",
         help="print build environment",
         action="store_true",
         default=False,
     )
 
-    m.argument_parser.add_argument(
+    parser.add_argument(
         "--inline",
         help="print variable definitions on a single line without exports",
         action="store_true",
         default=False,
     )
-    m.parse_args()
 
-    # Disable logging messages except errors
-    logging.getLogger("").setLevel(logging.ERROR)
-
-    check_common_tools()
 
+def get_anod_instance(
+    spec_name: str, qualifier: Optional[str], sandbox_dir: str
+) -> Anod:
+    """Return the Anod instance used to compute the environment of a spec."""
     ac = create_anod_context(SPEC_DIR)
-    sbx = create_anod_sandbox(m.args.sandbox_dir, SPEC_DIR)
+    sbx = create_anod_sandbox(sandbox_dir, SPEC_DIR)
 
-    anod_instance = ac.add_anod_action(
-        name=m.args.spec_name,
+    action = ac.add_anod_action(
+        name=spec_name,
         primitive="build",
-        qualifier=m.args.qualifier,
+        qualifier=qualifier,
         sandbox=sbx,
         upload=False,
         env=BaseEnv.from_env(),
-    ).anod_instance
+    )
+    assert isinstance(action, Build)
+    return action.anod_instance
+
+
+def print_anod_env(anod_instance: Anod, args: Namespace) -> None:
+    """Print the environment variables set by an Anod instance.
 
+    :param anod_instance: the Anod instance
+    :param args: the parsed printenv options
+    """
     saved_env = {k: v for k, v in os.environ.items()}
 
-    if m.args.build_env:
+    if args.build_env:
         if hasattr(anod_instance, "build_setenv"):
             anod_instance.build_setenv()
     else:
@@ -85,18 +99,37 @@ def do_printenv(m: Main, set_prog: bool = True) -> int:
 
     for var, value in os.environ.items():
         if var not in saved_env or saved_env[var] != os.environ[var]:
-            if m.args.inline:
+            if args.inline:
                 print('%s="%s"' % (var, value), end=" ")
             else:
                 print('export %s="%s";' % (var, value))
 
-                if m.args.verbose >= 1:
+                if args.verbose >= 1:
                     print('printf "I set %s=\\"%s\\"\\n\\n";' % (var, value))
 
                 print(" ")
 
-    if not m.args.inline:
-        print(BANNER % m.args.spec_name)
+    if not args.inline:
+        print(BANNER % args.spec_name)
+
+
+def do_printenv(m: Main, set_prog: bool = True) -> int:
+    """Print the environment for the given spec."""
+    if set_prog:
+        m.argument_parser.prog = m.argument_parser.prog + " printenv"
+    add_printenv_arguments(m.argument_parser)
+    m.parse_args()
+    assert m.args is not None
+
+    # Disable logging messages except errors
+    logging.getLogger("").setLevel(logging.ERROR)
+
+    check_common_tools()
+
+    anod_instance = get_anod_instance(
+        m.args.spec_name, m.args.qualifier, m.args.sandbox_dir
+    )
+    print_anod_env(anod_instance, m.args)
 
     return 0
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""Anod server control."""
+
+from __future__ import annotations
+
+from lib.anod.client import (
+    SERVER_ENV_VAR,
+    receive_message,
+    send_message,
+    server_socket_path,
+)
+from lib.anod.paths import SBX_DIR
+
+from e3.main import Main
+
+import logging
+import os
+import socket
+import sys
+
+
+def send_server_command(path: str, command: str) -> bool:
+    """Send a control command to a running server.
+
+    :param path: path to the server socket
+    :param command: the command (ping or stop)
+    :return: False if no server answered
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        send_message(sock, {"command": command})
+        return receive_message(sock) is not None
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def detach(log_file: str) -> None:
+    """Run the rest of the program as a daemon.
+
+    :param log_file: file to which the output of the daemon is written
+    """
+    if os.fork() != 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    os.close(null_fd)
+
+
+def do_server(m: Main, set_prog: bool = True) -> int:
+    """Run or control the anod server."""
+    if set_prog:
+        m.argument_parser.prog = m.argument_parser.prog + " server"
+    m.argument_parser.description = (
+        "Run a server keeping specs loaded between anod commands. While it "
+        "is running, anod build and anod printenv are performed by the "
+        "server. Set %s to an empty string to disable the use of the server."
+        % SERVER_ENV_VAR
+    )
+    m.argument_parser.add_argument(
+        "--detach",
+        help="run the server in the background",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--stop",
+        help="stop the running server",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--status",
+        help="check whether the server is running",
+        action="store_true",
+        default=False,
+    )
+    m.argument_parser.add_argument(
+        "--idle-timeout",
+        help="stop the server after this number of seconds without commands "
+        "(default: %(default)s)",
+        type=float,
+        default=4 * 3600,
+    )
+    m.parse_args()
+    assert m.args is not None
+
+    path = server_socket_path()
+    if path is None:
+        logging.error("the anod server is disabled")
+        return 1
+
+    if m.args.status:
+        running = send_server_command(path, "ping")
+        print("anod server %s" % ("running" if running else "not running"))
+        return 0 if running else 1
+
+    if m.args.stop:
+        return 0 if send_server_command(path, "stop") else 1
+
+    from lib.anod.server import AnodServer
+
+    server = AnodServer(path, idle_timeout=m.args.idle_timeout)
+    if server.is_running():
+        logging.error("an anod server is already running on %s", path)
+        return 1
+    if m.args.detach:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        detach(os.path.join(SBX_DIR, "log", "anod-server.log"))
+    return server.serve()
+
+
+if __name__ == "__main__":
+    exit(do_server(Main(), set_prog=False))
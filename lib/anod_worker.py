@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Anod worker daemon, performing builds for anod build --worker."""
+
+from __future__ import annotations
+
+from lib.anod.util import check_common_tools, create_anod_sandbox
+from lib.anod.paths import CACHE_DIR, REPO_DIR, SPEC_DIR
+
+from e3.env import Env
+from e3.main import Main
+
+import os
+
+
+# Uxas repo root directory
+os.environ["OPENUXAS_ROOT_DIR"] = os.path.dirname(REPO_DIR)
+
+
+def do_worker(m: Main, set_prog: bool = True) -> int:
+    """Run a worker."""
+    if set_prog:
+        m.argument_parser.prog = m.argument_parser.prog + " worker"
+    m.argument_parser.add_argument(
+        "--listen",
+        metavar="HOST[:PORT]",
+        help="address on which builds are accepted. There is no "
+        "authentication: only listen on trusted networks (default: "
+        "%(default)s)",
+        default="localhost",
+    )
+    m.argument_parser.add_argument(
+        "--sandbox-dir",
+        help="directory in which builds are performed. It must not be the "
+        "sandbox of a coordinator",
+        default=os.path.join(REPO_DIR, "sbx-worker"),
+    )
+    m.argument_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of cores of the worker: maximum number of builds, and of "
+        "processes run by their build tools, at the same time (default: "
+        "number of cores)",
+        default=Env().build.cpu.cores,
+    )
+    m.argument_parser.add_argument(
+        "--artifact-cache",
+        help="directory in which the install trees received and built are cached",
+        default=os.environ.get(
+            "OPENUXAS_ARTIFACT_CACHE", os.path.join(CACHE_DIR, "artifacts")
+        ),
+    )
+    m.argument_parser.add_argument(
+        "--no-compiler-cache",
+        help="do not use ccache, even if it is installed",
+        action="store_true",
+        default=False,
+    )
+    m.parse_args()
+    assert m.args is not None
+
+    # Not needed to parse the command line: loaded late to keep --help fast
+    from lib.anod.cache import ArtifactCache
+    from lib.anod.ccache import CompilerCache
+    from lib.anod.jobserver import JobServer
+    from lib.anod.remote import WorkerServer, parse_address
+
+    check_common_tools()
+
+    sbx = create_anod_sandbox(m.args.sandbox_dir, SPEC_DIR)
+    sbx.create_dirs()
+
+    if not m.args.no_compiler_cache:
+        compiler_cache = CompilerCache.find(
+            os.path.join(sbx.root_dir, "ccache"), base_dir=sbx.root_dir
+        )
+        if compiler_cache is not None:
+            compiler_cache.setenv()
+
+    jobs = max(1, m.args.jobs)
+    with JobServer(jobs, sbx) as jobserver:
+        return WorkerServer(
+            parse_address(m.args.listen),
+            sandbox=sbx,
+            spec_dir=SPEC_DIR,
+            artifact_cache=ArtifactCache(m.args.artifact_cache),
+            jobserver=jobserver,
+            jobs=jobs,
+        ).serve()
+
+
+if __name__ == "__main__":
+    exit(do_worker(Main(), set_prog=False))
@@ -0,0 +1,84 @@
+"""Tests of lib.anod.build.AnodFilesDigests."""
+
+from __future__ import annotations
+
+from e3.hash import sha256
+
+from lib.anod.build import AnodFilesDigests
+from lib.anod.digest import DigestIndex
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pathlib
+    from typing import Any, List
+
+
+class Anod(object):
+    """Stand-in for e3.anod.spec.Anod, recognized by its class name."""
+
+    name = "anod"
+    data_files: List[str] = []
+
+    def __init__(self, spec_dir: str):
+        self.spec_dir = spec_dir
+
+
+class Common(Anod):
+    name = "common"
+
+
+class Hello(Common):
+    name = "hello"
+    data_files = ["hello"]
+
+
+class World(Common):
+    name = "world"
+
+
+class CountingIndex(DigestIndex):
+    """Digest index recording the files it is asked about."""
+
+    def __init__(self, filename: str):
+        super(CountingIndex, self).__init__(filename)
+        self.requested: List[str] = []
+
+    def sha256(self, path: str) -> str:
+        self.requested.append(path)
+        return super(CountingIndex, self).sha256(path)
+
+
+def create_specs(spec_dir: pathlib.Path) -> None:
+    """Create the files of the stand-in specs."""
+    for name in ("common.anod", "hello.anod", "hello.yaml", "world.anod"):
+        (spec_dir / name).write_text("# %s\n" % name)
+
+
+def test_elements(tmp_path: pathlib.Path) -> None:
+    """The elements are the basename and sha256 of the spec and yaml files."""
+    create_specs(tmp_path)
+    anod_files = AnodFilesDigests(DigestIndex(str(tmp_path / "digests.json")))
+    hello: Any = Hello(str(tmp_path))
+
+    assert anod_files.get(hello) == [
+        (name, sha256(str(tmp_path / name)))
+        for name in ("hello.anod", "common.anod", "hello.yaml")
+    ]
+
+
+def test_memoized(tmp_path: pathlib.Path) -> None:
+    """Each file is looked up once per run."""
+    create_specs(tmp_path)
+    index = CountingIndex(str(tmp_path / "digests.json"))
+    anod_files = AnodFilesDigests(index)
+    hello: Any = Hello(str(tmp_path))
+    other_hello: Any = Hello(str(tmp_path))
+    world: Any = World(str(tmp_path))
+
+    assert anod_files.get(other_hello) == anod_files.get(hello)
+    anod_files.get(world)
+    assert sorted(index.requested) == sorted(
+        str(tmp_path / name)
+        for name in ("common.anod", "hello.anod", "hello.yaml", "world.anod")
+    )
@@ -0,0 +1,121 @@
+"""Tests of lib.anod.cache and lib.anod.store."""
+
+from __future__ import annotations
+
+from e3.env import Env
+from e3.fingerprint import Fingerprint
+
+from lib.anod.cache import ArtifactCache, portable_uid
+from lib.anod.store import BinaryStore
+
+import os
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pathlib
+
+
+def create_install_dir(install_dir: pathlib.Path) -> None:
+    """Create an install tree recording its prefix."""
+    (install_dir / "bin").mkdir(parents=True)
+    (install_dir / "bin" / "hello").write_text("#!/bin/sh\n")
+    (install_dir / "bin" / "hello").chmod(0o755)
+    (install_dir / "lib" / "pkgconfig").mkdir(parents=True)
+    (install_dir / "lib" / "pkgconfig" / "hello.pc").write_text(
+        "prefix=%s\n" % install_dir
+    )
+    (install_dir / "share").mkdir()
+    (install_dir / "share" / "prefix.txt").write_text(str(install_dir))
+
+
+def test_portable_uid() -> None:
+    """Only the name of the local machine is removed from uids."""
+    machine = Env().build.machine
+    assert portable_uid(machine + ".x86_64-linux.hello.build") == (
+        "x86_64-linux.hello.build"
+    )
+    assert portable_uid("x86_64-linux.hello.build") == "x86_64-linux.hello.build"
+    assert portable_uid("root") == "root"
+
+
+def test_key() -> None:
+    """Keys depend on the fingerprint and portable uid of the action."""
+    fingerprint = Fingerprint()
+    fingerprint.add("hello.anod", "0" * 64)
+    uid = "x86_64-linux.hello.build"
+    key = ArtifactCache.key(uid, fingerprint)
+
+    assert ArtifactCache.key(Env().build.machine + "." + uid, fingerprint) == key
+    assert ArtifactCache.key("x86_64-linux.world.build", fingerprint) != key
+    fingerprint.add("hello.yaml", "1" * 64)
+    assert ArtifactCache.key(uid, fingerprint) != key
+
+
+def test_store_restore(tmp_path: pathlib.Path) -> None:
+    """Install trees are restored as stored, with their metadata."""
+    install_dir = tmp_path / "install"
+    create_install_dir(install_dir)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    assert "key" not in cache
+    assert cache.store("key", "hello.build", str(install_dir), metadata={"a": 1})
+    assert "key" in cache
+    assert cache.load_metadata("key") == {
+        "a": 1,
+        "uid": "hello.build",
+        "prefix": str(install_dir),
+    }
+
+    # The previous content of the install directory is removed
+    (install_dir / "obsolete").write_text("")
+    assert cache.restore("key", str(install_dir))
+    assert not (install_dir / "obsolete").exists()
+    assert os.access(str(install_dir / "bin" / "hello"), os.X_OK)
+    assert (install_dir / "lib" / "pkgconfig" / "hello.pc").read_text() == (
+        "prefix=%s\n" % install_dir
+    )
+
+
+def test_restore_missing(tmp_path: pathlib.Path) -> None:
+    """Missing entries are not restored."""
+    install_dir = tmp_path / "install"
+    create_install_dir(install_dir)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    assert not cache.restore("key", str(install_dir))
+    assert (install_dir / "bin" / "hello").exists()
+
+
+def test_relocate(tmp_path: pathlib.Path) -> None:
+    """Prefixes are relocated in pkg-config and CMake files only."""
+    old_dir = tmp_path / "old" / "install"
+    create_install_dir(old_dir)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    cache.store("key", "hello.build", str(old_dir))
+
+    new_dir = tmp_path / "new" / "install"
+    assert cache.restore("key", str(new_dir))
+    assert (new_dir / "lib" / "pkgconfig" / "hello.pc").read_text() == (
+        "prefix=%s\n" % new_dir
+    )
+    assert (new_dir / "share" / "prefix.txt").read_text() == str(old_dir)
+
+
+def test_binary_store(tmp_path: pathlib.Path) -> None:
+    """Entries published in a binary store are fetched by other caches."""
+    install_dir = tmp_path / "install"
+    create_install_dir(install_dir)
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    cache.store("key", "hello.build", str(install_dir))
+    store = BinaryStore.open(str(tmp_path / "store"))
+    store.publish("key", cache)
+
+    other_cache = ArtifactCache(str(tmp_path / "other_cache"))
+    assert not store.fetch("missing", other_cache)
+    assert store.fetch("key", other_cache)
+    assert other_cache.load_metadata("key") == cache.load_metadata("key")
+
+    new_dir = tmp_path / "new" / "install"
+    assert other_cache.restore("key", str(new_dir))
+    assert (new_dir / "lib" / "pkgconfig" / "hello.pc").read_text() == (
+        "prefix=%s\n" % new_dir
+    )
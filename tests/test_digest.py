@@ -0,0 +1,117 @@
+"""Tests of lib.anod.digest."""
+
+from __future__ import annotations
+
+import e3.hash
+
+from lib.anod.digest import DigestIndex
+
+import hashlib
+import os
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pathlib
+    import pytest
+    from typing import List
+
+
+def sha256(content: bytes) -> str:
+    """Return the SHA-256 of some content."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def count_hashes(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    """Record the files hashed by e3.hash.sha256.
+
+    :return: the list of hashed files, updated on each call
+    """
+    hashed: List[str] = []
+    sha256_file = e3.hash.sha256
+
+    def counting_sha256(path: str) -> str:
+        hashed.append(path)
+        return sha256_file(path)
+
+    monkeypatch.setattr(e3.hash, "sha256", counting_sha256)
+    return hashed
+
+
+def test_digest_reused(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Digests of unchanged files are not computed again."""
+    hashed = count_hashes(monkeypatch)
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(b"content")
+    index = DigestIndex(str(tmp_path / "digests.json"))
+
+    assert index.sha256(str(path)) == sha256(b"content")
+    assert index.sha256(str(path)) == sha256(b"content")
+    assert len(hashed) == 1
+
+
+def test_digest_invalidated(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Digests are computed again when the status of a file changes."""
+    hashed = count_hashes(monkeypatch)
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(b"content")
+    index = DigestIndex(str(tmp_path / "digests.json"))
+    index.sha256(str(path))
+
+    # Same size, different modification time
+    path.write_bytes(b"CONTENT")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert index.sha256(str(path)) == sha256(b"CONTENT")
+    assert len(hashed) == 2
+
+
+def test_digest_modified_while_hashing(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Digests of files modified while being hashed are not recorded."""
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(b"content")
+    sha256_file = e3.hash.sha256
+
+    def racing_sha256(filename: str) -> str:
+        result = sha256_file(filename)
+        path.write_bytes(b"new content")
+        return result
+
+    monkeypatch.setattr(e3.hash, "sha256", racing_sha256)
+    index = DigestIndex(str(tmp_path / "digests.json"))
+    assert index.sha256(str(path)) == sha256(b"content")
+    assert index.entries == {}
+
+    monkeypatch.setattr(e3.hash, "sha256", sha256_file)
+    assert index.sha256(str(path)) == sha256(b"new content")
+
+
+def test_paranoid(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Recorded digests are not trusted in paranoid mode."""
+    hashed = count_hashes(monkeypatch)
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(b"content")
+    index = DigestIndex(str(tmp_path / "digests.json"), paranoid=True)
+
+    index.sha256(str(path))
+    index.sha256(str(path))
+    assert len(hashed) == 2
+
+
+def test_save(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Saved digests are reused by the next runs."""
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(b"content")
+    index = DigestIndex(str(tmp_path / "digests.json"))
+    index.record(str(path), sha1="0" * 40)
+    index.save()
+
+    hashed = count_hashes(monkeypatch)
+    index = DigestIndex(str(tmp_path / "digests.json"))
+    assert index.sha1(str(path)) == "0" * 40
+    assert index.sha256(str(path)) == sha256(b"content")
+    assert hashed == [str(path)]
@@ -0,0 +1,100 @@
+"""Tests of lib.anod.fingerprints."""
+
+from __future__ import annotations
+
+from e3.fingerprint import Fingerprint
+
+from lib.anod.fingerprints import FingerprintStore
+
+import os
+
+import pytest
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pathlib
+
+
+def make_fingerprint(**elements: str) -> Fingerprint:
+    """Return a fingerprint with the given elements."""
+    result = Fingerprint()
+    for name, value in elements.items():
+        result.add(name, value)
+    return result
+
+
+def test_save(tmp_path: pathlib.Path) -> None:
+    """Fingerprints are saved when the store is closed."""
+    filename = str(tmp_path / "meta" / "fingerprints.db")
+    store = FingerprintStore(filename)
+    assert store.get("hello.build") is None
+    assert store.start_run() == 1
+    store.set("hello.build", make_fingerprint(spec="1"))
+    store.set("world.build", make_fingerprint(spec="2"))
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    store.close()
+
+    store = FingerprintStore(filename)
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    assert store.start_run() == 2
+    store.set("hello.build", make_fingerprint(spec="3"))
+    store.set("world.build", None)
+    store.close()
+
+    store = FingerprintStore(filename)
+    assert store.get("hello.build") == make_fingerprint(spec="3")
+    assert store.get("world.build") is None
+    assert [run for run, _ in store.runs()] == [1, 2]
+    assert store.history("hello.build") == [
+        (1, make_fingerprint(spec="1")),
+        (2, make_fingerprint(spec="3")),
+    ]
+    assert store.changes_since(1) == {
+        "hello.build": {"updated": ["spec"], "new": [], "obsolete": []}
+    }
+    store.close()
+
+
+def test_read_only(tmp_path: pathlib.Path) -> None:
+    """Read-only stores are neither created nor modified."""
+    filename = str(tmp_path / "fingerprints.db")
+    store = FingerprintStore(filename, read_only=True)
+    assert store.get("hello.build") is None
+    with pytest.raises(AssertionError):
+        store.start_run()
+    store.close()
+    assert not os.path.exists(filename)
+
+    store = FingerprintStore(filename)
+    store.start_run()
+    store.set("hello.build", make_fingerprint(spec="1"))
+    store.close()
+    content = (tmp_path / "fingerprints.db").read_bytes()
+
+    store = FingerprintStore(filename, read_only=True)
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    store.close()
+    assert (tmp_path / "fingerprints.db").read_bytes() == content
+
+
+def test_legacy(tmp_path: pathlib.Path) -> None:
+    """The fingerprint files of previous versions are imported once."""
+    legacy_dir = tmp_path / "fingerprints"
+    legacy_dir.mkdir()
+    make_fingerprint(spec="1").save_to_file(str(legacy_dir / "hello.build.json"))
+    filename = str(tmp_path / "fingerprints.db")
+
+    # Loaded but not imported by read-only stores
+    store = FingerprintStore(filename, legacy_dir=str(legacy_dir), read_only=True)
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    store.close()
+    assert legacy_dir.is_dir()
+
+    store = FingerprintStore(filename, legacy_dir=str(legacy_dir))
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    store.close()
+    assert not legacy_dir.exists()
+    store = FingerprintStore(filename, legacy_dir=str(legacy_dir))
+    assert store.get("hello.build") == make_fingerprint(spec="1")
+    store.close()
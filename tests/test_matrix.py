@@ -0,0 +1,59 @@
+"""Tests of the qualifier matrix of anod build."""
+
+from __future__ import annotations
+
+from lib.anod_build import matrix_qualifiers, parse_matrix
+
+import pytest
+
+
+def test_parse_matrix() -> None:
+    """Entries apply to all the specs or to a single one."""
+    assert parse_matrix([]) == []
+    assert parse_matrix(["scenario=release,gcov", "uxas:lang=cpp"]) == [
+        (None, "scenario", ["release", "gcov"]),
+        ("uxas", "lang", ["cpp"]),
+    ]
+
+
+@pytest.mark.parametrize("entry", ["scenario", "scenario=", "=release", "uxas:=a"])
+def test_parse_matrix_invalid(entry: str) -> None:
+    """Entries without key or values are rejected."""
+    with pytest.raises(ValueError):
+        parse_matrix([entry])
+
+
+def test_no_matrix() -> None:
+    """Without matrix, the qualifier is used as is."""
+    assert matrix_qualifiers("uxas", None, []) == [None]
+    assert matrix_qualifiers("uxas", "lang=cpp", []) == ["lang=cpp"]
+
+
+def test_combinations() -> None:
+    """There is a variant per combination of the matrix values."""
+    matrix = parse_matrix(["scenario=release,gcov", "lang=cpp,ada"])
+    assert matrix_qualifiers("uxas", "debug", matrix) == [
+        "debug,scenario=release,lang=cpp",
+        "debug,scenario=release,lang=ada",
+        "debug,scenario=gcov,lang=cpp",
+        "debug,scenario=gcov,lang=ada",
+    ]
+
+
+def test_override() -> None:
+    """Matrix values replace the values of the qualifier for the same keys."""
+    matrix = parse_matrix(["scenario=release,gcov"])
+    assert matrix_qualifiers("uxas", "scenario=debug,lang=cpp", matrix) == [
+        "lang=cpp,scenario=release",
+        "lang=cpp,scenario=gcov",
+    ]
+
+
+def test_spec_entries() -> None:
+    """Entries for a spec do not apply to the other specs."""
+    matrix = parse_matrix(["uxas:scenario=release,gcov"])
+    assert matrix_qualifiers("uxas", None, matrix) == [
+        "scenario=release",
+        "scenario=gcov",
+    ]
+    assert matrix_qualifiers("amase", "lang=java", matrix) == ["lang=java"]
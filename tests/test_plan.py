@@ -0,0 +1,161 @@
+"""Tests of lib.anod.plan."""
+
+from __future__ import annotations
+
+from e3.env import BaseEnv
+
+from lib.anod.cache import ArtifactCache, portable_uid
+from lib.anod.fingerprints import FingerprintStore
+from lib.anod.plan import RUN, SKIP, UxasPlanner
+from lib.anod.util import (
+    clear_spec_repositories,
+    create_anod_context,
+    create_anod_sandbox,
+)
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pathlib
+    from e3.anod.sandbox import SandBox
+    from typing import Any, Dict, Optional, Tuple
+
+
+SPECS = {
+    "hello.anod": """
+from e3.anod.spec import Anod
+
+
+class Hello(Anod):
+    @Anod.primitive()
+    def build(self):
+        pass
+""",
+    "world.anod": """
+from e3.anod.spec import Anod
+
+
+class World(Anod):
+    build_deps = [Anod.Dependency("hello")]
+
+    @Anod.primitive()
+    def build(self):
+        pass
+""",
+}
+
+
+def create_planner(
+    tmp_path: pathlib.Path,
+    force: bool = False,
+    artifact_cache: Optional[ArtifactCache] = None,
+) -> Tuple[SandBox, UxasPlanner]:
+    """Return the planner of anod build world in a sandbox of tmp_path."""
+    spec_dir = tmp_path / "specs"
+    if not spec_dir.is_dir():
+        spec_dir.mkdir()
+        for name, content in SPECS.items():
+            (spec_dir / name).write_text(content)
+    clear_spec_repositories()
+    ac = create_anod_context(str(spec_dir))
+    sbx = create_anod_sandbox(str(tmp_path / "sbx"), str(spec_dir))
+    sbx.create_dirs()
+    ac.add_anod_action(
+        name="world", primitive="build", sandbox=sbx, upload=False, env=BaseEnv()
+    )
+    actions = ac.schedule(resolver=ac.always_create_source_resolver)
+    return sbx, UxasPlanner(actions, sbx, force, artifact_cache=artifact_cache)
+
+
+def plan_by_name(planner: UxasPlanner) -> Dict[str, Dict[str, Any]]:
+    """Return the plan entries of the builds, by spec name."""
+    return {
+        entry["uid"].split(".")[-2]: entry
+        for entry in planner.plan()
+        if entry["uid"].endswith(".build")
+    }
+
+
+def record_build(sbx: SandBox, planner: UxasPlanner) -> None:
+    """Record the fingerprints predicted by a planner, as a build would."""
+    store = FingerprintStore.for_sandbox(sbx)
+    store.start_run()
+    for uid, fingerprint in planner.new_fingerprints.items():
+        store.set(uid, fingerprint)
+    store.close()
+
+
+def test_never_built(tmp_path: pathlib.Path) -> None:
+    """Actions without previous fingerprint are run."""
+    _, planner = create_planner(tmp_path)
+    plan = plan_by_name(planner)
+    assert [(entry["decision"], entry["reason"]) for entry in plan.values()] == [
+        (RUN, "never built"),
+        (RUN, "never built"),
+    ]
+
+
+def test_up_to_date(tmp_path: pathlib.Path) -> None:
+    """Actions whose fingerprint did not change are skipped."""
+    sbx, planner = create_planner(tmp_path)
+    planner.plan()
+    record_build(sbx, planner)
+
+    _, planner = create_planner(tmp_path)
+    plan = plan_by_name(planner)
+    assert plan["hello"]["decision"] == SKIP
+    assert plan["hello"]["reason"] == "up to date"
+    assert plan["hello"]["duration"] == 0.0
+    assert plan["world"]["decision"] == SKIP
+    summary = planner.summary(planner.plan())
+    assert (summary[RUN], summary[SKIP]) == (0, 2)
+
+
+def test_changed(tmp_path: pathlib.Path) -> None:
+    """The changed elements of the fingerprints are reported."""
+    sbx, planner = create_planner(tmp_path)
+    planner.plan()
+    record_build(sbx, planner)
+
+    with open(str(tmp_path / "specs" / "hello.anod"), "a") as f:
+        f.write("# changed\n")
+    _, planner = create_planner(tmp_path)
+    plan = plan_by_name(planner)
+    assert plan["hello"]["decision"] == RUN
+    assert plan["hello"]["reason"] == "changed: (M)hello.anod"
+    assert plan["world"]["decision"] == RUN
+    # Fingerprints refer to their predecessors by portable uid
+    assert plan["world"]["reason"] == "changed: (M)" + portable_uid(
+        plan["hello"]["uid"]
+    )
+
+
+def test_forced(tmp_path: pathlib.Path) -> None:
+    """All the actions are run by forced builds."""
+    sbx, planner = create_planner(tmp_path)
+    planner.plan()
+    record_build(sbx, planner)
+
+    _, planner = create_planner(tmp_path, force=True)
+    plan = plan_by_name(planner)
+    assert {entry["reason"] for entry in plan.values()} == {"forced"}
+
+
+def test_restored(tmp_path: pathlib.Path) -> None:
+    """Builds found in the artifact cache are reported as restored."""
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    _, planner = create_planner(tmp_path, artifact_cache=cache)
+    plan = plan_by_name(planner)
+    hello_uid = plan["hello"]["uid"]
+    fingerprint = planner.new_fingerprints[hello_uid]
+    assert fingerprint is not None
+    install_dir = tmp_path / "install"
+    install_dir.mkdir()
+    cache.store(ArtifactCache.key(hello_uid, fingerprint), hello_uid, str(install_dir))
+
+    _, planner = create_planner(tmp_path, artifact_cache=cache)
+    plan = plan_by_name(planner)
+    assert plan["hello"]["reason"] == "never built, restored from the artifact cache"
+    assert plan["hello"]["duration"] == 0.0
+    assert plan["world"]["reason"] == "never built"
+    assert plan["world"]["duration"] > 0.0